@@ -46,6 +46,7 @@ and writePlistToString().
 from Foundation import NSData
 from Foundation import NSPropertyListSerialization
 from Foundation import NSPropertyListMutableContainers
+from Foundation import NSPropertyListBinaryFormat_v1_0
 from Foundation import NSPropertyListXMLFormat_v1_0
 # pylint: enable=E0611
 
@@ -106,14 +107,14 @@ def readPlistFromString(data):
         return dataObject
 
 
-def writePlist(dataObject, filepath):
+def _writePlistWithFormat(dataObject, filepath, plistFormat):
     '''
-    Write 'rootObject' as a plist to filepath.
+    Write 'dataObject' to filepath as a plist in plistFormat.
     '''
     plistData, error = (
         NSPropertyListSerialization.
         dataFromPropertyList_format_errorDescription_(
-            dataObject, NSPropertyListXMLFormat_v1_0, None))
+            dataObject, plistFormat, None))
     if plistData is None:
         if error:
             error = error.encode('ascii', 'ignore')
@@ -128,6 +129,23 @@ def writePlist(dataObject, filepath):
                 "Failed to write plist data to %s" % filepath)
 
 
+def writePlist(dataObject, filepath):
+    '''
+    Write 'dataObject' as a plist to filepath.
+    '''
+    _writePlistWithFormat(dataObject, filepath, NSPropertyListXMLFormat_v1_0)
+
+
+def writeBinaryPlist(dataObject, filepath):
+    '''
+    Write 'dataObject' as a binary plist to filepath. Binary plists are
+    much quicker to read back than XML plists, so they are a good choice
+    for local caches that are never edited by hand.
+    '''
+    _writePlistWithFormat(
+        dataObject, filepath, NSPropertyListBinaryFormat_v1_0)
+
+
 def writePlistToString(rootObject):
     '''Return 'rootObject' as a plist-formatted string.'''
     plistData, error = (
@@ -40,3 +40,20 @@ def list_items_of_kind(repo, kind):
     '''Returns a list of items of kind. Relative pathnames are prepended
     with kind. (example: ['icons/Bar.png', 'icons/Foo.png'])'''
     return [os.path.join(kind, item) for item in repo.itemlist(kind)]
+
+
+def list_items_with_fingerprints(repo, kind):
+    '''Returns a list of items of kind, like list_items_of_kind, and a dict
+    of item to a (size, mtime) fingerprint for the items the repo can
+    provide metadata for.'''
+    if not hasattr(repo, 'itemlist_with_metadata'):
+        # a plugin that doesn't derive from munkirepo.Repo
+        return list_items_of_kind(repo, kind), {}
+    items = []
+    fingerprints = {}
+    for metadata in repo.itemlist_with_metadata(kind):
+        item = os.path.join(kind, metadata['identifier'])
+        items.append(item)
+        if 'size' in metadata and 'mtime' in metadata:
+            fingerprints[item] = (metadata['size'], metadata['mtime'])
+    return items, fingerprints
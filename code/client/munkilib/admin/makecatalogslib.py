@@ -21,50 +21,304 @@ Routines used by makecatalogs
 """
 
 # std libs
+import cPickle
 import hashlib
+import itertools
 import os
 import plistlib
+import shutil
+import tempfile
+from cStringIO import StringIO
 
 # our libs
-from .common import list_items_of_kind, AttributeDict
+from .common import list_items_of_kind, list_items_with_fingerprints
+from .common import AttributeDict
 
 from .. import munkirepo
 
 
+# bump this when the layout of the incremental state file changes
+STATE_FORMAT = 1
+
+
 class MakeCatalogsError(Exception):
     '''Error to raise when there is problem making catalogs'''
     pass
 
 
-def hash_icons(repo, output_fn=None):
-    '''Builds a dictionary containing hashes for all our repo icons'''
+class CatalogWriter(object):
+    '''Writes catalogs as XML plists, byte-for-byte the same as
+    plistlib.writePlist would, but serializes each pkginfo only once no
+    matter how many catalogs it is in, and streams each catalog to a file
+    instead of building it in memory.'''
+
+    def __init__(self):
+        # serialized pkginfo, keyed on id() of the pkginfo dicts; the
+        # catalogs hold references to them for as long as we are used
+        self.fragments = {}
+
+    def fragment(self, pkginfo):
+        '''Returns pkginfo serialized as an element of a top-level array'''
+        key = id(pkginfo)
+        if key not in self.fragments:
+            buf = StringIO()
+            writer = plistlib.PlistWriter(buf, indentLevel=1, writeHeader=0)
+            writer.writeValue(pkginfo)
+            self.fragments[key] = buf.getvalue()
+        return self.fragments[key]
+
+    def write(self, pkginfo_list, fileref):
+        '''Writes pkginfo_list as a plist to fileref and returns the
+        SHA-256 hexdigest of what was written'''
+        digest = hashlib.sha256()
+        for chunk in self._chunks(pkginfo_list):
+            fileref.write(chunk)
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def _chunks(self, pkginfo_list):
+        '''Generates the pieces of the catalog plist'''
+        yield plistlib.PLISTHEADER
+        yield '<plist version="1.0">\n<array>\n'
+        for pkginfo in pkginfo_list:
+            yield self.fragment(pkginfo)
+        yield '</array>\n</plist>\n'
+
+
+def default_state_file(repo_url):
+    '''Returns the default path of the incremental state file for repo_url.
+    The state is a local cache, so it lives outside the repo.'''
+    if isinstance(repo_url, unicode):
+        repo_url = repo_url.encode('utf-8')
+    return os.path.join(
+        os.path.expanduser(
+            '~/Library/Caches/com.googlecode.munki.makecatalogs'),
+        hashlib.sha1(repo_url).hexdigest())
+
+
+def load_state(state_file):
+    '''Returns the incremental state saved by a previous run, or a new, empty
+    state if there is none we can use.'''
+    state = {}
+    try:
+        with open(state_file, 'rb') as fileref:
+            state = cPickle.load(fileref)
+    except (IOError, OSError):
+        pass
+    except Exception:
+        # corrupt or from an incompatible version; just start over
+        state = {}
+    if not isinstance(state, dict) or state.get('format') != STATE_FORMAT:
+        state = {}
+    state['format'] = STATE_FORMAT
+    state.setdefault('pkgsinfo', {})
+    state.setdefault('catalogs', {})
+    state.setdefault('icons', {})
+    return state
+
+
+def save_state(state_file, state):
+    '''Saves incremental state for the next run. Writes to a temporary file
+    first so an interrupted run can't leave a truncated state file.'''
+    state_dir = os.path.dirname(state_file)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    fileref = tempfile.NamedTemporaryFile(dir=state_dir, delete=False)
+    try:
+        cPickle.dump(state, fileref, cPickle.HIGHEST_PROTOCOL)
+        fileref.close()
+        os.rename(fileref.name, state_file)
+    except BaseException:
+        fileref.close()
+        os.unlink(fileref.name)
+        raise
+
+
+def parse_pkginfo(pkginfo_ref, data, errors):
+    '''Parses pkginfo data and strips the keys that don't belong in catalogs.
+    Returns None and adds to the errors list if the pkginfo is unusable.'''
+    try:
+        pkginfo = plistlib.readPlistFromString(data)
+    except BaseException, err:
+        errors.append("Unexpected error for %s: %s" % (pkginfo_ref, err))
+        return None
+
+    if not 'name' in pkginfo:
+        errors.append("WARNING: %s is missing name" % pkginfo_ref)
+        return None
+
+    # don't copy admin notes to catalogs.
+    if pkginfo.get('notes'):
+        del pkginfo['notes']
+    # strip out any keys that start with "_"
+    # (example: pkginfo _metadata)
+    for key in pkginfo.keys():
+        if key.startswith('_'):
+            del pkginfo[key]
+    return pkginfo
+
+
+def get_many(repo, resource_identifiers, jobs=None):
+    '''Generates a (resource_identifier, content) tuple for each of
+    resource_identifiers, in order, reading jobs items at once. Plugins
+    with their own get_many are asked to use that many threads; the rest
+    are read in a pool of jobs threads. If jobs is None, plugins read the
+    items however they do best.'''
+    own_get_many = getattr(getattr(type(repo), 'get_many', None),
+                           'im_func', None)
+    if (jobs and jobs > 1 and
+            own_get_many in (None, munkirepo.Repo.get_many.im_func)):
+        return munkirepo.get_many_in_threads(
+            repo, list(resource_identifiers), jobs)
+    return munkirepo.get_many(repo, resource_identifiers, threads=jobs)
+
+
+def hash_icons(repo, output_fn=None, state=None, jobs=None):
+    '''Builds a dictionary containing hashes for all our repo icons.
+
+    If state (from load_state) is given, icons that are unchanged since the
+    run that saved it are not read and hashed again. The rest are read with
+    get_many.'''
     errors = []
     icons = {}
     if output_fn:
         output_fn("Getting list of icons...")
-    icon_list = repo.itemlist('icons')
+    previous_icons = {}
+    icon_fingerprints = {}
+    if state is not None:
+        previous_icons = state['icons']
+        # rebuilt from scratch so removed icons drop out
+        state['icons'] = {}
+        icon_list, icon_fingerprints = list_items_with_fingerprints(
+            repo, 'icons')
+        icon_list = [item[len('icons/'):] for item in icon_list]
+    else:
+        icon_list = repo.itemlist('icons')
     # Don't hash the hashes, they aren't icons.
     if '_icon_hashes.plist' in icon_list:
         icon_list.remove('_icon_hashes.plist')
+
+    fingerprints = {}
+    changed_icons = []
     for icon_ref in icon_list:
+        if state is not None:
+            fingerprint = icon_fingerprints.get('icons/' + icon_ref)
+            previous = previous_icons.get(icon_ref)
+            if (fingerprint and previous and
+                    previous['fingerprint'] == fingerprint):
+                icons[icon_ref] = previous['hash']
+                state['icons'][icon_ref] = previous
+                continue
+            fingerprints[icon_ref] = fingerprint
+        changed_icons.append(icon_ref)
+
+    results = get_many(
+        repo, ['icons/' + icon_ref for icon_ref in changed_icons], jobs)
+    for icon_ref, (dummy_ref, icondata) in itertools.izip(
+            changed_icons, results):
         if output_fn:
             output_fn("Hashing %s..." % (icon_ref))
-        # Try to read the icon file
-        try:
-            icondata = repo.get('icons/' + icon_ref)
-            icons[icon_ref] = hashlib.sha256(icondata).hexdigest()
-        except munkirepo.RepoError, err:
-            errors.append(u'RepoError for %s: %s' % (icon_ref, unicode(err)))
-        except IOError, err:
-            errors.append(u'IO error for %s: %s' % (icon_ref, err))
-        except BaseException, err:
-            errors.append(u'Unexpected error for %s: %s' % (icon_ref, err))
+        if isinstance(icondata, munkirepo.RepoError):
+            errors.append(u'RepoError for %s: %s'
+                          % (icon_ref, unicode(icondata)))
+            continue
+        icon_hash = hashlib.sha256(icondata).hexdigest()
+        icons[icon_ref] = icon_hash
+        if fingerprints.get(icon_ref):
+            state['icons'][icon_ref] = {'fingerprint': fingerprints[icon_ref],
+                                        'hash': icon_hash}
     return icons, errors
 
 
+def read_pkginfo(pkginfo_ref, data, previous_pkgsinfo=None,
+                 fingerprint=None):
+    '''Parses the pkginfo file pkginfo_ref, whose contents are data, or the
+    RepoError raised reading it.
+
+    If previous_pkgsinfo (the pkgsinfo dict of incremental state) is given
+    and the hash of data matches the fingerprint recorded there, the
+    pkginfo parsed last time is used. Use this for items that have no
+    fingerprint from list_items_with_fingerprints.
+
+    Returns a tuple of the stripped pkginfo (or None if it can't be used),
+    its fingerprint (None unless previous_pkgsinfo is given) and a list of
+    errors.'''
+    errors = []
+    if isinstance(data, munkirepo.RepoError):
+        errors.append("Unexpected error for %s: %s" % (pkginfo_ref, data))
+        return None, None, errors
+    if previous_pkgsinfo is None:
+        fingerprint = None
+    else:
+        if fingerprint is None:
+            # can't stat items in this repo; compare contents instead
+            fingerprint = hashlib.sha256(data).hexdigest()
+        previous = previous_pkgsinfo.get(pkginfo_ref)
+        if previous and previous['fingerprint'] == fingerprint:
+            return previous['pkginfo'], fingerprint, errors
+    pkginfo = parse_pkginfo(pkginfo_ref, data, errors)
+    return pkginfo, fingerprint, errors
+
+
+def read_pkgsinfo(repo, pkgsinfo_list, fingerprints=None,
+                  previous_pkgsinfo=None, jobs=None):
+    '''Generates the result of read_pkginfo for each of pkgsinfo_list, in
+    order. The pkginfo files are read with get_many, except, if
+    previous_pkgsinfo is given, those whose fingerprint shows they haven't
+    changed.'''
+    fingerprints = fingerprints or {}
+
+    def unchanged(pkginfo_ref):
+        '''Returns the previous state of pkginfo_ref if its fingerprint
+        hasn't changed'''
+        if previous_pkgsinfo is None:
+            return None
+        fingerprint = fingerprints.get(pkginfo_ref)
+        previous = previous_pkgsinfo.get(pkginfo_ref)
+        if fingerprint and previous and previous['fingerprint'] == fingerprint:
+            return previous
+        return None
+
+    contents = get_many(
+        repo, [pkginfo_ref for pkginfo_ref in pkgsinfo_list
+               if not unchanged(pkginfo_ref)], jobs)
+    for pkginfo_ref in pkgsinfo_list:
+        previous = unchanged(pkginfo_ref)
+        if previous:
+            yield previous['pkginfo'], previous['fingerprint'], []
+            continue
+        dummy_ref, data = next(contents)
+        yield read_pkginfo(pkginfo_ref, data, previous_pkgsinfo,
+                           fingerprints.get(pkginfo_ref))
+
+
+class PkgsIndex(object):
+    '''Index of the items in the repo's pkgs, for fast exact and
+    case-insensitive lookups of installer item paths'''
+
+    def __init__(self, pkgs_list):
+        self.paths = set(pkgs_list)
+        self.lowercase_paths = {}
+        for repo_pkg in pkgs_list:
+            # keep the first match, as a scan of pkgs_list would
+            self.lowercase_paths.setdefault(repo_pkg.lower(), repo_pkg)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def case_insensitive_match(self, path):
+        '''Returns the path of the repo item that matches path when case is
+        ignored, or None'''
+        return self.lowercase_paths.get(path.lower())
+
+
 def verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors):
     '''Returns True if referenced installer items are present,
-    False otherwise. Adds errors/warnings to the errors list'''
+    False otherwise. Adds errors/warnings to the errors list.
+    pkgs_list can be a list of pkgs items, but a PkgsIndex built once and
+    reused for every pkginfo is much faster.'''
+    if not isinstance(pkgs_list, PkgsIndex):
+        pkgs_list = PkgsIndex(pkgs_list)
     installer_type = pkginfo.get('installer_type')
     if installer_type in ['nopkg', 'apple_update_metadata']:
         # no associated installer item (pkg) for these types
@@ -91,20 +345,17 @@ def verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors):
     # Check if the installer item actually exists
     if not installeritempath in pkgs_list:
         # do a case-insenstive comparison
-        found_caseinsensitive_match = False
-        for repo_pkg in pkgs_list:
-            if installeritempath.lower() == repo_pkg.lower():
-                errors.append(
-                    "WARNING: %s refers to installer item: %s. "
-                    "The pathname of the item in the repo has "
-                    "different case: %s. This may cause issues "
-                    "depending on the case-sensitivity of the "
-                    "underlying filesystem."
-                    % (pkginfo_ref,
-                       pkginfo['installer_item_location'], repo_pkg))
-                found_caseinsensitive_match = True
-                break
-        if not found_caseinsensitive_match:
+        repo_pkg = pkgs_list.case_insensitive_match(installeritempath)
+        if repo_pkg:
+            errors.append(
+                "WARNING: %s refers to installer item: %s. "
+                "The pathname of the item in the repo has "
+                "different case: %s. This may cause issues "
+                "depending on the case-sensitivity of the "
+                "underlying filesystem."
+                % (pkginfo_ref,
+                   pkginfo['installer_item_location'], repo_pkg))
+        else:
             errors.append(
                 "WARNING: %s refers to missing installer item: %s"
                 % (pkginfo_ref, pkginfo['installer_item_location']))
@@ -133,20 +384,17 @@ def verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors):
         # Check if the uninstaller item actually exists
         if not uninstalleritempath in pkgs_list:
             # do a case-insenstive comparison
-            found_caseinsensitive_match = False
-            for repo_pkg in pkgs_list:
-                if uninstalleritempath.lower() == repo_pkg.lower():
-                    errors.append(
-                        "WARNING: %s refers to uninstaller item: %s. "
-                        "The pathname of the item in the repo has "
-                        "different case: %s. This may cause issues "
-                        "depending on the case-sensitivity of the "
-                        "underlying filesystem."
-                        % (pkginfo_ref,
-                           pkginfo['uninstaller_item_location'], repo_pkg))
-                    found_caseinsensitive_match = True
-                    break
-            if not found_caseinsensitive_match:
+            repo_pkg = pkgs_list.case_insensitive_match(uninstalleritempath)
+            if repo_pkg:
+                errors.append(
+                    "WARNING: %s refers to uninstaller item: %s. "
+                    "The pathname of the item in the repo has "
+                    "different case: %s. This may cause issues "
+                    "depending on the case-sensitivity of the "
+                    "underlying filesystem."
+                    % (pkginfo_ref,
+                       pkginfo['uninstaller_item_location'], repo_pkg))
+            else:
                 errors.append(
                     "WARNING: %s refers to missing uninstaller item: %s"
                     % (pkginfo_ref, pkginfo['uninstaller_item_location']))
@@ -156,15 +404,24 @@ def verify_pkginfo(pkginfo_ref, pkginfo, pkgs_list, errors):
     return True
 
 
-def process_pkgsinfo(repo, options, output_fn=None):
-    '''Processes pkginfo files and returns a dictionary of catalogs'''
+def process_pkgsinfo(repo, options, output_fn=None, state=None):
+    '''Processes pkginfo files and returns a dictionary of catalogs.
+
+    If state (from load_state) is given, pkginfo files that are unchanged
+    since the run that saved it are not read or parsed again, and state is
+    updated for the current contents of the repo.'''
     errors = []
     catalogs = {}
     # get a list of pkgsinfo items
     if output_fn:
         output_fn("Getting list of pkgsinfo...")
+    pkgsinfo_fingerprints = {}
     try:
-        pkgsinfo_list = list_items_of_kind(repo, 'pkgsinfo')
+        if state is not None:
+            pkgsinfo_list, pkgsinfo_fingerprints = (
+                list_items_with_fingerprints(repo, 'pkgsinfo'))
+        else:
+            pkgsinfo_list = list_items_of_kind(repo, 'pkgsinfo')
     except munkirepo.RepoError, err:
         raise MakeCatalogsError(
             "Error getting list of pkgsinfo items: %s" % unicode(err))
@@ -173,7 +430,7 @@ def process_pkgsinfo(repo, options, output_fn=None):
     if output_fn:
         output_fn("Getting list of pkgs...")
     try:
-        pkgs_list = list_items_of_kind(repo, 'pkgs')
+        pkgs_list = PkgsIndex(list_items_of_kind(repo, 'pkgs'))
     except munkirepo.RepoError, err:
         raise MakeCatalogsError(
             "Error getting list of pkgs items: %s" % unicode(err))
@@ -182,31 +439,49 @@ def process_pkgsinfo(repo, options, output_fn=None):
     catalogs = {}
     catalogs['all'] = []
 
-    # Walk through the pkginfo files
-    for pkginfo_ref in pkgsinfo_list:
-        # Try to read the pkginfo file
-        try:
-            data = repo.get(pkginfo_ref)
-            pkginfo = plistlib.readPlistFromString(data)
-        except IOError, err:
-            errors.append("IO error for %s: %s" % (pkginfo_ref, err))
-            continue
-        except BaseException, err:
-            errors.append("Unexpected error for %s: %s" % (pkginfo_ref, err))
-            continue
+    previous_pkgsinfo = None
+    if state is not None:
+        previous_pkgsinfo = state['pkgsinfo']
+        # rebuilt from scratch so removed pkginfo files drop out
+        state['pkgsinfo'] = {}
+
+    # read and parse the pkginfo files; results come back in pkgsinfo_list
+    # order however they are read, so the catalogs and errors don't depend
+    # on the number of jobs
+    results = read_pkgsinfo(
+        repo, pkgsinfo_list, pkgsinfo_fingerprints, previous_pkgsinfo,
+        getattr(options, 'jobs', None))
+    add_pkginfo_to_catalogs(
+        pkgsinfo_list, results, pkgs_list, catalogs, options, errors,
+        state=state, output_fn=output_fn)
+
+    # look for catalog names that differ only in case
+    duplicate_catalogs = []
+    for key in catalogs:
+        if key.lower() in [item.lower() for item in catalogs if item != key]:
+            duplicate_catalogs.append(key)
+    if duplicate_catalogs:
+        errors.append("WARNING: There are catalogs with names that differ only "
+                      "by case. This may cause issues depending on the case-"
+                      "sensitivity of the underlying filesystem: %s"
+                      % duplicate_catalogs)
 
-        if not 'name' in pkginfo:
-            errors.append("WARNING: %s is missing name" % pkginfo_ref)
+    return catalogs, errors
+
+
+def add_pkginfo_to_catalogs(pkgsinfo_list, results, pkgs_list, catalogs,
+                            options, errors, state=None, output_fn=None):
+    '''Checks each pkginfo read by read_pkginfo and adds it to the relevant
+    catalogs. results must be in the same order as pkgsinfo_list.'''
+    for pkginfo_ref, (pkginfo, fingerprint, read_errors) in itertools.izip(
+            pkgsinfo_list, results):
+        errors.extend(read_errors)
+        if pkginfo is None:
             continue
 
-        # don't copy admin notes to catalogs.
-        if pkginfo.get('notes'):
-            del pkginfo['notes']
-        # strip out any keys that start with "_"
-        # (example: pkginfo _metadata)
-        for key in pkginfo.keys():
-            if key.startswith('_'):
-                del pkginfo[key]
+        if state is not None:
+            state['pkgsinfo'][pkginfo_ref] = {'fingerprint': fingerprint,
+                                              'pkginfo': pkginfo}
 
         # sanity checking
         if not options.skip_payload_check:
@@ -228,19 +503,6 @@ def process_pkgsinfo(repo, options, output_fn=None):
             if output_fn:
                 output_fn("Adding %s to %s..." % (pkginfo_ref, catalogname))
 
-    # look for catalog names that differ only in case
-    duplicate_catalogs = []
-    for key in catalogs:
-        if key.lower() in [item.lower() for item in catalogs if item != key]:
-            duplicate_catalogs.append(key)
-    if duplicate_catalogs:
-        errors.append("WARNING: There are catalogs with names that differ only "
-                      "by case. This may cause issues depending on the case-"
-                      "sensitivity of the underlying filesystem: %s"
-                      % duplicate_catalogs)
-
-    return catalogs, errors
-
 
 def makecatalogs(repo, options, output_fn=None):
     '''Assembles all pkginfo files into catalogs.
@@ -250,13 +512,59 @@ def makecatalogs(repo, options, output_fn=None):
     if isinstance(options, dict):
         options = AttributeDict(options)
 
-    icons, errors = hash_icons(repo, output_fn=output_fn)
+    state = None
+    state_file = getattr(options, 'state_file', None)
+    if state_file:
+        state = load_state(state_file)
+
+    icons, errors = hash_icons(repo, output_fn=output_fn, state=state,
+                               jobs=getattr(options, 'jobs', None))
 
     catalogs, catalog_errors = process_pkgsinfo(
-        repo, options, output_fn=output_fn)
+        repo, options, output_fn=output_fn, state=state)
 
     errors.extend(catalog_errors)
 
+    # publish the catalogs and icon hashes together, once they are all
+    # written, so clients never see a mix of old and new catalogs
+    try:
+        with munkirepo.batch(repo):
+            write_catalogs(repo, catalogs, icons, errors, state=state,
+                           output_fn=output_fn)
+    except munkirepo.RepoError, err:
+        errors.append(u'Failed to publish catalogs: %s' % unicode(err))
+        if state is not None:
+            # we don't know what made it into the repo
+            state['catalogs'] = {}
+            state.pop('icon_hashes', None)
+
+    if state is not None:
+        try:
+            save_state(state_file, state)
+        except (IOError, OSError, cPickle.PicklingError), err:
+            errors.append(
+                u'Could not save state to %s: %s' % (state_file, err))
+
+    # Return and errors
+    return errors
+
+
+def unchanged_in_repo(repo, resource_identifier, content_hash):
+    '''Returns True if the item in the repo has the SHA-256 hexdigest
+    content_hash. The repo may have been changed since we last wrote to it,
+    by a full run, another admin or by hand, so we check what is there now
+    instead of trusting our state.'''
+    try:
+        data = repo.get(resource_identifier)
+    except munkirepo.RepoError:
+        return False
+    return hashlib.sha256(data).hexdigest() == content_hash
+
+
+def write_catalogs(repo, catalogs, icons, errors, state=None,
+                   output_fn=None):
+    '''Removes old catalogs and writes new catalogs and the icon hashes to
+    the repo. Adds errors to the errors list.'''
     # clear out old catalogs
     try:
         catalog_list = repo.itemlist('catalogs')
@@ -271,30 +579,57 @@ def makecatalogs(repo, options, output_fn=None):
                 errors.append('Could not delete catalog %s' % catalog_name)
 
     # write the new catalogs
-    for key in catalogs:
-        catalogpath = os.path.join("catalogs", key)
-        if len(catalogs[key]):
-            catalog_data = plistlib.writePlistToString(catalogs[key])
-            try:
-                repo.put(catalogpath, catalog_data)
-                if output_fn:
-                    output_fn("Created %s..." % catalogpath)
-            except munkirepo.RepoError, err:
-                errors.append(
-                    u'Failed to create catalog %s: %s' % (key, unicode(err)))
-        else:
-            errors.append(
-                "WARNING: Did not create catalog %s because it is empty" % key)
+    catalog_hashes = {}
+    writer = CatalogWriter()
+    tmpdir = tempfile.mkdtemp(prefix='makecatalogs')
+    try:
+        for key in catalogs:
+            catalogpath = os.path.join("catalogs", key)
+            if len(catalogs[key]):
+                local_catalog = os.path.join(tmpdir, 'catalog')
+                with open(local_catalog, 'wb') as fileref:
+                    catalog_hash = writer.write(catalogs[key], fileref)
+                if (state is not None and key in catalog_list and
+                        state['catalogs'].get(key) == catalog_hash and
+                        unchanged_in_repo(repo, catalogpath, catalog_hash)):
+                    # same contents as the catalog already in the repo
+                    catalog_hashes[key] = catalog_hash
+                    if output_fn:
+                        output_fn("Skipped unchanged %s..." % catalogpath)
+                    continue
+                try:
+                    repo.put_from_local_file(catalogpath, local_catalog)
+                    catalog_hashes[key] = catalog_hash
+                    if output_fn:
+                        output_fn("Created %s..." % catalogpath)
+                except munkirepo.RepoError, err:
+                    errors.append(u'Failed to create catalog %s: %s'
+                                  % (key, unicode(err)))
+            else:
+                errors.append("WARNING: Did not create catalog %s because "
+                              "it is empty" % key)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
     if icons:
         icon_hashes_plist = os.path.join("icons", "_icon_hashes.plist")
         icon_hashes = plistlib.writePlistToString(icons)
-        try:
-            repo.put(icon_hashes_plist, icon_hashes)
-            print "Created %s..." % (icon_hashes_plist)
-        except munkirepo.RepoError, err:
-            errors.append(
-                u'Failed to create %s: %s' % (icon_hashes_plist, unicode(err)))
+        icon_hashes_hash = hashlib.sha256(icon_hashes).hexdigest()
+        if (state is not None and
+                state.get('icon_hashes') == icon_hashes_hash and
+                unchanged_in_repo(repo, icon_hashes_plist, icon_hashes_hash)):
+            if output_fn:
+                output_fn("Skipped unchanged %s..." % icon_hashes_plist)
+        else:
+            try:
+                repo.put(icon_hashes_plist, icon_hashes)
+                if output_fn:
+                    output_fn("Created %s..." % icon_hashes_plist)
+                if state is not None:
+                    state['icon_hashes'] = icon_hashes_hash
+            except munkirepo.RepoError, err:
+                errors.append(u'Failed to create %s: %s'
+                              % (icon_hashes_plist, unicode(err)))
 
-    # Return and errors
-    return errors
+    if state is not None:
+        state['catalogs'] = catalog_hashes
@@ -0,0 +1,327 @@
+# encoding: utf-8
+#
+# Copyright 2018 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+manifestutillib
+
+Routines used by manifestutil: a local index of the manifests and catalogs
+in a repo, kept in a cache file and brought up to date by reading only the
+items that changed.
+"""
+
+# std libs
+import cPickle
+import copy
+import hashlib
+import itertools
+import os
+import plistlib
+import tempfile
+from xml.parsers.expat import ExpatError
+
+# our libs
+from .common import list_items_with_fingerprints
+
+from .. import munkirepo
+
+
+# bump this when the layout of the index cache file changes
+INDEX_FORMAT = 1
+# the kinds of repo item the index holds
+INDEX_KINDS = ('manifests', 'catalogs')
+
+
+def default_cache_file(repo_url):
+    '''Returns the default path of the index cache file for repo_url.
+    The index is a local cache, so it lives outside the repo.'''
+    if isinstance(repo_url, unicode):
+        repo_url = repo_url.encode('utf-8')
+    return os.path.join(
+        os.path.expanduser(
+            '~/Library/Caches/com.googlecode.munki.manifestutil'),
+        hashlib.sha1(repo_url).hexdigest())
+
+
+def catalog_item_names(catalog):
+    '''Returns a sorted list of the unique names of the items in a catalog
+    that aren't updates for other items'''
+    return sorted(set(item['name'] for item in catalog
+                      if not item.get('update_for')))
+
+
+class RepoIndex(object):
+    '''An index of the manifests and catalogs in a repo: the names of each,
+    the contents of every manifest and the names of the items in every
+    catalog. The index is saved to cache_file, if given, and refresh()
+    reads only the items that were added or changed since then, comparing
+    the (size, mtime) fingerprints the repo plugin provides. Items a plugin
+    can't provide fingerprints for are read on every refresh.'''
+
+    def __init__(self, repo, cache_file=None):
+        self.repo = repo
+        self.cache_file = cache_file
+        self.state = self._load()
+        self.changed = False
+        # a ManifestSearchIndex of our manifests, made when first needed
+        self.search = None
+
+    def _load(self):
+        '''Returns the index saved in our cache file, or a new, empty index
+        if there is none we can use'''
+        state = {}
+        if self.cache_file:
+            try:
+                with open(self.cache_file, 'rb') as fileref:
+                    state = cPickle.load(fileref)
+            except (IOError, OSError):
+                pass
+            except Exception:
+                # corrupt or from an incompatible version; just start over
+                state = {}
+        if not isinstance(state, dict) or state.get('format') != INDEX_FORMAT:
+            state = {}
+        state['format'] = INDEX_FORMAT
+        for kind in INDEX_KINDS:
+            # item name -> {'fingerprint': ..., 'content': ..., 'error': ...}
+            state.setdefault(kind, {})
+        return state
+
+    def save(self):
+        '''Saves the index to our cache file. Writes to a temporary file
+        first so an interrupted save can't leave a truncated cache.'''
+        if not self.cache_file:
+            return
+        cache_dir = os.path.dirname(self.cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fileref = tempfile.NamedTemporaryFile(dir=cache_dir, delete=False)
+        try:
+            cPickle.dump(self.state, fileref, cPickle.HIGHEST_PROTOCOL)
+            fileref.close()
+            os.rename(fileref.name, self.cache_file)
+        except BaseException:
+            fileref.close()
+            os.unlink(fileref.name)
+            raise
+        self.changed = False
+
+    def refresh(self, kinds=INDEX_KINDS):
+        '''Brings the index up to date with the repo for the given kinds of
+        item, and saves it if anything changed. Returns a list of error
+        messages for the items that couldn't be listed or retrieved; items
+        that aren't valid plists are recorded, and manifest_errors() lists
+        those.'''
+        errors = []
+        for kind in kinds:
+            self._refresh_kind(kind, errors)
+        if self.changed:
+            try:
+                self.save()
+            except (IOError, OSError, cPickle.PicklingError), err:
+                errors.append(u'Could not save repo index to %s: %s'
+                              % (self.cache_file, err))
+        return errors
+
+    def _refresh_kind(self, kind, errors):
+        '''Brings the index of one kind of item up to date'''
+        entries = self.state[kind]
+        try:
+            item_refs, fingerprints = list_items_with_fingerprints(
+                self.repo, kind)
+        except munkirepo.RepoError, err:
+            errors.append(u'Could not retrieve %s: %s' % (kind, unicode(err)))
+            return
+        names = [item_ref[len(kind) + 1:] for item_ref in item_refs]
+        for name in set(entries) - set(names):
+            del entries[name]
+            self._changed(kind)
+        changed_refs = []
+        for name, item_ref in itertools.izip(names, item_refs):
+            fingerprint = fingerprints.get(item_ref)
+            if (fingerprint is None or name not in entries or
+                    entries[name]['fingerprint'] != fingerprint):
+                changed_refs.append(item_ref)
+        for item_ref, data in munkirepo.get_many(self.repo, changed_refs):
+            name = item_ref[len(kind) + 1:]
+            if isinstance(data, munkirepo.RepoError):
+                # don't remember it, so we try again next time
+                errors.append(u'Could not retrieve %s: %s'
+                              % (item_ref, unicode(data)))
+                entries.pop(name, None)
+                self._changed(kind)
+                continue
+            entry = {'fingerprint': fingerprints.get(item_ref),
+                     'content': None,
+                     'error': None}
+            try:
+                content = plistlib.readPlistFromString(data)
+                if kind == 'catalogs':
+                    content = catalog_item_names(content)
+                entry['content'] = content
+            except (IOError, OSError, ExpatError, AttributeError,
+                    KeyError, TypeError), err:
+                entry['error'] = unicode(err)
+            if entries.get(name) != entry:
+                entries[name] = entry
+                self._changed(kind)
+
+    def _changed(self, kind):
+        '''Notes that our index of kind has changed'''
+        self.changed = True
+        if kind == 'manifests':
+            self.search = None
+
+    def manifest_names(self):
+        '''Returns a sorted list of the names of the manifests'''
+        return sorted(self.state['manifests'])
+
+    def catalog_names(self):
+        '''Returns a sorted list of the names of the catalogs'''
+        return sorted(self.state['catalogs'])
+
+    def manifests(self):
+        '''Generates a (name, manifest) tuple for each manifest we could
+        read, sorted by name. The manifests are shared with the index, so
+        callers must not change them.'''
+        for name in self.manifest_names():
+            manifest = self.state['manifests'][name]['content']
+            if manifest is not None:
+                yield name, manifest
+
+    def manifest_errors(self):
+        '''Returns a dict of manifest name to the error reading it, for the
+        manifests that aren't valid plists'''
+        return dict((name, entry['error'])
+                    for name, entry in self.state['manifests'].items()
+                    if entry['error'])
+
+    def installer_item_names(self, catalog_limit_list):
+        '''Returns a sorted list of the unique names of the items in the
+        given catalogs'''
+        item_names = set()
+        for catalog_name in catalog_limit_list:
+            entry = self.state['catalogs'].get(catalog_name)
+            if entry and entry['content']:
+                item_names.update(entry['content'])
+        return sorted(item_names)
+
+    def update_manifest(self, name, manifest):
+        '''Records a manifest we have just saved to the repo. Its
+        fingerprint is unknown, so the next refresh reads it again.'''
+        self.state['manifests'][name] = {'fingerprint': None,
+                                         'content': copy.deepcopy(manifest),
+                                         'error': None}
+        self._changed('manifests')
+
+    def rename_manifest(self, source_name, dest_name):
+        '''Records a manifest we have just renamed in the repo'''
+        entry = self.state['manifests'].pop(source_name, None)
+        if entry is not None:
+            entry['fingerprint'] = None
+            self.state['manifests'][dest_name] = entry
+            self._changed('manifests')
+
+    def search_index(self):
+        '''Returns a ManifestSearchIndex of our manifests'''
+        if self.search is None:
+            self.search = ManifestSearchIndex(self.manifests())
+        return self.search
+
+
+def included_manifest_names(manifest):
+    '''Returns the names of the manifests a manifest includes, directly or
+    in its conditional_items'''
+    names = []
+    for value in [manifest] + list(manifest.get('conditional_items', [])):
+        if not isinstance(value, dict):
+            continue
+        included = value.get('included_manifests', [])
+        if isinstance(included, list):
+            names.extend(name for name in included
+                         if isinstance(name, basestring))
+    return names
+
+
+class ManifestSearchIndex(object):
+    '''Inverted indexes of a set of manifests: from each string found in
+    their top-level keys to where it is found, and from each manifest to
+    the manifests that include it. Strings are indexed once, upper-cased,
+    however many manifests they are in, so a search compares each distinct
+    string once.'''
+
+    def __init__(self, manifests):
+        '''manifests is an iterable of (name, manifest) tuples'''
+        # upper-cased string -> [(manifest name, key, position, string)]
+        self.postings = {}
+        # manifest name -> set of the names of manifests that include it
+        self.included_by = {}
+        for name, manifest in manifests:
+            self._add(name, manifest)
+
+    def _add(self, name, manifest):
+        '''Adds a manifest to our indexes'''
+        for key, value in manifest.items():
+            if isinstance(value, basestring):
+                value = [value]
+            elif not isinstance(value, list):
+                continue
+            for position, item in enumerate(value):
+                if isinstance(item, basestring):
+                    self.postings.setdefault(item.upper(), []).append(
+                        (name, key, position, item))
+        for included_name in included_manifest_names(manifest):
+            self.included_by.setdefault(included_name, set()).add(name)
+
+    def find(self, text, keyname=None, exact=False):
+        '''Returns a sorted list of (manifest name, key, string) tuples for
+        each string in a top-level key of a manifest (or just in keyname)
+        that contains text, or is text if exact, ignoring case'''
+        text = text.upper()
+        if exact:
+            postings = self.postings.get(text, [])
+        else:
+            postings = [posting for value in self.postings
+                        if text in value for posting in self.postings[value]]
+        return [(name, key, item) for name, key, dummy_position, item
+                in sorted(postings)
+                if keyname is None or key == keyname]
+
+    def manifests_including(self, name):
+        '''Returns a sorted list of the manifests that include the named
+        manifest directly'''
+        return sorted(self.included_by.get(name, []))
+
+    def include_chains(self, name):
+        '''Returns a sorted list of the chains of manifests that include the
+        named manifest: lists that start with name, each manifest included
+        by the next, and end with a manifest nothing else includes, or one
+        that would start a loop'''
+        chains = []
+        self._add_include_chains([name], chains)
+        return sorted(chains)
+
+    def _add_include_chains(self, chain, chains):
+        '''Adds to chains every chain that continues chain'''
+        includers = self.manifests_including(chain[-1])
+        if not includers:
+            if len(chain) > 1:
+                chains.append(chain)
+            return
+        for includer in includers:
+            if includer in chain:
+                # a loop; stop here rather than going round it
+                chains.append(chain + [includer])
+            else:
+                self._add_include_chains(chain + [includer], chains)
@@ -0,0 +1,324 @@
+# encoding: utf-8
+#
+# Copyright 2018 Greg Neagle.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+repocleanlib
+
+Routines used by repoclean: compact records for the pkginfo items it
+analyzes, a store for them that moves to disk when a repo is too big to
+analyze in memory, and the accounting and deletion of what it cleans up.
+"""
+
+# std libs
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+
+# our libs
+from .. import munkirepo
+
+
+# default for repoclean's --memory-budget, in megabytes
+DEFAULT_MEMORY_BUDGET = 512
+# default for repoclean's --jobs: deletions made at once
+DEFAULT_DELETE_JOBS = 4
+# what reclaim_by_catalog calls the catalog of items without catalogs
+NO_CATALOG = '(no catalog)'
+# rough size of a PkginfoRecord and its share of the store, not counting
+# the characters of its strings
+RECORD_OVERHEAD = 400
+
+# the manifest keys that list items to install or remove
+MANIFEST_ITEM_KEYS = ['managed_installs', 'managed_uninstalls',
+                      'managed_updates', 'optional_installs']
+
+# pkginfo keys that distinguish one variant of an item from another
+METAKEY_KEYS = ['name', 'catalogs', 'minimum_munki_version',
+                'minimum_os_version', 'maximum_os_version',
+                'supported_architectures', 'installable_condition']
+
+
+# what repoclean keeps for each pkginfo item
+PkginfoRecord = namedtuple('PkginfoRecord', [
+    'name', 'version', 'resource_identifier', 'item_size', 'catalogs',
+    'pkg_path', 'pkg_size', 'uninstallpkg_path', 'uninstallpkg_size'])
+
+
+def make_metakey(pkginfo):
+    '''Returns a description of the variant of an item a pkginfo is: items
+    with the same metakey differ only by version'''
+    metakey = ''
+    keys_to_hash = list(METAKEY_KEYS)
+    if pkginfo.get('uninstall_method') == 'removepackages':
+        keys_to_hash.append('receipts')
+    for key in keys_to_hash:
+        if pkginfo.get(key):
+            value = pkginfo[key]
+            if key == 'catalogs':
+                value = ', '.join(value)
+            if key == 'receipts':
+                value = ', '.join(
+                    [item.get('packageid', '') for item in value])
+            metakey += u"%s: %s\n" % (key, value)
+    return metakey.rstrip('\n')
+
+
+def hash_metakey(metakey):
+    '''Returns a short, fixed-size key for a metakey'''
+    return hashlib.sha1(metakey.encode('UTF-8')).digest()
+
+
+def make_record(pkginfo, resource_identifier, item_size):
+    '''Returns a PkginfoRecord for a pkginfo dict'''
+    return PkginfoRecord(
+        pkginfo['name'], pkginfo['version'], resource_identifier, item_size,
+        tuple(pkginfo.get('catalogs', [])),
+        pkginfo.get('installer_item_location', ''),
+        pkginfo.get('installer_item_size', 0) * 1024,
+        pkginfo.get('uninstaller_item_location', ''),
+        pkginfo.get('uninstaller_item_size', 0) * 1024)
+
+
+def record_size(record):
+    '''Estimates the memory used by a PkginfoRecord, in bytes'''
+    return RECORD_OVERHEAD + sum(
+        len(value) for value in record if isinstance(value, basestring))
+
+
+class PkginfoStore(object):
+    '''Holds PkginfoRecords grouped by metakey and then version. Records
+    are kept in memory until their estimated size passes memory_budget
+    bytes; then they are moved to a SQLite database in a temporary
+    directory, where the rest are added too. Call close() when done.'''
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET * 1024 * 1024):
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self.item_count = 0
+        # hashed metakey -> (metakey, {version: [records]})
+        self.variants_by_key = {}
+        self.tmpdir = None
+        self.conn = None
+
+    @property
+    def spilled(self):
+        '''True if our records have been moved to disk'''
+        return self.conn is not None
+
+    def __len__(self):
+        '''Returns the number of variants'''
+        if self.spilled:
+            return self.conn.execute(
+                'SELECT count(*) FROM variants').fetchone()[0]
+        return len(self.variants_by_key)
+
+    def add(self, metakey, record):
+        '''Adds a record for a pkginfo with the given metakey'''
+        self.item_count += 1
+        key = hash_metakey(metakey)
+        if self.spilled:
+            self._insert(key, metakey, [record])
+            return
+        if key not in self.variants_by_key:
+            self.variants_by_key[key] = (metakey, {})
+        self.variants_by_key[key][1].setdefault(
+            record.version, []).append(record)
+        self.memory_used += record_size(record)
+        if self.memory_used > self.memory_budget:
+            self._spill()
+
+    def variants(self):
+        '''Generates a (metakey, {version: [records]}) tuple for each
+        variant, sorted by metakey'''
+        if not self.spilled:
+            for key in sorted(self.variants_by_key,
+                              key=lambda key: self.variants_by_key[key][0]):
+                yield self.variants_by_key[key]
+            return
+        # the variants query has to finish before we run another
+        for key, metakey in self.conn.execute(
+                'SELECT key, metakey FROM variants '
+                'ORDER BY metakey').fetchall():
+            versions = {}
+            for row in self.conn.execute(
+                    'SELECT name, version, resource_identifier, item_size, '
+                    'catalogs, pkg_path, pkg_size, uninstallpkg_path, '
+                    'uninstallpkg_size FROM items WHERE key = ? '
+                    'ORDER BY rowid', (key, )):
+                record = PkginfoRecord(*row)
+                # catalogs are stored one per line
+                record = record._replace(
+                    catalogs=tuple(record.catalogs.splitlines()))
+                versions.setdefault(record.version, []).append(record)
+            yield metakey, versions
+
+    def close(self):
+        '''Removes our database, if we made one'''
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+
+    def _spill(self):
+        '''Moves our records into a SQLite database'''
+        self.tmpdir = tempfile.mkdtemp(prefix='repoclean.')
+        self.conn = sqlite3.connect(os.path.join(self.tmpdir, 'pkgsinfo.db'))
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.conn.execute(
+            'CREATE TABLE variants (key BLOB PRIMARY KEY, metakey TEXT)')
+        self.conn.execute(
+            'CREATE TABLE items (key BLOB, name TEXT, version TEXT, '
+            'resource_identifier TEXT, item_size INTEGER, catalogs TEXT, '
+            'pkg_path TEXT, pkg_size INTEGER, uninstallpkg_path TEXT, '
+            'uninstallpkg_size INTEGER)')
+        self.conn.execute('CREATE INDEX items_key ON items (key)')
+        for key, (metakey, versions) in self.variants_by_key.items():
+            self._insert(key, metakey, [record for records in versions.values()
+                                        for record in records])
+        self.variants_by_key = {}
+        self.memory_used = 0
+
+    def _insert(self, key, metakey, records):
+        '''Adds records for a variant to our database'''
+        key = buffer(key)
+        self.conn.execute(
+            'INSERT OR IGNORE INTO variants (key, metakey) VALUES (?, ?)',
+            (key, metakey))
+        self.conn.executemany(
+            'INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(key, ) + tuple(
+                record._replace(catalogs='\n'.join(record.catalogs)))
+             for record in records])
+
+
+def objects_to_delete(items_to_delete, pkgs_to_keep):
+    '''Returns a list of (resource_identifier, size, catalogs) tuples for
+    the repo objects that deleting items_to_delete, a list of
+    PkginfoRecords, removes: their pkginfo files, and the pkgs they use
+    that aren't in pkgs_to_keep. A pkg used by several items is listed once,
+    with the catalogs of all of them.'''
+    objects = []
+    pkgs = {}
+    for item in items_to_delete:
+        objects.append(
+            (item.resource_identifier, item.item_size, set(item.catalogs)))
+        for pkg_path, pkg_size in [
+                (item.pkg_path, item.pkg_size),
+                (item.uninstallpkg_path, item.uninstallpkg_size)]:
+            if not pkg_path or pkg_path in pkgs_to_keep:
+                continue
+            if pkg_path not in pkgs:
+                pkgs[pkg_path] = (os.path.join('pkgs', pkg_path), pkg_size,
+                                  set())
+                objects.append(pkgs[pkg_path])
+            pkgs[pkg_path][2].update(item.catalogs)
+    return objects
+
+
+def reclaim_by_catalog(objects):
+    '''Given a list from objects_to_delete, returns a dict of catalog
+    name to an (object count, bytes) tuple for the objects in that catalog,
+    and an (object count, bytes) tuple for all of them. Objects in several
+    catalogs are counted in each, but only once in the total.'''
+    by_catalog = {}
+    for dummy_identifier, size, catalogs in objects:
+        for catalog in catalogs or [NO_CATALOG]:
+            count, total_size = by_catalog.get(catalog, (0, 0))
+            by_catalog[catalog] = (count + 1, total_size + int(size))
+    total = (len(objects), sum(int(size) for dummy_id, size, dummy_catalogs
+                               in objects))
+    return by_catalog, total
+
+
+class RateLimiter(object):
+    '''Spaces out calls to wait(), from any number of threads, so no more
+    than rate of them return each second. A rate of 0 or None means no
+    limit.'''
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        '''Returns when the next call is allowed'''
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def delete_objects(repo, resource_identifiers, jobs=DEFAULT_DELETE_JOBS,
+                   rate=None):
+    '''Deletes resource_identifiers from repo, making up to jobs deletions
+    at once and starting no more than rate of them a second. Generates a
+    (resource_identifier, error) tuple for each deletion, in order, where
+    error is the RepoError raised, or None.
+    No more than jobs deletions are started ahead of the one being
+    reported, so if the caller stops early (or is interrupted), only the
+    deletions already under way are made.'''
+    limiter = RateLimiter(rate)
+
+    def delete(resource_identifier):
+        '''Deletes one object'''
+        limiter.wait()
+        try:
+            repo.delete(resource_identifier)
+        except munkirepo.RepoError, err:
+            return resource_identifier, err
+        return resource_identifier, None
+
+    if jobs <= 1:
+        for resource_identifier in resource_identifiers:
+            yield delete(resource_identifier)
+        return
+    pool = ThreadPool(jobs)
+    pending = deque()
+    try:
+        for resource_identifier in resource_identifiers:
+            pending.append(pool.apply_async(delete, (resource_identifier, )))
+            if len(pending) >= jobs:
+                yield wait_for(pending.popleft())
+        while pending:
+            yield wait_for(pending.popleft())
+    except BaseException:
+        # closed early, or interrupted; start no more deletions
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def wait_for(async_result):
+    '''Returns the result of a pool task. Waits with a timeout, since an
+    untimed wait can't be interrupted with Ctrl-C.'''
+    while not async_result.ready():
+        async_result.wait(0.5)
+    return async_result.get()
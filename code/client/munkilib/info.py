@@ -802,21 +802,44 @@ def predicate_info_object():
     return info_object
 
 
+# results of predicates evaluated against the unmodified info object,
+# keyed by predicate string
+_PREDICATE_RESULTS = {}
+
+
+def reset_predicate_results():
+    '''Forgets cached predicate results. Called at the start of each check,
+    since the info object may have changed since the last one.'''
+    _PREDICATE_RESULTS.clear()
+
+
 def predicate_evaluates_as_true(predicate_string, additional_info=None):
-    '''Evaluates predicate against our info object'''
+    '''Evaluates predicate against our info object. Results for predicates
+    evaluated without additional_info are cached, since the info object
+    doesn't change during a run.'''
+    use_cache = not additional_info
+    if use_cache and predicate_string in _PREDICATE_RESULTS:
+        result = _PREDICATE_RESULTS[predicate_string]
+        display.display_debug1(
+            'Predicate %s is %s (cached)', predicate_string, result)
+        return result
     display.display_debug1('Evaluating predicate: %s', predicate_string)
     info_object = predicate_info_object()
     if isinstance(additional_info, dict):
+        # copy so we don't modify the memoized info object
+        info_object = dict(info_object)
         info_object.update(additional_info)
     try:
         predicate = NSPredicate.predicateWithFormat_(predicate_string)
     except BaseException, err:
         display.display_warning('%s', err)
         # can't parse predicate, so return False
-        return False
-
-    result = predicate.evaluateWithObject_(info_object)
-    display.display_debug1('Predicate %s is %s', predicate_string, result)
+        result = False
+    else:
+        result = predicate.evaluateWithObject_(info_object)
+        display.display_debug1('Predicate %s is %s', predicate_string, result)
+    if use_cache:
+        _PREDICATE_RESULTS[predicate_string] = result
     return result
 
 
@@ -24,9 +24,12 @@ only file removals are done.
 
 """
 
+import collections
+import itertools
 import os
 import subprocess
 import sqlite3
+from multiprocessing.pool import ThreadPool
 
 from .. import display
 from .. import munkistatus
@@ -55,15 +58,34 @@ from .. import FoundationPlist
 #                          uid INTEGER,
 #                          gid INTEGER,
 #                          perms INTEGER )
+#
+# plus a table of our own recording where each package came from, so the
+# database can be updated incrementally:
+#
+# CREATE TABLE receipts (pkg_key INTEGER PRIMARY KEY,
+#                        source VARCHAR NOT NULL UNIQUE,
+#                        fingerprint VARCHAR )
 #################################################################
 
+# bump this when the schema changes; databases with a different
+# user_version are rebuilt from scratch
+SCHEMA_VERSION = 1
+# number of BOM lines we queue before inserting them with executemany
+INSERT_BATCH_SIZE = 10000
+# number of paths we look up at once; SQLite allows 999 parameters
+LOOKUP_BATCH_SIZE = 500
+# number of receipts read at once when updating the db
+IMPORT_JOBS = 4
+# page cache for our connection while importing, in kilobytes
+CACHE_SIZE_KB = 64 * 1024
+
 
 def should_rebuild_db(pkgdbpath):
     """
-    Checks to see if our internal package DB should be rebuilt.
+    Checks to see if our internal package DB should be updated.
     If anything in /Library/Receipts, /Library/Receipts/boms, or
     /Library/Receipts/db/a.receiptdb has a newer modtime than our
-    database, we should rebuild.
+    database, we should update it.
     """
     def items_newer_than_pkgdb(directory, file_extensions):
         '''Return true if the directory or files inside the directory
@@ -126,6 +148,78 @@ def create_tables(curs):
                           uid INTEGER,
                           gid INTEGER,
                           perms INTEGER )''')
+    curs.execute('''CREATE TABLE receipts
+                         (pkg_key INTEGER PRIMARY KEY,
+                          source VARCHAR NOT NULL UNIQUE,
+                          fingerprint VARCHAR )''')
+    curs.execute(
+        'CREATE INDEX pkgs_paths_pkg_key ON pkgs_paths (pkg_key)')
+    curs.execute(
+        'CREATE INDEX pkgs_paths_path_key ON pkgs_paths (path_key)')
+    curs.execute('CREATE INDEX pkgs_pkgid ON pkgs (pkgid)')
+    curs.execute('CREATE INDEX pkgs_pkgname ON pkgs (pkgname)')
+    curs.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+
+def database_version(pkgdbpath):
+    '''Returns the schema version of the database at pkgdbpath, or None
+    if it doesn't exist or can't be read'''
+    if not os.path.exists(pkgdbpath):
+        return None
+    try:
+        conn = sqlite3.connect(pkgdbpath)
+        try:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return None
+
+
+def open_database(forcerebuild=False):
+    '''Returns a connection to our package database, creating it first if
+    needed. If forcerebuild is True, or the existing database was made with
+    a different schema, it is removed and recreated empty. Returns None if
+    an out-of-date database can't be removed.'''
+    if os.path.exists(PACKAGEDB) and (
+            forcerebuild or database_version(PACKAGEDB) != SCHEMA_VERSION):
+        try:
+            # along with any write-ahead log
+            for suffix in ['-wal', '-shm', '']:
+                if os.path.exists(PACKAGEDB + suffix):
+                    os.remove(PACKAGEDB + suffix)
+        except (OSError, IOError):
+            display.display_error(
+                "Could not remove out-of-date receipt database.")
+            return None
+
+    newdb = not os.path.exists(PACKAGEDB)
+    conn = sqlite3.connect(PACKAGEDB)
+    conn.text_factory = str
+    # with a write-ahead log and synchronous=NORMAL, commits don't wait for
+    # an fsync. A power failure can lose the last commit but can't corrupt
+    # the db, and it's only a cache of the receipts anyway.
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA cache_size = -%d' % CACHE_SIZE_KB)
+    if newdb:
+        create_tables(conn.cursor())
+        conn.commit()
+    return conn
+
+
+def receipt_fingerprint(paths):
+    '''Returns a string that changes when any of the files at paths is
+    added, removed or modified, or None if none of them exist'''
+    fingerprint = []
+    for path in paths:
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        fingerprint.append('%s:%s:%s' % (path, info.st_mtime, info.st_size))
+    return '\n'.join(fingerprint) or None
 
 
 def find_bundle_receipt(pkgid):
@@ -148,12 +242,13 @@ def find_bundle_receipt(pkgid):
     return ''
 
 
-def insert_bomvalues_into_pkgdb(bom_line, pkgkey, ppath, curs):
-    '''Parses line from lsbom or pkgutil --files and inserts the paths into
-    our pkgdb'''
+def parse_bom_line(bom_line, ppath):
+    '''Parses a line from lsbom or pkgutil --files. Returns a
+    (path, uid, gid, perms) tuple, with ppath prepended to the path so it
+    matches the actual install location, or None for the '.' entry.'''
+    item = bom_line.rstrip("\n").split("\t")
+    path = item[0]
     try:
-        item = bom_line.rstrip("\n").split("\t")
-        path = item[0]
         perms = item[1]
         uidgid = item[2].split("/")
         uid = uidgid[0]
@@ -164,40 +259,138 @@ def insert_bomvalues_into_pkgdb(bom_line, pkgkey, ppath, curs):
         uid = "0"
         gid = "0"
 
-    try:
-        if path != ".":
-            # special case for MS Office 2008 installers
-            if ppath == "tmp/com.microsoft.updater/office_location":
-                ppath = "Applications"
-
-            # prepend the ppath so the paths match the actual install locations
-            path = path.lstrip("./")
-            if ppath:
-                path = ppath + "/" + path
-
-            values_t = (path, )
-            row = curs.execute(
-                'SELECT path_key from paths where path = ?',
-                values_t).fetchone()
-            if not row:
-                curs.execute(
-                    'INSERT INTO paths (path) values (?)', values_t)
-                pathkey = curs.lastrowid
-            else:
-                pathkey = row[0]
-
-            values_t = (pkgkey, pathkey, uid, gid, perms)
-            curs.execute(
-                'INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, '
-                'perms) values (?, ?, ?, ?, ?)', values_t)
-    except sqlite3.DatabaseError:
-        pass
+    if path == ".":
+        return None
+    # special case for MS Office 2008 installers
+    if ppath == "tmp/com.microsoft.updater/office_location":
+        ppath = "Applications"
+    # prepend the ppath so the paths match the actual install locations
+    path = path.lstrip("./")
+    if ppath:
+        path = ppath + "/" + path
+    if isinstance(path, unicode):
+        # paths come back from the db as UTF-8 strs (see text_factory)
+        path = path.encode('UTF-8')
+    return (path, uid, gid, perms)
+
+
+class BomInserter(object):
+    '''Inserts packages and their BOM lines into our pkgdb. Rows are
+    queued and written with executemany in batches of INSERT_BATCH_SIZE.
+    An in-memory map of path to path_key, filled from the db a batch at a
+    time as paths are seen, replaces a SELECT and an INSERT for each
+    line.'''
+
+    def __init__(self, curs):
+        self.curs = curs
+        self.pathkeys = {}
+        # a new db has no paths to look up
+        self.lookup_paths = curs.execute(
+            'SELECT 1 FROM paths LIMIT 1').fetchone() is not None
+        # we allocate path_keys ourselves, continuing the AUTOINCREMENT
+        # sequence, so we don't need a lastrowid for each new path
+        row = curs.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'paths'").fetchone()
+        self.next_pathkey = (row[0] if row else 0) + 1
+        self.queued = []
+
+    def insert_pkg(self, timestamp, owner, pkgid, vers, ppath, pkgname):
+        '''Adds a package to the pkgs table and returns its pkg_key'''
+        return insert_pkg(
+            timestamp, owner, pkgid, vers, ppath, pkgname, self.curs)
+
+    def insert_paths(self, paths, pkgkey):
+        '''Adds paths, a list of (path, uid, gid, perms) tuples from
+        parse_bom_line, to the db as belonging to pkgkey'''
+        for values in paths:
+            self.queued.append((pkgkey, ) + values)
+            if len(self.queued) >= INSERT_BATCH_SIZE:
+                self.flush()
+        self.flush()
+
+    def flush(self):
+        '''Writes any queued rows'''
+        if not self.queued:
+            return
+        unknown_paths = []
+        for row in self.queued:
+            if row[1] not in self.pathkeys:
+                # a placeholder, so each path is only listed once
+                self.pathkeys[row[1]] = None
+                unknown_paths.append(row[1])
+
+        if self.lookup_paths:
+            for index in range(0, len(unknown_paths), LOOKUP_BATCH_SIZE):
+                chunk = unknown_paths[index:index + LOOKUP_BATCH_SIZE]
+                self.pathkeys.update(self.curs.execute(
+                    'SELECT path, path_key FROM paths WHERE path IN (%s)'
+                    % ', '.join(['?'] * len(chunk)), chunk))
+
+        new_paths = []
+        for path in unknown_paths:
+            if self.pathkeys[path] is None:
+                self.pathkeys[path] = self.next_pathkey
+                new_paths.append((self.next_pathkey, path))
+                self.next_pathkey += 1
+        self.curs.executemany(
+            'INSERT INTO paths (path_key, path) values (?, ?)', new_paths)
+
+        self.curs.executemany(
+            'INSERT INTO pkgs_paths (pkg_key, path_key, uid, gid, perms) '
+            'values (?, ?, ?, ?, ?)',
+            [(pkgkey, self.pathkeys[path], uid, gid, perms)
+             for pkgkey, path, uid, gid, perms in self.queued])
+        self.queued = []
+
+
+def command_output_lines(cmd):
+    '''Runs cmd, lsbom or pkgutil --files, and generates each line of its
+    output. Lines are left as UTF-8 strs, which is how the db stores
+    paths, rather than decoded and encoded again.'''
+    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, ''):
+        yield line
+    proc.wait()
+
+
+def package_record(timestamp, owner, pkgid, vers, ppath, pkgname, bom_lines):
+    '''Returns the data write_package() needs to add a package to our
+    pkgdb: a dict with the package's pkgs table values, and the parsed
+    paths from bom_lines, lines of output from lsbom or pkgutil --files'''
+    paths = []
+    for bom_line in bom_lines:
+        values = parse_bom_line(bom_line, ppath)
+        if values:
+            paths.append(values)
+    return {'values': (timestamp, owner, pkgid, vers, ppath, pkgname),
+            'paths': paths}
+
+
+def write_package(package, inserter):
+    '''Adds a package record from one of the read_ functions to our pkgdb
+    and returns its new pkg_key'''
+    pkgkey = inserter.insert_pkg(*package['values'])
+    inserter.insert_paths(package['paths'], pkgkey)
+    return pkgkey
+
+
+def insert_pkg(timestamp, owner, pkgid, vers, ppath, pkgname, curs):
+    '''Adds a package to the pkgs table of our pkgdb and returns its
+    pkg_key'''
+    values_t = (timestamp, owner, pkgid, vers, ppath, pkgname)
+    curs.execute(
+        '''INSERT INTO pkgs (timestamp, owner, pkgid, vers, ppath, pkgname)
+           values (?, ?, ?, ?, ?, ?)''', values_t)
+    return curs.lastrowid
 
 
-def import_package(packagepath, curs):
+def read_package(packagepath):
     """
-    Imports package data from the receipt at packagepath into
-    our internal package database.
+    Reads package data from the receipt at packagepath for
+    our internal package database. Returns a package record (see
+    package_record), or None if the receipt was skipped.
     """
 
     bompath = os.path.join(packagepath, 'Contents/Archive.bom')
@@ -242,28 +435,16 @@ def import_package(packagepath, curs):
                      plist.get('Bundle versions string, short', '1.0'))
     ppath = plist.get('IFPkgRelocatedPath', '').lstrip('./').rstrip('/')
 
-    values_t = (timestamp, owner, pkgid, vers, ppath, pkgname)
-    curs.execute(
-        '''INSERT INTO pkgs (timestamp, owner, pkgid, vers, ppath, pkgname)
-           values (?, ?, ?, ?, ?, ?)''', values_t)
-    pkgkey = curs.lastrowid
+    return package_record(
+        timestamp, owner, pkgid, vers, ppath, pkgname,
+        command_output_lines(['/usr/bin/lsbom', bompath]))
 
-    proc = subprocess.Popen(
-        ['/usr/bin/lsbom', bompath], shell=False, bufsize=-1,
-        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-    while True:
-        line = proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        insert_bomvalues_into_pkgdb(line, pkgkey, ppath, curs)
-
-
-def import_bom(bompath, curs):
+def read_bom(bompath):
     """
-    Imports package data into our internal package database
+    Reads package data for our internal package database
     using a combination of the bom file and data in Apple's
-    package database into our internal package database.
+    package database. Returns a package record (see package_record).
     """
     # If we completely trusted the accuracy of Apple's database, we wouldn't
     # need the bom files, but in my environment at least, the bom files are
@@ -295,26 +476,15 @@ def import_bom(bompath, curs):
         if "install-time" in plist:
             timestamp = plist["install-time"]
 
-    values_t = (timestamp, owner, pkgid, vers, ppath, pkgname)
-    curs.execute(
-        '''INSERT INTO pkgs (timestamp, owner, pkgid, vers, ppath, pkgname)
-           values (?, ?, ?, ?, ?, ?)''', values_t)
-    pkgkey = curs.lastrowid
-
     cmd = ["/usr/bin/lsbom", bompath]
-    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return package_record(timestamp, owner, pkgid, vers, ppath, pkgname,
+                          command_output_lines(cmd))
 
-    while True:
-        line = proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        insert_bomvalues_into_pkgdb(line, pkgkey, ppath, curs)
 
-def import_from_pkgutil(pkgname, curs):
+def read_from_pkgutil(pkgname):
     """
-    Imports package data from pkgutil into our internal package database.
+    Reads package data from pkgutil for our internal package database.
+    Returns a package record (see package_record).
     """
 
     timestamp = 0
@@ -350,63 +520,39 @@ def import_from_pkgutil(pkgname, curs):
                         ppath = infopl["IFPkgRelocatedPath"]
                         ppath = ppath.lstrip('./').rstrip('/')
 
-    values_t = (timestamp, owner, pkgid, vers, ppath, pkgname)
-    curs.execute(
-        '''INSERT INTO pkgs (timestamp, owner, pkgid, vers, ppath, pkgname)
-           values (?, ?, ?, ?, ?, ?)''', values_t)
-    pkgkey = curs.lastrowid
-
     cmd = ["/usr/sbin/pkgutil", "--files", pkgid]
-    proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return package_record(timestamp, owner, pkgid, vers, ppath, pkgname,
+                          command_output_lines(cmd))
 
-    while True:
-        line = proc.stdout.readline().decode('UTF-8')
-        if not line and (proc.poll() != None):
-            break
-        insert_bomvalues_into_pkgdb(line, pkgkey, ppath, curs)
 
-
-def init_database(forcerebuild=False):
-    """
-    Builds or rebuilds our internal package database.
-    """
-    def abort_init_database():
-        '''What to do if user requests we stop'''
-        curs.close()
-        conn.close()
-        #our package db isn't valid, so we should delete it
-        os.remove(PACKAGEDB)
-        return False
-
-    if not should_rebuild_db(PACKAGEDB) and not forcerebuild:
-        return True
-
-    display.display_status_minor(
-        'Gathering information on installed packages')
-
-    if os.path.exists(PACKAGEDB):
-        try:
-            os.remove(PACKAGEDB)
-        except (OSError, IOError):
-            display.display_error(
-                "Could not remove out-of-date receipt database.")
-            return False
+def receipt_sources():
+    '''Returns a list of (source, fingerprint, read_function, argument)
+    tuples, one for each receipt, bom file and pkgutil package we import.
+    source is the receipt or bom path, or the package id; fingerprint is
+    None when we can't tell whether the package has changed.'''
+    sources = []
 
     receiptsdir = '/Library/Receipts'
-    receiptlist = []
     if os.path.exists(receiptsdir):
-        receiptlist = [item for item in osutils.listdir(receiptsdir)
-                       if item.endswith('.pkg')]
+        for item in osutils.listdir(receiptsdir):
+            if item.endswith('.pkg'):
+                receiptpath = os.path.join(receiptsdir, item)
+                fingerprint = receipt_fingerprint(
+                    [receiptpath,
+                     os.path.join(receiptpath, 'Contents/Info.plist'),
+                     os.path.join(receiptpath, 'Contents/Archive.bom'),
+                     os.path.join(receiptpath, 'Contents/Resources')])
+                sources.append(
+                    (receiptpath, fingerprint, read_package, receiptpath))
 
     bomsdir = '/Library/Receipts/boms'
-    bomslist = []
     if os.path.exists(bomsdir):
-        bomslist = [item for item in osutils.listdir(bomsdir)
-                    if item.endswith('.bom')]
+        for item in osutils.listdir(bomsdir):
+            if item.endswith('.bom'):
+                bompath = os.path.join(bomsdir, item)
+                sources.append((bompath, receipt_fingerprint([bompath]),
+                                read_bom, bompath))
 
-    pkglist = []
     cmd = ['/usr/sbin/pkgutil', '--pkgs']
     proc = subprocess.Popen(cmd, shell=False, bufsize=-1,
                             stdin=subprocess.PIPE,
@@ -416,54 +562,162 @@ def init_database(forcerebuild=False):
         line = proc.stdout.readline()
         if not line and (proc.poll() != None):
             break
-
-        pkglist.append(line.rstrip('\n'))
-
-    pkgcount = len(receiptlist) + len(bomslist) + len(pkglist)
-    conn = sqlite3.connect(PACKAGEDB)
-    conn.text_factory = str
+        pkg = line.rstrip('\n')
+        if not pkg:
+            continue
+        # pkgutil keeps its receipts here; if they're somewhere else we
+        # can't tell whether the package changed, so we always reimport it
+        fingerprint = receipt_fingerprint(
+            [os.path.join('/private/var/db/receipts', pkg + extension)
+             for extension in ('.plist', '.bom')])
+        sources.append((pkg, fingerprint, read_from_pkgutil, pkg))
+
+    return sources
+
+
+def read_source(source_info):
+    '''Calls the read function for a (source, fingerprint, read_function,
+    argument) tuple from receipt_sources(). Returns source, fingerprint
+    and the package record. Called from update_database's worker
+    threads.'''
+    source, fingerprint, read_function, argument = source_info
+    return source, fingerprint, read_function(argument)
+
+
+def read_sources(pool, to_import, window):
+    '''Generates read_source() for each of to_import, in order, using the
+    worker threads in pool. At most window packages are being read or
+    waiting to be written at once, so parsed packages don't pile up in
+    memory when the database writer falls behind.'''
+    to_import = iter(to_import)
+    pending = collections.deque(
+        pool.apply_async(read_source, (source_info, ))
+        for source_info in itertools.islice(to_import, window))
+    while pending:
+        package = pending.popleft().get()
+        for source_info in itertools.islice(to_import, 1):
+            pending.append(pool.apply_async(read_source, (source_info, )))
+        yield package
+
+
+def update_database(conn, sources, jobs=IMPORT_JOBS):
+    '''Brings our package database in line with sources, a list like the
+    one returned by receipt_sources(). Packages whose receipts are gone or
+    have changed are removed, and new or changed ones are imported, all
+    in a single transaction. Up to jobs packages are read at once, and no
+    more than jobs * 2 are read ahead of the one being written. If we're
+    asked to stop, the packages imported so far are committed so the next
+    update can pick up from there. Returns False if we stopped before
+    finishing.'''
     curs = conn.cursor()
-    create_tables(curs)
-
-    currentpkgindex = 0
+    imported = {}
+    for pkgkey, source, fingerprint in curs.execute(
+            'SELECT pkg_key, source, fingerprint FROM receipts'):
+        imported[source] = (pkgkey, fingerprint)
+
+    stale_pkgkeys = []
+    to_import = []
+    for source, fingerprint, read_function, argument in sources:
+        previous = imported.pop(source, None)
+        if previous:
+            if fingerprint is not None and previous[1] == fingerprint:
+                continue
+            stale_pkgkeys.append(previous[0])
+        to_import.append((source, fingerprint, read_function, argument))
+    # whatever is left has been removed from the system
+    stale_pkgkeys.extend(pkgkey for pkgkey, dummy_fp in imported.values())
+
+    # we manage the transaction ourselves so we can use a savepoint for
+    # each package; Python's sqlite3 would commit before a SAVEPOINT
+    conn.isolation_level = None
+    curs.execute('BEGIN')
+
+    if stale_pkgkeys:
+        display.display_detail(
+            "Removing %s changed or removed packages from internal "
+            "database...", len(stale_pkgkeys))
+        stale_pkgkeys_t = [(pkgkey, ) for pkgkey in stale_pkgkeys]
+        curs.executemany(
+            'DELETE FROM pkgs_paths where pkg_key = ?', stale_pkgkeys_t)
+        curs.executemany('DELETE FROM pkgs where pkg_key = ?', stale_pkgkeys_t)
+        curs.executemany(
+            'DELETE FROM receipts where pkg_key = ?', stale_pkgkeys_t)
+        curs.execute(
+            '''DELETE FROM paths where path_key not in
+               (select distinct path_key from pkgs_paths)''')
+
+    inserter = BomInserter(curs)
+    completed = True
+    pkgcount = len(to_import)
     display.display_percent_done(0, pkgcount)
+    # worker threads run the lsbom and pkgutil subprocesses and parse their
+    # output; only this thread writes to the db
+    pool = None
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        packages = read_sources(pool, to_import, jobs * 2)
+    else:
+        packages = itertools.imap(read_source, to_import)
+    try:
+        for index, (source, fingerprint, package) in enumerate(packages):
+            if processes.stop_requested():
+                completed = False
+                break
+
+            display.display_detail("Importing %s...", source)
+            if package:
+                curs.execute('SAVEPOINT import_package')
+                try:
+                    pkgkey = write_package(package, inserter)
+                    curs.execute(
+                        'INSERT INTO receipts (pkg_key, source, fingerprint) '
+                        'values (?, ?, ?)', (pkgkey, source, fingerprint))
+                except sqlite3.DatabaseError, err:
+                    display.display_warning(
+                        "Could not import %s: %s", source, err)
+                    curs.execute('ROLLBACK TO import_package')
+                    # the inserter's path map may include rolled back paths
+                    inserter = BomInserter(curs)
+                curs.execute('RELEASE import_package')
+            display.display_percent_done(index + 1, pkgcount)
+    finally:
+        if pool:
+            # workers finish the package they're reading, then exit
+            pool.terminate()
+            pool.join()
+
+    curs.execute('COMMIT')
+    if completed:
+        # in case we didn't quite get to 100% for some reason
+        display.display_percent_done(pkgcount, pkgcount)
+    curs.close()
+    return completed
 
-    for item in receiptlist:
-        if processes.stop_requested():
-            return abort_init_database()
-
-        receiptpath = os.path.join(receiptsdir, item)
-        display.display_detail("Importing %s...", receiptpath)
-        import_package(receiptpath, curs)
-        currentpkgindex += 1
-        display.display_percent_done(currentpkgindex, pkgcount)
-
-    for item in bomslist:
-        if processes.stop_requested():
-            return abort_init_database()
-
-        bompath = os.path.join(bomsdir, item)
-        display.display_detail("Importing %s...", bompath)
-        import_bom(bompath, curs)
-        currentpkgindex += 1
-        display.display_percent_done(currentpkgindex, pkgcount)
 
-    for pkg in pkglist:
-        if processes.stop_requested():
-            return abort_init_database()
+def init_database(forcerebuild=False):
+    """
+    Builds or updates our internal package database.
+    """
+    if not should_rebuild_db(PACKAGEDB) and not forcerebuild:
+        return True
 
-        display.display_detail("Importing %s...", pkg)
-        import_from_pkgutil(pkg, curs)
-        currentpkgindex += 1
-        display.display_percent_done(currentpkgindex, pkgcount)
+    display.display_status_minor(
+        'Gathering information on installed packages')
 
-    # in case we didn't quite get to 100% for some reason
-    display.display_percent_done(pkgcount, pkgcount)
+    conn = open_database(forcerebuild=forcerebuild)
+    if not conn:
+        return False
+    try:
+        completed = update_database(conn, receipt_sources())
+    finally:
+        conn.close()
 
-    # commit and close the db when we're done.
-    conn.commit()
-    curs.close()
-    conn.close()
+    if not completed:
+        # backdate the db so we finish updating it next time
+        os.utime(PACKAGEDB, (0, 0))
+        return False
+    # the db must be newer than the receipts even if nothing changed
+    os.utime(PACKAGEDB, None)
     return True
 
 
@@ -513,39 +767,28 @@ def getpathstoremove(pkgkeylist):
     """
     Queries our database for paths to remove.
     """
-    pkgkeys = tuple(pkgkeylist)
-
     # open connection and cursor to our database
     conn = sqlite3.connect(PACKAGEDB)
     curs = conn.cursor()
 
-    # set up some subqueries:
-    # all the paths that are referred to by the selected packages:
-    if len(pkgkeys) > 1:
-        in_selected_packages = \
-          "select distinct path_key from pkgs_paths where pkg_key in %s" % \
-           str(pkgkeys)
-    else:
-        in_selected_packages = \
-          "select distinct path_key from pkgs_paths where pkg_key = %s" % \
-           str(pkgkeys[0])
-
-    # all the paths that are referred to by every package
-    # except the selected packages:
-    if len(pkgkeys) > 1:
-        not_in_other_packages = \
-        "select distinct path_key from pkgs_paths where pkg_key not in %s" % \
-         str(pkgkeys)
-    else:
-        not_in_other_packages = \
-        "select distinct path_key from pkgs_paths where pkg_key != %s" % \
-         str(pkgkeys[0])
-
-    # every path that is used by the selected packages and no other packages:
-    combined_query = \
-        "select path from paths where " + \
-        "(path_key in (%s) and path_key not in (%s))" % \
-                                (in_selected_packages, not_in_other_packages)
+    # the selected packages go in a temporary table rather than query
+    # parameters, so there is no limit on how many can be removed at once
+    curs.execute(
+        'CREATE TEMP TABLE selected (pkg_key INTEGER PRIMARY KEY)')
+    curs.executemany('INSERT OR IGNORE INTO selected (pkg_key) values (?)',
+                     [(pkgkey, ) for pkgkey in pkgkeylist])
+
+    # every path that is used by the selected packages and no other
+    # packages. Both halves are lookups on the pkgs_paths indexes, rather
+    # than building the set of every path used by every other package.
+    combined_query = (
+        'select path from paths where path_key in '
+        '(select path_key from pkgs_paths where pkg_key in '
+        '(select pkg_key from selected)) '
+        'and not exists '
+        '(select 1 from pkgs_paths where '
+        'pkgs_paths.path_key = paths.path_key and pkg_key not in '
+        '(select pkg_key from selected))')
 
     display.display_status_minor(
         'Determining which filesystem items to remove')
@@ -608,6 +851,7 @@ def remove_receipts(pkgkeylist, noupdateapplepkgdb):
             "Removing package data from internal database...")
         curs.execute('DELETE FROM pkgs_paths where pkg_key = ?', pkgkey_t)
         curs.execute('DELETE FROM pkgs where pkg_key = ?', pkgkey_t)
+        curs.execute('DELETE FROM receipts where pkg_key = ?', pkgkey_t)
 
         # then remove pkg info from Apple's database unless option is passed
         if not noupdateapplepkgdb and pkgid:
@@ -1,17 +1,25 @@
 # encoding: utf-8
 '''Defines FileRepo plugin. See docstring for FileRepo class'''
 
+import contextlib
 import errno
 import getpass
+import hashlib
 import os
 import shutil
 import subprocess
 import sys
+import threading
 import urllib
+import uuid
 
+from collections import OrderedDict
 from urlparse import urlparse
 
-from munkilib.munkirepo import Repo, RepoError
+from munkilib.munkirepo import Repo, RepoError, get_many_in_threads
+
+# number of files get_many reads at once
+GET_MANY_THREADS = 4
 
 
 # NetFS share mounting code borrowed and liberally adapted from Michael Lynn's
@@ -64,6 +72,14 @@ def unicodeize(path):
     return path
 
 
+def remove_temp_file(path):
+    '''Removes a temporary file we no longer need, if it is still there'''
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
 def mount_share(share_url):
     '''Mounts a share at /Volumes, returns the mount point or raises an error'''
     # Uses some constants defined in NetFS.h
@@ -154,6 +170,10 @@ class FileRepo(Repo):
                 u'/Volumes',
                 unicodeize(urllib.unquote(url_parts.path).lstrip('/')))
         self.we_mounted_repo = False
+        # repo_filepath -> temporary file, for the writes waiting for the
+        # current batch() to finish
+        self._pending = None
+        self._pending_lock = threading.Lock()
         self._connect()
 
     def __del__(self):
@@ -198,30 +218,72 @@ class FileRepo(Repo):
         if not os.path.exists(self.root):
             raise RepoError(u'%s does not exist' % self.root)
 
+    def _walk(self, kind):
+        '''Generates a (relative path, absolute path) tuple for each item of
+        kind, skipping files and directories whose names start with a
+        period.'''
+        kind = unicodeize(kind)
+        search_dir = os.path.join(self.root, kind)
+        for (dirpath, dirnames, filenames) in os.walk(search_dir,
+                                                      followlinks=True):
+            # don't recurse into directories that start with a period.
+            dirnames[:] = [name
+                           for name in dirnames if not name.startswith('.')]
+            for name in filenames:
+                if name.startswith('.'):
+                    # skip files that start with a period as well
+                    continue
+                abs_path = os.path.join(dirpath, name)
+                rel_path = abs_path[len(search_dir):].lstrip("/")
+                yield rel_path, abs_path
+
     def itemlist(self, kind):
         '''Returns a list of identifiers for each item of kind.
         Kind might be 'catalogs', 'manifests', 'pkgsinfo', 'pkgs', or 'icons'.
         For a file-backed repo this would be a list of pathnames.'''
-        kind = unicodeize(kind)
-        search_dir = os.path.join(self.root, kind)
-        file_list = []
         try:
-            for (dirpath, dirnames, filenames) in os.walk(search_dir,
-                                                          followlinks=True):
-                # don't recurse into directories that start with a period.
-                dirnames[:] = [name
-                               for name in dirnames if not name.startswith('.')]
-                for name in filenames:
-                    if name.startswith('.'):
-                        # skip files that start with a period as well
-                        continue
-                    abs_path = os.path.join(dirpath, name)
-                    rel_path = abs_path[len(search_dir):].lstrip("/")
-                    file_list.append(rel_path)
-            return file_list
+            return [rel_path for rel_path, dummy_abs in self._walk(kind)]
         except (OSError, IOError), err:
             raise RepoError(err)
 
+    def itemlist_with_metadata(self, kind, include_hash=False):
+        '''Returns a list of dicts, one for each item of kind, with keys:
+          identifier: the item identifier, as returned by itemlist()
+          size: size of the item in bytes
+          mtime: modification time of the item, as seconds since the epoch
+          sha256: SHA-256 hexdigest of the item (only if include_hash)
+        Sizes and modification times come from the same walk of the
+        filesystem that lists the items, and items are in the same order
+        itemlist() returns them.'''
+        items = []
+        try:
+            for rel_path, abs_path in self._walk(kind):
+                try:
+                    info = os.stat(abs_path)
+                except OSError:
+                    # a broken symlink; itemlist lists it, so we do too
+                    info = os.lstat(abs_path)
+                item = {'identifier': rel_path,
+                        'size': info.st_size,
+                        'mtime': info.st_mtime}
+                if include_hash:
+                    item['sha256'] = self._hash_file(abs_path)
+                items.append(item)
+            return items
+        except (OSError, IOError), err:
+            raise RepoError(err)
+
+    def _hash_file(self, path):
+        '''Returns the SHA-256 hexdigest of the file at path'''
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fileref:
+            while True:
+                block = fileref.read(1024 * 1024)
+                if not block:
+                    break
+                digest.update(block)
+        return digest.hexdigest()
+
     def get(self, resource_identifier):
         '''Returns the content of item with given resource_identifier.
         For a file-backed repo, a resource_identifier of
@@ -239,6 +301,14 @@ class FileRepo(Repo):
         except (OSError, IOError), err:
             raise RepoError(err)
 
+    def get_many(self, resource_identifiers, threads=None):
+        '''Generates a (resource_identifier, content) tuple for each of
+        resource_identifiers, in the same order, reading threads files at
+        once (GET_MANY_THREADS if None). If an item can't be read, content
+        is the RepoError raised.'''
+        return get_many_in_threads(
+            self, list(resource_identifiers), threads or GET_MANY_THREADS)
+
     def get_to_local_file(self, resource_identifier, local_file_path):
         '''Gets the contents of item with given resource_identifier and saves
         it to local_file_path.
@@ -258,16 +328,21 @@ class FileRepo(Repo):
         '''Stores content on the repo based on resource_identifier.
         For a file-backed repo, a resource_identifier of
         'pkgsinfo/apps/Firefox-52.0.plist' would result in the content being
-        saved to <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.'''
+        saved to <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.
+        The content is written to a temporary file that is then renamed into
+        place, so readers never see a partly-written file.'''
         resource_identifier = unicodeize(resource_identifier)
         repo_filepath = os.path.join(self.root, resource_identifier)
-        dir_path = os.path.dirname(repo_filepath)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path, 0755)
         try:
-            fileref = open(repo_filepath, 'w')
-            fileref.write(content)
-            fileref.close()
+            temp_path = self._make_temp_file(repo_filepath)
+            try:
+                fileref = open(temp_path, 'wb')
+                fileref.write(content)
+                fileref.close()
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+            self._replace(temp_path, repo_filepath)
         except (OSError, IOError), err:
             raise RepoError(err)
 
@@ -275,18 +350,23 @@ class FileRepo(Repo):
         '''Copies the content of local_file_path to the repo based on
         resource_identifier. For a file-backed repo, a resource_identifier
         of 'pkgsinfo/apps/Firefox-52.0.plist' would result in the content
-        being saved to <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.'''
+        being saved to <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.
+        Like put(), the file is copied to a temporary file that is then
+        renamed into place.'''
         resource_identifier = unicodeize(resource_identifier)
         repo_filepath = os.path.join(self.root, resource_identifier)
         local_file_path = unicodeize(local_file_path)
         if local_file_path == repo_filepath:
             # nothing to do!
             return
-        dir_path = os.path.dirname(repo_filepath)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path, 0755)
         try:
-            shutil.copyfile(local_file_path, repo_filepath)
+            temp_path = self._make_temp_file(repo_filepath)
+            try:
+                shutil.copyfile(local_file_path, temp_path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+            self._replace(temp_path, repo_filepath)
         except (OSError, IOError), err:
             raise RepoError(err)
 
@@ -294,10 +374,106 @@ class FileRepo(Repo):
         '''Deletes a repo object located by resource_identifier.
         For a file-backed repo, a resource_identifier of
         'pkgsinfo/apps/Firefox-52.0.plist' would result in the deletion of
-        <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.'''
+        <repo_root>/pkgsinfo/apps/Firefox-52.0.plist.
+        Inside a batch(), the file is still removed straight away, and any
+        write of it waiting for the batch to finish is discarded.'''
         resource_identifier = unicodeize(resource_identifier)
         repo_filepath = os.path.join(self.root, resource_identifier)
+        pending_temp_path = None
+        with self._pending_lock:
+            if self._pending is not None:
+                pending_temp_path = self._pending.pop(repo_filepath, None)
+        if pending_temp_path:
+            remove_temp_file(pending_temp_path)
         try:
             os.remove(repo_filepath)
+        except (OSError, IOError), err:
+            if not (pending_temp_path and err.errno == errno.ENOENT):
+                raise RepoError(err)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Context manager that groups writes. Files put inside it are
+        written to temporary files; when the block finishes, the temporary
+        files are flushed to disk together and then all moved into place.
+        If the block raises an exception, none of the writes are made.
+        Publishing is not atomic across files, though: if moving a file
+        into place fails, the files moved before it stay published, the
+        rest are discarded and RepoError is raised.
+        Deletes are not held back, so each one can be made and reported
+        as it happens. Batches can be nested; the outermost one publishes
+        the changes.'''
+        with self._pending_lock:
+            nested = self._pending is not None
+            if not nested:
+                self._pending = OrderedDict()
+        if nested:
+            yield
+            return
+        try:
+            yield
+        except BaseException:
+            with self._pending_lock:
+                pending, self._pending = self._pending, None
+            for temp_path in pending.values():
+                remove_temp_file(temp_path)
+            raise
+        with self._pending_lock:
+            pending, self._pending = self._pending, None
+        try:
+            self._publish(pending.items())
         except (OSError, IOError), err:
             raise RepoError(err)
+
+    def _make_temp_file(self, repo_filepath):
+        '''Creates an empty temporary file next to repo_filepath and returns
+        its path. The name starts with a period so itemlist() ignores it.'''
+        dir_path = os.path.dirname(repo_filepath)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path, 0755)
+        temp_path = os.path.join(
+            dir_path, u'.%s.%s.tmp' % (os.path.basename(repo_filepath),
+                                       uuid.uuid4().hex))
+        # same permissions open() would give a new file
+        os.close(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0666))
+        if os.path.exists(repo_filepath):
+            # keep the permissions of the file we're replacing
+            shutil.copymode(repo_filepath, temp_path)
+        return temp_path
+
+    def _replace(self, temp_path, repo_filepath):
+        '''Moves temp_path into place at repo_filepath, or, inside a
+        batch(), arranges for that to happen when the batch finishes'''
+        with self._pending_lock:
+            batched = self._pending is not None
+            if batched:
+                # a later write of the same file replaces an earlier one
+                earlier_temp_path = self._pending.pop(repo_filepath, None)
+                self._pending[repo_filepath] = temp_path
+        if not batched:
+            self._publish([(repo_filepath, temp_path)])
+        elif earlier_temp_path:
+            remove_temp_file(earlier_temp_path)
+
+    def _publish(self, pending):
+        '''Flushes the temporary files in pending, a list of
+        (repo_filepath, temp_path) tuples, to disk, then renames them into
+        place. This is not atomic across files: if a flush or rename fails,
+        the files already renamed stay published, and the temporary files
+        not yet renamed are removed.'''
+        published = 0
+        try:
+            for dummy_repo_filepath, temp_path in pending:
+                fileno = os.open(temp_path, os.O_RDONLY)
+                try:
+                    os.fsync(fileno)
+                finally:
+                    os.close(fileno)
+            for repo_filepath, temp_path in pending:
+                os.rename(temp_path, repo_filepath)
+                published += 1
+        except BaseException:
+            for dummy_repo_filepath, temp_path in pending[published:]:
+                remove_temp_file(temp_path)
+            raise
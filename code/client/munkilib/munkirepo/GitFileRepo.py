@@ -1,6 +1,7 @@
 # encoding: utf-8
 '''Subclasses FileRepo to do git commits of file changes'''
 
+import contextlib
 import inspect
 import os
 import pwd
@@ -110,6 +111,94 @@ class MunkiGit(object):
         else:
             print >> sys.stderr, "%s is not in a git repo." % a_path
 
+    def commit_changes(self, changes):
+        """Adds and removes many files with a single commit. changes is a
+        list of (operation, path) tuples, where operation is 'add' or 'rm';
+        if a path appears more than once, its last operation wins. Files
+        that are gitignored are skipped."""
+        operations = {}
+        for operation, a_path in changes:
+            operations[a_path] = operation
+        if not operations:
+            return 0
+
+        self.git_repo_dir = self.munki_repo_dir
+        self.run_git(['rev-parse', '--is-inside-work-tree'])
+        if self.results['returncode'] != 0:
+            print >> sys.stderr, (
+                "%s is not in a git repo." % self.munki_repo_dir)
+            return -1
+
+        ignored = set()
+        for chunk in self._chunks(sorted(operations)):
+            self.run_git(['check-ignore', '--'] + chunk)
+            ignored.update(self.results['output'].splitlines())
+        for operation, git_args in [
+                ('add', ['add', '--']),
+                ('rm', ['rm', '--quiet', '--ignore-unmatch', '--'])]:
+            paths = sorted(a_path for a_path in operations
+                           if operations[a_path] == operation and
+                           a_path not in ignored)
+            for chunk in self._chunks(paths):
+                self.run_git(git_args + chunk)
+                if self.results['returncode'] != 0:
+                    print >> sys.stderr, (
+                        "Git error: %s" % self.results['error'])
+                    return -1
+
+        # find out what actually changed, for the log message
+        actions = {'A': 'created', 'M': 'modified', 'D': 'deleted'}
+        changed = []
+        for chunk in self._chunks(sorted(operations)):
+            self.run_git(['status', '--porcelain', '-z', '--'] + chunk)
+            entries = iter(self.results['output'].split('\0'))
+            for entry in entries:
+                if len(entry) <= 3:
+                    continue
+                if entry[0] in ('R', 'C'):
+                    # renames and copies are followed by a field with the
+                    # original path
+                    original = next(entries, '')
+                    changed.append(('created', entry[3:]))
+                    if entry[0] == 'R' and original:
+                        changed.append(('deleted', original))
+                elif entry[0] in actions:
+                    changed.append((actions[entry[0]], entry[3:]))
+        if not changed:
+            return 0
+
+        try:
+            toolname = os.path.basename(inspect.stack()[-1][1])
+        except IndexError:
+            toolname = 'Munki command-line tools'
+        username = pwd.getpwuid(os.getuid()).pw_name
+        if len(changed) == 1:
+            log_msg = '%s %s \'%s\' via %s' % (
+                username, changed[0][0], changed[0][1], toolname)
+        else:
+            counts = []
+            for action in ['created', 'modified', 'deleted']:
+                count = len([item for item in changed if item[0] == action])
+                if count:
+                    counts.append('%s %s' % (action, count))
+            log_msg = '%s %s items via %s\n\n%s' % (
+                username, ', '.join(counts), toolname,
+                '\n'.join('%s \'%s\'' % item for item in sorted(
+                    changed, key=lambda item: item[1])))
+        print "Doing git commit: %s" % log_msg.splitlines()[0]
+        self.run_git(['commit', '-m', log_msg])
+        if self.results['returncode'] != 0:
+            print >> sys.stderr, "Failed to commit changes"
+            print >> sys.stderr, self.results['error']
+            return -1
+        return 0
+
+    def _chunks(self, paths, size=500):
+        """Splits a list of paths into lists short enough for a command
+        line"""
+        return [paths[index:index + size]
+                for index in range(0, len(paths), size)]
+
     def add_file_at_path(self, a_path):
         """Commits a file to the Git repo."""
         self._add_remove_file_at_path(a_path, 'add')
@@ -122,18 +211,60 @@ class MunkiGit(object):
 class GitFileRepo(FileRepo):
     '''A subclass of FileRepo that does git commits for pkginfo files'''
 
+    def __init__(self, baseurl):
+        '''Constructor'''
+        # git operations waiting for the current batch() to finish
+        self._pending_git = None
+        super(GitFileRepo, self).__init__(baseurl)
+
     def put(self, resource_identifier, content):
         super(GitFileRepo, self).put(resource_identifier, content)
         repo_filepath = os.path.join(self.root, resource_identifier)
-        MunkiGit(self).add_file_at_path(repo_filepath)
+        self._git('add', repo_filepath)
 
     def put_from_local_file(self, resource_identifier, local_file_path):
         super(GitFileRepo, self).put_from_local_file(
             resource_identifier, local_file_path)
         repo_filepath = os.path.join(self.root, resource_identifier)
-        MunkiGit(self).add_file_at_path(repo_filepath)
+        self._git('add', repo_filepath)
 
     def delete(self, resource_identifier):
         super(GitFileRepo, self).delete(resource_identifier)
         repo_filepath = os.path.join(self.root, resource_identifier)
-        MunkiGit(self).delete_file_at_path(repo_filepath)
+        self._git('rm', repo_filepath)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Like FileRepo.batch, but also holds back the git operations for
+        the files changed inside it until the files are in place, then
+        commits all of them together as a single commit. If the block
+        raises, the files it deleted are gone already, so those deletions
+        are still committed.'''
+        outermost = self._pending_git is None
+        if outermost:
+            self._pending_git = []
+        try:
+            with super(GitFileRepo, self).batch():
+                yield
+        except BaseException:
+            if outermost:
+                pending, self._pending_git = self._pending_git, None
+                removals = [(operation, a_path)
+                            for operation, a_path in pending
+                            if operation == 'rm']
+                if removals:
+                    MunkiGit(self).commit_changes(removals)
+            raise
+        if outermost:
+            pending, self._pending_git = self._pending_git, None
+            MunkiGit(self).commit_changes(pending)
+
+    def _git(self, operation, a_path):
+        '''Git adds or removes the file at a_path, or, inside a batch(),
+        arranges for that to happen when the batch finishes'''
+        if self._pending_git is not None:
+            self._pending_git.append((operation, a_path))
+        elif operation == 'add':
+            MunkiGit(self).add_file_at_path(a_path)
+        else:
+            MunkiGit(self).delete_file_at_path(a_path)
@@ -0,0 +1,258 @@
+# encoding: utf-8
+'''Defines MWA2APIHTTPRepo plugin. See docstring for MWA2APIHTTPRepo class'''
+
+import httplib
+import mimetypes
+import os
+import select
+import socket
+import threading
+import uuid
+import Queue
+from urlparse import urlparse, urljoin
+
+from munkilib.munkirepo import get_many_in_threads
+from munkilib.munkirepo.MWA2APIRepo import MWA2APIRepo, CurlError
+
+# maximum number of simultaneous connections to each server
+MAX_CONNECTIONS = 4
+# seconds to wait for a server to respond
+TIMEOUT = 60
+# how many redirects we'll follow, like curl's --location
+MAX_REDIRECTS = 5
+# size of blocks read from and written to local files
+BLOCKSIZE = 64 * 1024
+# requests we can safely send again if the connection fails; the server may
+# already have acted on anything else
+RETRY_METHODS = ('GET', 'HEAD')
+
+
+def connection_dropped(connection):
+    '''Returns True if the server has closed an idle connection. An idle
+    keep-alive connection has nothing to read unless it has been closed.'''
+    try:
+        readable, dummy_w, dummy_x = select.select(
+            [connection.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+class ConnectionPool(object):
+    '''A pool of keep-alive HTTP(S) connections to a single server. No more
+    than maxsize connections are open at once; callers wait for a free
+    connection when they are all in use.'''
+
+    def __init__(self, scheme, netloc, maxsize=MAX_CONNECTIONS,
+                 timeout=TIMEOUT):
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.netloc = netloc
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(maxsize)
+
+    def get(self):
+        '''Returns an idle connection the server hasn't closed, or a new
+        one. Blocks if maxsize connections are already in use.'''
+        self.slots.acquire()
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except Queue.Empty:
+                return self.connection_class(
+                    self.netloc, timeout=self.timeout)
+            if not connection_dropped(connection):
+                return connection
+            connection.close()
+
+    def release(self, connection, reusable=True):
+        '''Returns a connection to the pool, closing it if it can't be
+        used for another request'''
+        if reusable:
+            self.idle.put(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+    def close(self):
+        '''Closes all idle connections'''
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+class MWA2APIHTTPRepo(MWA2APIRepo):
+    '''Talks to the MWA2 API like MWA2APIRepo, but in-process using pooled
+    keep-alive connections instead of running curl for each request.
+    Safe to use from multiple threads.'''
+
+    def __init__(self, baseurl):
+        '''Constructor'''
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        super(MWA2APIHTTPRepo, self).__init__(baseurl)
+
+    def __del__(self):
+        '''Destructor -- close our idle connections'''
+        for pool in self.pools.values():
+            pool.close()
+
+    def get_many(self, resource_identifiers, threads=None):
+        '''Generates a (resource_identifier, content) tuple for each of
+        resource_identifiers, in the same order, making threads requests at
+        once (as many as the pool allows if None). No more than
+        MAX_CONNECTIONS are ever in flight to one server. If an item can't
+        be read, content is the RepoError raised.'''
+        return get_many_in_threads(
+            self, list(resource_identifiers),
+            min(threads or MAX_CONNECTIONS, MAX_CONNECTIONS))
+
+    def _pool_for(self, scheme, netloc):
+        '''Returns the connection pool for a server'''
+        with self.pools_lock:
+            if (scheme, netloc) not in self.pools:
+                self.pools[(scheme, netloc)] = ConnectionPool(scheme, netloc)
+            return self.pools[(scheme, netloc)]
+
+    def _curl(self, relative_url, headers=None, method='GET',
+              filename=None, content=None, formdata=None):
+        '''Makes a request to the MWA2 API. Has the same interface and
+        behavior as MWA2APIRepo._curl, so the rest of MWA2APIRepo works
+        unchanged.'''
+        url = os.path.join(self.baseurl, relative_url)
+        request_headers = {'Authorization': self.authtoken}
+        request_headers.update(headers or {})
+
+        for dummy_redirect in range(MAX_REDIRECTS + 1):
+            status, reason, location, output = self._request(
+                url, method, request_headers, filename, content, formdata)
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                if status == 303:
+                    method = 'GET'
+                continue
+            if status >= 400:
+                raise CurlError((status, '%s %s: %s' % (status, reason, url)))
+            return output
+        raise CurlError((-1, 'Too many redirects: %s' % url))
+
+    def _request(self, url, method, headers, filename, content, formdata):
+        '''Makes a single request. Returns status, reason, redirect location
+        and response body (which is saved to filename instead for GETs with
+        a filename).'''
+        url_parts = urlparse(url)
+        path = url_parts.path or '/'
+        if url_parts.query:
+            path += '?' + url_parts.query
+        pool = self._pool_for(url_parts.scheme, url_parts.netloc)
+
+        while True:
+            connection = pool.get()
+            # a connection that was idle may have been closed by the
+            # server since the pool checked it; if so, we retry requests
+            # that are safe to repeat on a new connection
+            reused = connection.sock is not None
+            try:
+                response = self._send(
+                    connection, path, method, headers, filename, content,
+                    formdata)
+                if response.status < 300 and filename and method == 'GET':
+                    output = ''
+                    with open(filename, 'wb') as fileref:
+                        while True:
+                            block = response.read(BLOCKSIZE)
+                            if not block:
+                                break
+                            fileref.write(block)
+                else:
+                    output = response.read()
+            except (httplib.BadStatusLine, socket.error, IOError,
+                    httplib.HTTPException), err:
+                pool.release(connection, reusable=False)
+                if (reused and method in RETRY_METHODS and isinstance(
+                        err, (httplib.BadStatusLine, socket.error))):
+                    continue
+                raise CurlError((-1, 'Error communicating with %s: %s'
+                                 % (url_parts.netloc, err)))
+            pool.release(connection, reusable=not response.will_close)
+            return (response.status, response.reason,
+                    response.getheader('location'), output)
+
+    def _send(self, connection, path, method, headers, filename, content,
+              formdata):
+        '''Sends a request on connection and returns the response'''
+        headers = dict(headers)
+        if formdata:
+            return self._send_form(connection, path, method, headers,
+                                   formdata)
+        if filename and method in ('PUT', 'POST'):
+            headers['Content-Length'] = str(os.path.getsize(filename))
+            connection.putrequest(method, path, skip_accept_encoding=True)
+            for key, value in headers.items():
+                connection.putheader(key, value)
+            connection.endheaders()
+            with open(filename, 'rb') as fileref:
+                while True:
+                    block = fileref.read(BLOCKSIZE)
+                    if not block:
+                        break
+                    connection.send(block)
+        else:
+            body = None
+            if content is not None and method in ('PUT', 'POST'):
+                body = content
+            connection.request(method, path, body, headers)
+        return connection.getresponse()
+
+    def _send_form(self, connection, path, method, headers, formdata):
+        '''Sends a multipart/form-data request, streaming any files. formdata
+        is a list of 'name=value' strings in curl's --form syntax, where a
+        value of '@/path' uploads the file at /path.'''
+        boundary = uuid.uuid4().hex
+        parts = []
+        length = 0
+        for line in formdata:
+            name, value = line.split('=', 1)
+            if value.startswith('@'):
+                local_path = value[1:]
+                filename = os.path.basename(local_path)
+                header = (
+                    '--%s\r\nContent-Disposition: form-data; name="%s"; '
+                    'filename="%s"\r\nContent-Type: %s\r\n\r\n'
+                    % (boundary, name, filename,
+                       mimetypes.guess_type(filename)[0] or
+                       'application/octet-stream'))
+                parts.append((header, local_path))
+                length += len(header) + os.path.getsize(local_path) + 2
+            else:
+                header = ('--%s\r\nContent-Disposition: form-data; '
+                          'name="%s"\r\n\r\n%s' % (boundary, name, value))
+                parts.append((header, None))
+                length += len(header) + 2
+        trailer = '--%s--\r\n' % boundary
+        length += len(trailer)
+
+        headers['Content-Type'] = (
+            'multipart/form-data; boundary=%s' % boundary)
+        headers['Content-Length'] = str(length)
+        connection.putrequest(method, path, skip_accept_encoding=True)
+        for key, value in headers.items():
+            connection.putheader(key, value)
+        connection.endheaders()
+        for header, local_path in parts:
+            connection.send(header)
+            if local_path:
+                with open(local_path, 'rb') as fileref:
+                    while True:
+                        block = fileref.read(BLOCKSIZE)
+                        if not block:
+                            break
+                        connection.send(block)
+            connection.send('\r\n')
+        connection.send(trailer)
+        return connection.getresponse()
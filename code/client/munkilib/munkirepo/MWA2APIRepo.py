@@ -10,12 +10,15 @@ import tempfile
 import urllib2
 from xml.parsers.expat import ExpatError
 
-from munkilib.munkirepo import Repo, RepoError
+from munkilib.munkirepo import Repo, RepoError, get_many_in_threads
 
 DEBUG = False
 
 # TODO: make this more easily configurable
 CURL_CMD = '/usr/bin/curl'
+# number of requests get_many makes at once
+GET_MANY_THREADS = 4
+
 
 class CurlError(Exception):
     pass
@@ -150,6 +153,14 @@ class MWA2APIRepo(Repo):
         except CurlError, err:
             raise RepoError(err)
 
+    def get_many(self, resource_identifiers, threads=None):
+        '''Generates a (resource_identifier, content) tuple for each of
+        resource_identifiers, in the same order, making threads requests at
+        once (GET_MANY_THREADS if None). If an item can't be read, content
+        is the RepoError raised.'''
+        return get_many_in_threads(
+            self, list(resource_identifiers), threads or GET_MANY_THREADS)
+
     def get_to_local_file(self, resource_identifier, local_file_path):
         '''Gets the contents of item with given resource_identifier and saves
         it to local_file_path.
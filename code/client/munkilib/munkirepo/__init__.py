@@ -1,6 +1,10 @@
+import contextlib
+import hashlib
 import imp
+import itertools
 import os
 import sys
+from multiprocessing.pool import ThreadPool
 
 
 class RepoError(Exception):
@@ -14,6 +18,106 @@ class Repo(object):
         '''Override in subclasses'''
         pass
 
+    def get_many(self, resource_identifiers, threads=None):
+        '''Generates a (resource_identifier, content) tuple for each of
+        resource_identifiers, in the same order. If an item can't be read,
+        content is the RepoError raised when getting it, so one bad item
+        doesn't stop the rest being read.
+        threads, if given, is how many items the caller wants read at once;
+        None leaves it to the plugin.
+        Plugins can override this to get many items more efficiently; this
+        implementation calls get() for each item in turn.'''
+        for resource_identifier in resource_identifiers:
+            yield resource_identifier, get_or_error(self, resource_identifier)
+
+    def itemlist_with_metadata(self, kind, include_hash=False):
+        '''Returns a list of dicts, one for each item of kind, with keys:
+          identifier: the item identifier, as returned by itemlist()
+          size: size of the item in bytes
+          mtime: modification time of the item, as seconds since the epoch
+          sha256: SHA-256 hexdigest of the item (only if include_hash)
+        Plugins that can get sizes and modification times cheaply should
+        override this; this implementation can't, so leaves those keys out,
+        and has to get() each item to hash it.'''
+        items = []
+        for identifier in self.itemlist(kind):
+            item = {'identifier': identifier}
+            if include_hash:
+                item['sha256'] = hashlib.sha256(
+                    self.get(os.path.join(kind, identifier))).hexdigest()
+            items.append(item)
+        return items
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Context manager that groups the writes and deletes made inside
+        it, so a plugin can publish them together when the block finishes.
+        Plugins that can do this should override it; this implementation
+        just makes each change as it happens.'''
+        yield
+
+
+def batch(repo):
+    '''Returns repo.batch(), or a context manager that does nothing for
+    plugins that don't derive from Repo'''
+    if hasattr(repo, 'batch'):
+        return repo.batch()
+    return _no_batch()
+
+
+@contextlib.contextmanager
+def _no_batch():
+    '''A batch context manager that does nothing'''
+    yield
+
+
+def get_many(repo, resource_identifiers, threads=None):
+    '''Returns repo.get_many(resource_identifiers, threads), or, for plugins
+    that don't derive from Repo, generates the same (resource_identifier,
+    content) tuples by calling get() for each item in turn'''
+    if hasattr(repo, 'get_many'):
+        if threads is None:
+            return repo.get_many(resource_identifiers)
+        return repo.get_many(resource_identifiers, threads=threads)
+    return (
+        (resource_identifier, get_or_error(repo, resource_identifier))
+        for resource_identifier in resource_identifiers)
+
+
+def get_or_error(repo, resource_identifier):
+    '''Returns the content of resource_identifier, or the RepoError raised
+    trying to get it'''
+    try:
+        return repo.get(resource_identifier)
+    except RepoError, err:
+        return err
+
+
+def get_many_in_threads(repo, resource_identifiers, threads):
+    '''Implements Repo.get_many for plugins whose get() is safe to call
+    from several threads, using a pool of that many threads. If the caller
+    stops early, reads that haven't started yet are abandoned.'''
+    if threads <= 1:
+        for resource_identifier in resource_identifiers:
+            yield resource_identifier, get_or_error(repo, resource_identifier)
+        return
+    pool = ThreadPool(threads)
+    try:
+        results = pool.imap(
+            lambda identifier: get_or_error(repo, identifier),
+            resource_identifiers, 8)
+        for resource_identifier, content in itertools.izip(
+                resource_identifiers, results):
+            yield resource_identifier, content
+    except BaseException:
+        # closed early, or the caller raised; don't wait for the rest
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
 
 def plugin_named(name):
     '''Returns a plugin object given a name'''
@@ -21,11 +21,13 @@ Created by Greg Neagle on 2016-12-14.
 Common pkg/receipt functions and classes used by the munki tools.
 """
 
+import collections
 import os
 import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import urllib2
 
 from distutils import version
@@ -103,6 +105,46 @@ class MunkiLooseVersion(version.LooseVersion):
         return cmp(self_cmp_version, other_cmp_version)
 
 
+# maximum number of parsed version keys kept by version_key()
+VERSION_KEY_CACHE_SIZE = 10000
+_VERSION_KEYS = collections.OrderedDict()
+_VERSION_KEYS_LOCK = threading.Lock()
+
+
+def _make_version_key(vstring):
+    """Parses vstring into a tuple that sorts the same way MunkiLooseVersion
+    objects compare."""
+    components = list(MunkiLooseVersion(vstring).version)
+    # MunkiLooseVersion pads with zeros when comparing, so "10.6" and
+    # "10.6.0" are equal; dropping trailing zeros gives them the same key
+    while components and components[-1] == 0:
+        components.pop()
+    # tag each component so numbers sort before strings, just as they do
+    # when Python 2 compares the version lists
+    return tuple((0, component) if isinstance(component, (int, long))
+                 else (1, component) for component in components)
+
+
+def version_key(vstring):
+    """Returns a hashable, totally ordered key for a version string.
+
+    version_key(a) < version_key(b) if and only if
+    MunkiLooseVersion(a) < MunkiLooseVersion(b), and likewise for == and >,
+    but keys are parsed only once per string and compare as plain tuples,
+    so they are much cheaper on hot paths and can be used with sort(key=).
+    Recently used keys are kept in a bounded LRU cache."""
+    with _VERSION_KEYS_LOCK:
+        try:
+            key = _VERSION_KEYS.pop(vstring)
+        except KeyError:
+            key = _make_version_key(vstring)
+            if len(_VERSION_KEYS) >= VERSION_KEY_CACHE_SIZE:
+                # discard the least recently used key
+                _VERSION_KEYS.popitem(last=False)
+        _VERSION_KEYS[vstring] = key
+    return key
+
+
 def padVersionString(versString, tupleCount):
     """Normalize the format of a version string"""
     if versString is None:
@@ -834,8 +876,8 @@ def getInstalledPackages():
                         # installed, since presumably
                         # the newer package replaced the older one
                         storedversion = installedpkgs[pkgid]
-                        if (MunkiLooseVersion(thisversion) >
-                                MunkiLooseVersion(storedversion)):
+                        if (version_key(thisversion) >
+                                version_key(storedversion)):
                             installedpkgs[pkgid] = thisversion
     return installedpkgs
 
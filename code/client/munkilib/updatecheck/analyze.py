@@ -32,18 +32,88 @@ from . import unused_software
 
 from .. import display
 from .. import fetch
-from .. import info
 from .. import munkilog
 from .. import prefs
 from .. import processes
 
 
+class NameList(list):
+    """A list of manifest item names, like installinfo['processed_installs'],
+    that also keeps a set of its members and of their names without version
+    numbers so membership tests don't have to scan the list. It is still a
+    list, so it is written to InstallInfo.plist the same way."""
+
+    def __init__(self, iterable=()):
+        list.__init__(self)
+        self._members = set()
+        self._names = set()
+        self.extend(iterable)
+
+    def append(self, item):
+        list.append(self, item)
+        self._members.add(item)
+        self._names.add(catalogs.split_name_and_version(item)[0])
+
+    def extend(self, iterable):
+        for item in iterable:
+            self.append(item)
+
+    def __contains__(self, item):
+        return item in self._members
+
+    def contains_name(self, name):
+        """Returns True if some version of name is in the list"""
+        return name in self._names
+
+
+class ItemInfoList(list):
+    """A list of iteminfo dicts, like installinfo['managed_installs'], that
+    also indexes its entries by name for item_in_installinfo()."""
+
+    def __init__(self, iterable=()):
+        list.__init__(self)
+        self._by_name = {}
+        self.extend(iterable)
+
+    def append(self, item):
+        list.append(self, item)
+        name = item.get('name')
+        if not name in self._by_name:
+            self._by_name[name] = []
+        self._by_name[name].append(item)
+
+    def extend(self, iterable):
+        for item in iterable:
+            self.append(item)
+
+    def items_named(self, name):
+        """Returns the entries with the given name"""
+        return self._by_name.get(name, [])
+
+
+def new_installinfo():
+    """Returns an empty installinfo dict for an update check, using indexed
+    lists for the sections we look things up in"""
+    return {
+        'processed_installs': NameList(),
+        'processed_uninstalls': NameList(),
+        'managed_updates': NameList(),
+        'optional_installs': ItemInfoList(),
+        'featured_items': [],
+        'managed_installs': ItemInfoList(),
+        'removals': ItemInfoList(),
+    }
+
+
 def item_in_installinfo(item_pl, thelist, vers=''):
     """Determines if an item is in a list of processed items.
 
     Returns True if the item has already been processed (it's in the list)
     and, optionally, the version is the same or greater.
     """
+    if isinstance(thelist, ItemInfoList):
+        # only look at the entries with a matching name
+        thelist = thelist.items_named(item_pl.get('name'))
     for listitem in thelist:
         try:
             if listitem['name'] == item_pl['name']:
@@ -150,12 +220,11 @@ def process_optional_install(manifestitem, cataloglist, installinfo):
 
     # check to see if item (any version) is already in the
     # optional_install list:
-    for item in installinfo['optional_installs']:
-        if manifestitemname == item['name']:
-            display.display_debug1(
-                '%s has already been processed for optional install.',
-                manifestitemname)
-            return
+    if installinfo['optional_installs'].items_named(manifestitemname):
+        display.display_debug1(
+            '%s has already been processed for optional install.',
+            manifestitemname)
+        return
 
     item_pl = catalogs.get_item_detail(manifestitem, cataloglist,
                                        suppress_warnings=True)
@@ -622,65 +691,46 @@ def process_manifest_for_key(manifest, manifest_key, installinfo,
     """Processes keys in manifests to build the lists of items to install and
     remove.
 
-    Can be recursive if manifests include other manifests.
-    Probably doesn't handle circular manifest references well.
+    The manifest and everything it includes is resolved once per run by
+    manifestutils.resolve_manifest(); this walks that tree, so processing
+    each manifest key doesn't re-read manifests or re-evaluate the
+    conditional_items predicates.
 
     manifest can be a path to a manifest file or a dictionary object.
     """
-    if isinstance(manifest, basestring):
+    resolved = manifestutils.resolve_manifest(manifest, parentcatalogs)
+    process_resolved_manifest_for_key(resolved, manifest_key, installinfo)
+
+
+def process_resolved_manifest_for_key(resolved, manifest_key, installinfo):
+    """Processes manifest_key in a manifest returned by
+    manifestutils.resolve_manifest() and, recursively, in the manifests it
+    includes."""
+    manifest = resolved['name']
+    if manifest != manifestutils.EMBEDDED_MANIFEST:
         display.display_debug1(
             "** Processing manifest %s for %s" %
             (os.path.basename(manifest), manifest_key))
-        manifestdata = manifestutils.get_manifest_data(manifest)
-    else:
-        manifestdata = manifest
-        manifest = 'embedded manifest'
-
-    cataloglist = manifestdata.get('catalogs')
-    if cataloglist:
-        catalogs.get_catalogs(cataloglist)
-    elif parentcatalogs:
-        cataloglist = parentcatalogs
 
+    cataloglist = resolved['catalogs']
     if not cataloglist:
         display.display_warning('Manifest %s has no catalogs', manifest)
         return
 
-    for item in manifestdata.get('included_manifests', []):
-        if item: # only process if item is not empty
-            nestedmanifestpath = manifestutils.get_manifest(item)
-            if not nestedmanifestpath:
-                raise manifestutils.ManifestException
-            if processes.stop_requested():
-                return {}
-            process_manifest_for_key(nestedmanifestpath, manifest_key,
-                                     installinfo, cataloglist)
-
-    conditionalitems = manifestdata.get('conditional_items', [])
-    if conditionalitems:
+    for nested in resolved['included']:
+        if processes.stop_requested():
+            return {}
+        process_resolved_manifest_for_key(nested, manifest_key, installinfo)
+
+    if resolved['data'].get('conditional_items'):
         display.display_debug1(
             '** Processing conditional_items in %s', manifest)
-    # conditionalitems should be an array of dicts
-    # each dict has a predicate; the rest consists of the
-    # same keys as a manifest
-    for item in conditionalitems:
-        try:
-            predicate = item['condition']
-        except (AttributeError, KeyError):
-            display.display_warning(
-                'Missing predicate for conditional_item %s', item)
-            continue
-        except BaseException:
-            display.display_warning(
-                'Conditional item is malformed: %s', item)
-            continue
-        if info.predicate_evaluates_as_true(
-                predicate, additional_info={'catalogs': cataloglist}):
-            conditionalmanifest = item
-            process_manifest_for_key(
-                conditionalmanifest, manifest_key, installinfo, cataloglist)
+    # only conditional_items whose conditions are true are included here
+    for conditionalmanifest in resolved['conditional']:
+        process_resolved_manifest_for_key(
+            conditionalmanifest, manifest_key, installinfo)
 
-    for item in manifestdata.get(manifest_key, []):
+    for item in resolved['data'].get(manifest_key, []):
         if processes.stop_requested():
             return {}
         if manifest_key == 'managed_installs':
@@ -730,8 +780,7 @@ def process_removal(manifestitem, cataloglist, installinfo):
         manifestitemname_withversion)
 
     # have we processed this already?
-    if manifestitemname in [catalogs.split_name_and_version(item)[0]
-                            for item in installinfo['processed_installs']]:
+    if installinfo['processed_installs'].contains_name(manifestitemname):
         display.display_warning(
             'Will not attempt to remove %s because some version of it is in '
             'the list of managed installs, or it is required by another'
@@ -27,6 +27,7 @@ from . import download
 
 from .. import display
 from .. import info
+from .. import munkihash
 from .. import pkgutils
 from .. import prefs
 from .. import utils
@@ -69,6 +70,10 @@ def make_catalog_db(catalogitems):
                     pkgid_table[pkg_id][version] = []
                 pkgid_table[pkg_id][version].append(itemindex)
 
+    # build lists of the versions available for each name, sorted highest
+    # version first, so finding the latest version doesn't need a sort
+    version_table = make_version_index(name_table)
+
     # build table of update items with a list comprehension --
     # filter all items from the catalogitems that have a non-empty
     # 'update_for' list
@@ -81,6 +86,9 @@ def make_catalog_db(catalogitems):
             # convert to list of strings
             update['update_for'] = [update['update_for']]
 
+    # build a reverse index of updaters keyed on the items they update
+    update_for_table = make_update_for_index(updaters)
+
     # build table of autoremove items with a list comprehension --
     # filter all items from the catalogitems that have a non-empty
     # 'autoremove' list
@@ -95,13 +103,49 @@ def make_catalog_db(catalogitems):
     pkgdb = {}
     pkgdb['named'] = name_table
     pkgdb['receipts'] = pkgid_table
+    pkgdb['versions'] = version_table
     pkgdb['updaters'] = updaters
+    pkgdb['update_for'] = update_for_table
     pkgdb['autoremoveitems'] = autoremoveitems
     pkgdb['items'] = catalogitems
 
     return pkgdb
 
 
+def make_version_index(name_table):
+    """Takes the name table from a catalog DB and returns a dict mapping
+    each name to a list of its versions, sorted highest version first."""
+    version_table = {}
+    for name in name_table:
+        version_table[name] = sorted(
+            name_table[name].keys(), key=pkgutils.version_key,
+            reverse=True)
+    return version_table
+
+
+def make_update_for_index(updaters):
+    """Takes a list of updater items and builds a reverse index mapping the
+    names they are an update for to the names of the updaters.
+
+    Keys are (name, version) tuples as returned by split_name_and_version, so
+    'Foo', 'Foo-1.0' and 'Foo--1.0' map to ('Foo', ''), ('Foo', '1.0') and
+    ('Foo', '1.0') respectively."""
+    update_for_table = {}
+    for update in updaters:
+        updater_name = update.get('name')
+        if not updater_name:
+            continue
+        for update_for in update['update_for']:
+            if not isinstance(update_for, basestring):
+                continue
+            key = split_name_and_version(update_for)
+            if not key in update_for_table:
+                update_for_table[key] = []
+            if not updater_name in update_for_table[key]:
+                update_for_table[key].append(updater_name)
+    return update_for_table
+
+
 def add_package_ids(catalogitems, itemname_to_pkgid, pkgid_to_itemname):
     """Adds packageids from each catalogitem to two dictionaries.
     One maps itemnames to receipt pkgids, the other maps receipt pkgids
@@ -145,7 +189,7 @@ def split_name_and_version(some_string):
             chunks = some_string.split(delim)
             vers = chunks.pop()
             name = delim.join(chunks)
-            if vers[0] in '0123456789':
+            if vers and vers[0] in '0123456789':
                 return (name, vers)
 
     return (some_string, '')
@@ -158,10 +202,9 @@ def get_all_items_with_name(name, cataloglist):
       list of pkginfo items; sorted with newest version first. No precedence
       is given to catalog order.
     """
-    def compare_item_versions(item_a, item_b):
-        """Internal comparison function for use with sorting"""
-        return cmp(pkgutils.MunkiLooseVersion(item_b['version']),
-                   pkgutils.MunkiLooseVersion(item_a['version']))
+    def item_version(item):
+        """Internal key function for use with sorting"""
+        return pkgutils.version_key(item['version'])
 
     itemlist = []
     # we'll throw away any included version info
@@ -189,7 +232,7 @@ def get_all_items_with_name(name, cataloglist):
 
     if itemlist:
         # sort so latest version is first
-        itemlist.sort(compare_item_versions)
+        itemlist.sort(key=item_version, reverse=True)
     return itemlist
 
 
@@ -205,11 +248,13 @@ def get_auto_removal_items(installinfo, cataloglist):
         if catalogname in _CATALOG.keys():
             autoremovalnames += _CATALOG[catalogname]['autoremoveitems']
 
-    processed_installs_names = [split_name_and_version(item)[0]
-                                for item in installinfo['processed_installs']]
+    processed_installs_names = set(
+        split_name_and_version(item)[0]
+        for item in installinfo['processed_installs'])
+    processed_uninstalls = set(installinfo['processed_uninstalls'])
     autoremovalnames = [item for item in autoremovalnames
                         if item not in processed_installs_names
-                        and item not in installinfo['processed_uninstalls']]
+                        and item not in processed_uninstalls]
     return autoremovalnames
 
 
@@ -227,16 +272,13 @@ def look_for_updates(itemname, cataloglist):
     display.display_debug1('Looking for updates for: %s', itemname)
     # get a list of catalog items that are updates for other items
     update_list = []
+    key = split_name_and_version(itemname)
     for catalogname in cataloglist:
         if catalogname not in _CATALOG:
             # in case the list refers to a non-existent catalog
             continue
 
-        updaters = _CATALOG[catalogname]['updaters']
-        # list comprehension coming up...
-        update_items = [catalogitem['name']
-                        for catalogitem in updaters
-                        if itemname in catalogitem.get('update_for', [])]
+        update_items = _CATALOG[catalogname]['update_for'].get(key)
         if update_items:
             update_list.extend(update_items)
 
@@ -255,14 +297,18 @@ def look_for_updates(itemname, cataloglist):
 
 
 def look_for_updates_for_version(itemname, itemversion, cataloglist):
-    """Looks for updates for a specific version of an item. Since these
-    can appear in manifests and pkginfo as item-version or item--version
-    we have to search twice."""
+    """Looks for updates for a specific version of an item. These can
+    appear in manifests and pkginfo as item-version or item--version; the
+    update_for index normalizes both spellings to the same key, so we only
+    have to search twice if the version can't be split back out (for
+    example, if it doesn't start with a digit)."""
 
     name_and_version = '%s-%s' % (itemname, itemversion)
     alt_name_and_version = '%s--%s' % (itemname, itemversion)
     update_list = look_for_updates(name_and_version, cataloglist)
-    update_list.extend(look_for_updates(alt_name_and_version, cataloglist))
+    if (split_name_and_version(alt_name_and_version) !=
+            split_name_and_version(name_and_version)):
+        update_list.extend(look_for_updates(alt_name_and_version, cataloglist))
 
     # make sure the list has only unique items:
     update_list = list(set(update_list))
@@ -425,11 +471,6 @@ def get_item_detail(name, cataloglist, vers='',
     If no version is given at all, the latest version is assumed.
     Returns a pkginfo item, or None.
     """
-    def compare_versions(item_a, item_b):
-        """Internal comparison function for use in sorting"""
-        return cmp(pkgutils.MunkiLooseVersion(item_b),
-                   pkgutils.MunkiLooseVersion(item_a))
-
     rejected_items = []
     machine = info.getMachineFacts()
     # condition check functions
@@ -445,8 +486,8 @@ def get_item_detail(name, cataloglist, vers='',
                 item['name'], item['version'], min_munki_vers)
             display.display_debug1(
                 'Our Munki version is %s', machine['munki_version'])
-            if (pkgutils.MunkiLooseVersion(machine['munki_version'])
-                    < pkgutils.MunkiLooseVersion(min_munki_vers)):
+            if (pkgutils.version_key(machine['munki_version'])
+                    < pkgutils.version_key(min_munki_vers)):
                 reason = (
                     'Rejected item %s, version %s with minimum Munki version '
                     'required %s. Our Munki version is %s.'
@@ -470,8 +511,8 @@ def get_item_detail(name, cataloglist, vers='',
                 item['name'], item['version'], min_os_vers)
             display.display_debug1(
                 'Our OS version is %s', machine['os_vers'])
-            if (pkgutils.MunkiLooseVersion(machine['os_vers']) <
-                    pkgutils.MunkiLooseVersion(min_os_vers)):
+            if (pkgutils.version_key(machine['os_vers']) <
+                    pkgutils.version_key(min_os_vers)):
                 # skip this one, go to the next
                 reason = (
                     'Rejected item %s, version %s with minimum os version '
@@ -490,8 +531,8 @@ def get_item_detail(name, cataloglist, vers='',
                 item['name'], item['version'], max_os_vers)
             display.display_debug1(
                 'Our OS version is %s', machine['os_vers'])
-            if (pkgutils.MunkiLooseVersion(machine['os_vers']) >
-                    pkgutils.MunkiLooseVersion(max_os_vers)):
+            if (pkgutils.version_key(machine['os_vers']) >
+                    pkgutils.version_key(max_os_vers)):
                 # skip this one, go to the next
                 reason = (
                     'Rejected item %s, version %s with maximum os version '
@@ -572,9 +613,8 @@ def get_item_detail(name, cataloglist, vers='',
             itemsmatchingname = _CATALOG[catalogname]['named'][name]
             indexlist = []
             if vers == 'latest':
-                # order all our items, highest version first
-                versionlist = itemsmatchingname.keys()
-                versionlist.sort(compare_versions)
+                # versions are already sorted, highest version first
+                versionlist = _CATALOG[catalogname]['versions'][name]
                 for versionkey in versionlist:
                     indexlist.extend(itemsmatchingname[versionkey])
             elif vers in itemsmatchingname.keys():
@@ -590,11 +630,25 @@ def get_item_detail(name, cataloglist, vers='',
                 # version first, looking for first one that passes all the
                 # conditional tests (if any)
                 item = _CATALOG[catalogname]['items'][index]
-                if (munki_version_ok(item) and
+                eligibility_key = (catalogname, index, skip_min_os_check)
+                if eligibility_key in _ITEM_ELIGIBILITY:
+                    # we've checked this item before during this run
+                    reason = _ITEM_ELIGIBILITY[eligibility_key]
+                    if reason:
+                        rejected_items.append(reason)
+                    eligible = not reason
+                else:
+                    eligible = (
+                        munki_version_ok(item) and
                         os_version_ok(item,
                                       skip_min_os_check=skip_min_os_check) and
                         cpu_arch_ok(item) and
-                        installable_condition_ok(item)):
+                        installable_condition_ok(item))
+                    # record the reason for rejection (if any) so we don't
+                    # have to repeat the checks
+                    _ITEM_ELIGIBILITY[eligibility_key] = (
+                        None if eligible else rejected_items[-1])
+                if eligible:
                     display.display_debug1(
                         'Found %s, version %s in catalog %s',
                         item['name'], item['version'], catalogname)
@@ -610,8 +664,110 @@ def get_item_detail(name, cataloglist, vers='',
     return None
 
 
+# bump this if the layout of the catalog DB changes so that stale
+# caches written by older versions of Munki are ignored
+CATALOG_CACHE_FORMAT = 2
+
+
+def catalog_cache_dir():
+    '''Returns the path to the directory holding our compiled catalog DBs'''
+    return os.path.join(prefs.pref('ManagedInstallDir'), 'catalog_cache')
+
+
+def write_catalog_cache(catalogname, catalog_hash, pkgdb):
+    """Saves a compiled catalog DB as a binary plist so the next run can skip
+    parsing the catalog and building the indexes if the catalog file has not
+    changed. catalog_hash is the SHA-256 hash of the catalog file the DB was
+    built from."""
+    cache_dir = catalog_cache_dir()
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir, 0755)
+        except OSError, err:
+            display.display_debug1(
+                'Could not create %s: %s', cache_dir, err)
+            return
+    # updaters are stored as indexes into the items array so we don't store
+    # a second copy of each updater item
+    updater_indexes = [index for (index, item) in enumerate(pkgdb['items'])
+                       if item.get('update_for')]
+    cachedata = {
+        'format': CATALOG_CACHE_FORMAT,
+        'catalog_hash': catalog_hash,
+        'named': pkgdb['named'],
+        'receipts': pkgdb['receipts'],
+        'versions': pkgdb['versions'],
+        'updaters': updater_indexes,
+        'autoremoveitems': pkgdb['autoremoveitems'],
+        'items': pkgdb['items'],
+    }
+    cachepath = os.path.join(cache_dir, catalogname)
+    try:
+        FoundationPlist.writeBinaryPlist(cachedata, cachepath)
+    except FoundationPlist.FoundationPlistException, err:
+        display.display_debug1(
+            'Could not write catalog cache for %s: %s', catalogname, err)
+        try:
+            os.unlink(cachepath)
+        except (OSError, IOError):
+            pass
+
+
+def read_catalog_cache(catalogname, catalog_hash):
+    """Returns the compiled catalog DB for catalogname if we have one that
+    was built from a catalog file with the same hash. Returns None if there
+    is no usable cached DB."""
+    cachepath = os.path.join(catalog_cache_dir(), catalogname)
+    if not os.path.exists(cachepath):
+        return None
+    try:
+        cachedata = FoundationPlist.readPlist(cachepath)
+    except FoundationPlist.FoundationPlistException:
+        display.display_debug1(
+            'Cached catalog DB for %s is invalid.', catalogname)
+        return None
+    if (cachedata.get('format') != CATALOG_CACHE_FORMAT or
+            cachedata.get('catalog_hash') != catalog_hash):
+        display.display_debug1(
+            'Cached catalog DB for %s is out of date.', catalogname)
+        return None
+
+    def native_index(table):
+        """Converts a two-level index table back to Python dicts"""
+        return dict((key, dict((subkey, list(table[key][subkey]))
+                               for subkey in table[key]))
+                    for key in table)
+
+    catalogitems = cachedata['items']
+    pkgdb = {}
+    pkgdb['named'] = native_index(cachedata['named'])
+    pkgdb['receipts'] = native_index(cachedata['receipts'])
+    pkgdb['versions'] = dict((name, list(cachedata['versions'][name]))
+                             for name in cachedata['versions'])
+    pkgdb['updaters'] = [catalogitems[index]
+                         for index in cachedata['updaters']]
+    pkgdb['update_for'] = make_update_for_index(pkgdb['updaters'])
+    pkgdb['autoremoveitems'] = list(cachedata['autoremoveitems'])
+    pkgdb['items'] = catalogitems
+    display.display_debug1('Using cached catalog DB for %s', catalogname)
+    return pkgdb
+
+
 # global to hold our catalog DBs
 _CATALOG = {}
+# global to hold the results of get_item_detail's condition checks for
+# catalog items, keyed on (catalogname, index, skip_min_os_check). The
+# machine facts the checks use don't change during a run.
+_ITEM_ELIGIBILITY = {}
+
+
+def reset_item_eligibility():
+    """Forgets the results of get_item_detail's condition checks. Called at
+    the start of each check and whenever a catalog is loaded, since the
+    results are keyed on item indexes in the catalog DBs."""
+    _ITEM_ELIGIBILITY.clear()
+
+
 def get_catalogs(cataloglist):
     """Retrieves the catalogs from the server and populates our catalogs
     dictionary.
@@ -621,26 +777,49 @@ def get_catalogs(cataloglist):
         if not catalogname in _CATALOG:
             catalogpath = download.download_catalog(catalogname)
             if catalogpath:
-                try:
-                    catalogdata = FoundationPlist.readPlist(catalogpath)
-                except FoundationPlist.NSPropertyListSerializationException:
-                    display.display_error(
-                        'Retreived catalog %s is invalid.', catalogname)
-                    try:
-                        os.unlink(catalogpath)
-                    except (OSError, IOError):
-                        pass
-                else:
-                    _CATALOG[catalogname] = make_catalog_db(catalogdata)
+                load_catalog(catalogname, catalogpath)
+
+
+def load_catalog(catalogname, catalogpath):
+    """Adds the catalog downloaded to catalogpath to our catalogs
+    dictionary, using the cached catalog DB if the catalog is unchanged."""
+    reset_item_eligibility()
+    catalog_hash = munkihash.getsha256hash(catalogpath)
+    pkgdb = read_catalog_cache(catalogname, catalog_hash)
+    if pkgdb is not None:
+        _CATALOG[catalogname] = pkgdb
+        return
+    try:
+        catalogdata = FoundationPlist.readPlist(catalogpath)
+    except FoundationPlist.NSPropertyListSerializationException:
+        display.display_error(
+            'Retreived catalog %s is invalid.', catalogname)
+        try:
+            os.unlink(catalogpath)
+        except (OSError, IOError):
+            pass
+    else:
+        _CATALOG[catalogname] = make_catalog_db(catalogdata)
+        write_catalog_cache(
+            catalogname, catalog_hash, _CATALOG[catalogname])
 
 
 def clean_up():
-    """Removes any catalog files that are no longer in use by this client"""
+    """Removes any catalog files and cached catalog DBs that are no longer in
+    use by this client"""
     catalog_dir = os.path.join(prefs.pref('ManagedInstallDir'),
                                'catalogs')
     for item in os.listdir(catalog_dir):
         if item not in _CATALOG:
             os.unlink(os.path.join(catalog_dir, item))
+    cache_dir = catalog_cache_dir()
+    if os.path.isdir(cache_dir):
+        for item in os.listdir(cache_dir):
+            if item not in _CATALOG:
+                try:
+                    os.unlink(os.path.join(cache_dir, item))
+                except (OSError, IOError):
+                    pass
 
 
 def catalogs():
@@ -46,11 +46,11 @@ def compare_versions(thisvers, thatvers):
       1 if thisvers is the same as thatvers
       2 if thisvers is newer than thatvers
     """
-    if (pkgutils.MunkiLooseVersion(thisvers) <
-            pkgutils.MunkiLooseVersion(thatvers)):
+    thiskey = pkgutils.version_key(thisvers)
+    thatkey = pkgutils.version_key(thatvers)
+    if thiskey < thatkey:
         return VERSION_IS_LOWER
-    elif (pkgutils.MunkiLooseVersion(thisvers) ==
-          pkgutils.MunkiLooseVersion(thatvers)):
+    elif thiskey == thatkey:
         return VERSION_IS_THE_SAME
     else:
         return VERSION_IS_HIGHER
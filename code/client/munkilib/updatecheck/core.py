@@ -59,6 +59,11 @@ def check(client_id='', localmanifestpath=None):
 
     reports.report['MachineInfo'] = info.getMachineFacts()
 
+    # results cached during an earlier check in this process may be stale
+    info.reset_predicate_results()
+    catalogs.reset_item_eligibility()
+    manifestutils.reset_resolved_manifests()
+
     # initialize our Munki keychain if we are using custom certs or CAs
     dummy_keychain_obj = keychain.MunkiKeychain()
 
@@ -94,17 +99,17 @@ def check(client_id='', localmanifestpath=None):
                 'Munki is checking for new software')
 
         # initialize our installinfo record
-        installinfo['processed_installs'] = []
-        installinfo['processed_uninstalls'] = []
-        installinfo['managed_updates'] = []
-        installinfo['optional_installs'] = []
-        installinfo['featured_items'] = []
-        installinfo['managed_installs'] = []
-        installinfo['removals'] = []
+        installinfo = analyze.new_installinfo()
 
         # record info object for conditional item comparisons
         reports.report['Conditions'] = info.predicate_info_object()
 
+        # download included manifests and catalogs concurrently before
+        # we start processing them
+        manifestutils.prefetch_manifests(mainmanifestpath)
+        if processes.stop_requested():
+            return 0
+
         display.display_detail('**Checking for installs**')
         analyze.process_manifest_for_key(
             mainmanifestpath, 'managed_installs', installinfo)
@@ -301,6 +306,11 @@ def check(client_id='', localmanifestpath=None):
                           item, installinfo['removals'])):
                     item['will_be_removed'] = True
 
+        # we're done looking things up; convert our indexed lists back to
+        # plain lists for reporting and for InstallInfo.plist
+        for key in installinfo:
+            installinfo[key] = list(installinfo[key])
+
         # filter managed_installs to get items already installed
         installed_items = [item.get('name', '')
                            for item in installinfo['managed_installs']
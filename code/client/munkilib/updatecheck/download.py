@@ -323,17 +323,24 @@ def download_client_resources():
                     'Could not remove stale %s: %s', resource_archive_path, err)
 
 
-def download_catalog(catalogname):
-    '''Attempt to download a catalog from the Munki server, Returns the path to
-    the downlaoded catalog file'''
+def catalog_location(catalogname):
+    '''Returns the URL of a catalog on the Munki server and the local path
+    it is downloaded to'''
     catalogbaseurl = (prefs.pref('CatalogURL') or
                       prefs.pref('SoftwareRepoURL') + '/catalogs/')
     if not catalogbaseurl.endswith('?') and not catalogbaseurl.endswith('/'):
         catalogbaseurl = catalogbaseurl + '/'
-    display.display_debug2('Catalog base URL is: %s', catalogbaseurl)
     catalog_dir = os.path.join(prefs.pref('ManagedInstallDir'), 'catalogs')
     catalogurl = catalogbaseurl + urllib2.quote(catalogname.encode('UTF-8'))
     catalogpath = os.path.join(catalog_dir, catalogname)
+    return catalogurl, catalogpath
+
+
+def download_catalog(catalogname):
+    '''Attempt to download a catalog from the Munki server, Returns the path to
+    the downlaoded catalog file'''
+    catalogurl, catalogpath = catalog_location(catalogname)
+    display.display_debug2('Catalog URL is: %s', catalogurl)
     display.display_detail('Getting catalog %s...', catalogname)
     message = 'Retrieving catalog "%s"...' % catalogname
     try:
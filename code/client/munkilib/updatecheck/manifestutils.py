@@ -24,17 +24,27 @@ Functions for working with manifest files
 
 import os
 import urllib2
+from multiprocessing.pool import ThreadPool
+
+from . import catalogs
+from . import download
 
 from .. import display
 from .. import fetch
 from .. import info
 from .. import keychain
 from .. import prefs
+from .. import processes
 from .. import reports
 from .. import FoundationPlist
 
 
 PRIMARY_MANIFEST_TAG = '_primary_manifest_'
+# name used in messages for manifests embedded in conditional_items
+EMBEDDED_MANIFEST = 'embedded manifest'
+
+# number of manifests and catalogs to download at once when prefetching
+PREFETCH_WORKERS = 4
 
 
 class ManifestException(Exception):
@@ -67,6 +77,22 @@ def set_manifest(name, path):
     _MANIFESTS[name] = path
 
 
+def manifest_location(manifest_name):
+    """Returns the URL of a manifest on the Munki server and the local path
+    it is downloaded to"""
+    manifestbaseurl = (prefs.pref('ManifestURL') or
+                       prefs.pref('SoftwareRepoURL') + '/manifests/')
+    if (not manifestbaseurl.endswith('?') and
+            not manifestbaseurl.endswith('/')):
+        manifestbaseurl = manifestbaseurl + '/'
+    manifest_dir = os.path.join(prefs.pref('ManagedInstallDir'),
+                                'manifests')
+    manifesturl = (
+        manifestbaseurl + urllib2.quote(manifest_name.encode('UTF-8')))
+    manifestpath = os.path.join(manifest_dir, manifest_name.lstrip('/'))
+    return manifesturl, manifestpath
+
+
 def get_manifest(manifest_name, suppress_errors=False):
     """Gets a manifest from the server.
 
@@ -79,20 +105,9 @@ def get_manifest(manifest_name, suppress_errors=False):
     if manifest_name in _MANIFESTS:
         return _MANIFESTS[manifest_name]
 
-    manifestbaseurl = (prefs.pref('ManifestURL') or
-                       prefs.pref('SoftwareRepoURL') + '/manifests/')
-    if (not manifestbaseurl.endswith('?') and
-            not manifestbaseurl.endswith('/')):
-        manifestbaseurl = manifestbaseurl + '/'
-    manifest_dir = os.path.join(prefs.pref('ManagedInstallDir'),
-                                'manifests')
-
-    manifesturl = (
-        manifestbaseurl + urllib2.quote(manifest_name.encode('UTF-8')))
-
-    display.display_debug2('Manifest base URL is: %s', manifestbaseurl)
+    manifesturl, manifestpath = manifest_location(manifest_name)
+    display.display_debug2('Manifest URL is: %s', manifesturl)
     display.display_detail('Getting manifest %s...', manifest_name)
-    manifestpath = os.path.join(manifest_dir, manifest_name.lstrip('/'))
 
     # Create the folder the manifest shall be stored in
     destinationdir = os.path.dirname(manifestpath)
@@ -236,6 +251,228 @@ def clean_up_manifests():
                 pass
 
 
+def manifest_references(manifestdata, parentcatalogs=None):
+    """Returns the catalogs and included manifests a manifest refers to.
+
+    Included manifests listed in conditional_items are returned only if the
+    condition is true. Returns a tuple of (list of catalog names, list of
+    (included manifest name, catalogs it inherits) tuples)."""
+    cataloglist = manifestdata.get('catalogs') or parentcatalogs
+    if not cataloglist:
+        # a manifest without catalogs isn't processed
+        return ([], [])
+    catalognames = list(cataloglist)
+    included = [(item, cataloglist)
+                for item in manifestdata.get('included_manifests', [])
+                if item]
+    for item in manifestdata.get('conditional_items', []):
+        try:
+            predicate = item['condition']
+        except BaseException:
+            # reported when the manifest is processed
+            continue
+        if info.predicate_evaluates_as_true(
+                predicate, additional_info={'catalogs': cataloglist}):
+            (more_catalogs, more_included) = manifest_references(
+                item, cataloglist)
+            catalognames.extend(more_catalogs)
+            included.extend(more_included)
+    return (catalognames, included)
+
+
+def _prefetch_download(location):
+    """Worker function for prefetch_manifests. Downloads a (url, local path)
+    tuple from manifest_location() or download.catalog_location(). Returns
+    None if it was downloaded, or the error if not. Runs in a worker
+    thread, so it doesn't touch our globals or show any status; fetch only
+    logs its progress."""
+    url, path = location
+    try:
+        destinationdir = os.path.dirname(path)
+        if not os.path.isdir(destinationdir):
+            os.makedirs(destinationdir)
+        fetch.munki_resource(url, path)
+    except (fetch.Error, OSError), err:
+        return err
+    return None
+
+
+def prefetch_manifests(manifestpath):
+    """Downloads every manifest included (directly, indirectly or via
+    conditional_items) by the manifest at manifestpath, and every catalog
+    those manifests use, with a pool of worker threads. Later processing of
+    the manifests then finds everything already downloaded and parsed
+    instead of fetching each manifest in turn.
+
+    Only the downloads run in the pool. Manifests and catalogs are checked,
+    parsed and recorded on this thread. Anything that can't be prefetched
+    is left for processing to retrieve, and report errors for, as usual.
+
+    Each manifest is fetched only once, so circular includes don't cause an
+    endless loop."""
+    pool = ThreadPool(PREFETCH_WORKERS)
+    completed = False
+    try:
+        seen_manifests = set()
+        seen_catalogs = set()
+        pending_catalogs = []
+        level = [(get_manifest_data(manifestpath), None)]
+        while level:
+            if processes.stop_requested():
+                return
+            to_fetch = []
+            for (manifestdata, parentcatalogs) in level:
+                (catalognames, included) = manifest_references(
+                    manifestdata, parentcatalogs)
+                for name in catalognames:
+                    if (name not in seen_catalogs and
+                            name not in catalogs.catalogs()):
+                        seen_catalogs.add(name)
+                        location = download.catalog_location(name)
+                        pending_catalogs.append(
+                            (name, location[1], pool.apply_async(
+                                _prefetch_download, (location, ))))
+                for (manifest_name, cataloglist) in included:
+                    if manifest_name not in seen_manifests:
+                        seen_manifests.add(manifest_name)
+                        to_fetch.append((manifest_name, cataloglist))
+            if not to_fetch:
+                break
+            display.display_debug1(
+                'Prefetching %s manifest(s)...', len(to_fetch))
+            names = [name for (name, dummy) in to_fetch
+                     if name not in _MANIFESTS]
+            locations = [manifest_location(name) for name in names]
+            errors = pool.map(_prefetch_download, locations)
+            for (name, (dummy_url, path), err) in zip(
+                    names, locations, errors):
+                if err:
+                    display.display_debug1(
+                        'Could not prefetch manifest %s: %s', name, err)
+                    continue
+                try:
+                    FoundationPlist.readPlist(path)
+                except FoundationPlist.NSPropertyListSerializationException:
+                    # reported when the manifest is processed
+                    continue
+                _MANIFESTS[name] = path
+            level = [(get_manifest_data(_MANIFESTS[name]), cataloglist)
+                     for (name, cataloglist) in to_fetch
+                     if name in _MANIFESTS]
+        for (name, path, result) in pending_catalogs:
+            if processes.stop_requested():
+                return
+            err = result.get()
+            if err:
+                display.display_debug1(
+                    'Could not prefetch catalog %s: %s', name, err)
+                continue
+            catalogs.load_catalog(name, path)
+        completed = True
+    finally:
+        if completed:
+            pool.close()
+        else:
+            # don't start downloads nobody is waiting for
+            pool.terminate()
+        pool.join()
+
+
+def resolve_manifest(manifest, parentcatalogs=None, manifest_chain=None):
+    """Reads a manifest and, recursively, the manifests it includes, and
+    evaluates its conditional_items, returning a tree that can be walked
+    once for each manifest key without re-reading the manifests or
+    re-evaluating predicates. Resolved manifest files are cached for the
+    rest of the check, unless we're asked to stop.
+
+    manifest can be a path to a manifest file or a dictionary object (as
+    found in conditional_items). manifest_chain is the list of manifest
+    paths that led to this one; an include of one of them is skipped with a
+    warning.
+
+    Returns a dict with these keys:
+      name: the manifest path, or EMBEDDED_MANIFEST
+      data: the manifest contents
+      catalogs: the catalogs used for the manifest's items, or None
+      included: resolved included_manifests
+      conditional: resolved conditional_items whose conditions are true
+    Raises ManifestException if an included manifest can't be retrieved.
+    """
+    manifest_chain = list(manifest_chain or [])
+    cache_key = None
+    if isinstance(manifest, basestring):
+        cache_key = (manifest, tuple(parentcatalogs or []))
+        if cache_key in _RESOLVED_MANIFESTS:
+            return _RESOLVED_MANIFESTS[cache_key]
+        manifestdata = get_manifest_data(manifest)
+        manifest_chain.append(manifest)
+    else:
+        manifestdata = manifest
+        manifest = EMBEDDED_MANIFEST
+
+    resolved = {'name': manifest,
+                'data': manifestdata,
+                'catalogs': None,
+                'included': [],
+                'conditional': []}
+
+    cataloglist = manifestdata.get('catalogs')
+    if cataloglist:
+        catalogs.get_catalogs(cataloglist)
+    elif parentcatalogs:
+        cataloglist = parentcatalogs
+    if not cataloglist:
+        # nothing in this manifest can be processed
+        return resolved
+    resolved['catalogs'] = cataloglist
+
+    for item in manifestdata.get('included_manifests', []):
+        if item:  # only process if item is not empty
+            nestedmanifestpath = get_manifest(item)
+            if not nestedmanifestpath:
+                raise ManifestException
+            if processes.stop_requested():
+                return resolved
+            if nestedmanifestpath in manifest_chain:
+                display.display_warning(
+                    'Skipping circular include of manifest %s in %s.',
+                    item, manifest)
+                continue
+            resolved['included'].append(resolve_manifest(
+                nestedmanifestpath, cataloglist, manifest_chain))
+
+    # conditionalitems should be an array of dicts
+    # each dict has a predicate; the rest consists of the
+    # same keys as a manifest
+    for item in manifestdata.get('conditional_items', []):
+        try:
+            predicate = item['condition']
+        except (AttributeError, KeyError):
+            display.display_warning(
+                'Missing predicate for conditional_item %s', item)
+            continue
+        except BaseException:
+            display.display_warning(
+                'Conditional item is malformed: %s', item)
+            continue
+        if info.predicate_evaluates_as_true(
+                predicate, additional_info={'catalogs': cataloglist}):
+            resolved['conditional'].append(resolve_manifest(
+                item, cataloglist, manifest_chain))
+
+    if cache_key and not processes.stop_requested():
+        # a tree cut short by a stop request is incomplete; don't keep it
+        _RESOLVED_MANIFESTS[cache_key] = resolved
+    return resolved
+
+
+def reset_resolved_manifests():
+    """Forgets the manifests resolved by resolve_manifest. Called at the
+    start of each check, since the manifests and the facts their
+    conditions use may have changed since the last one."""
+    _RESOLVED_MANIFESTS.clear()
+
+
 def get_manifest_data(manifestpath):
     '''Reads a manifest file, returns a dictionary-like object.'''
     plist = {}
@@ -314,6 +551,8 @@ def remove_from_selfserve_uninstalls(itemname):
 
 # module globals
 _MANIFESTS = {}
+# manifests resolved by resolve_manifest, keyed on (path, parent catalogs)
+_RESOLVED_MANIFESTS = {}
 
 if __name__ == '__main__':
     print 'This is a library of support tools for the Munki Suite.'
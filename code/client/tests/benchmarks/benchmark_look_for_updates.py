@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+benchmark_look_for_updates.py
+
+Times updatecheck.catalogs.look_for_updates() against synthetic catalogs of
+increasing size, comparing the update_for index with the linear scan over
+the updaters list it replaced.
+
+Run from the code/client directory:
+
+    python -m tests.benchmarks.benchmark_look_for_updates
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from munkilib.updatecheck import catalogs
+
+
+CATALOG_SIZES = [1000, 5000, 10000, 30000]
+# one in this many items is an update for another item
+UPDATER_RATIO = 10
+# number of manifest items looked up per simulated check
+LOOKUPS = 500
+
+
+def make_catalog(size):
+    '''Returns a list of synthetic pkginfo items'''
+    items = []
+    for index in range(size):
+        item = {'name': 'Item%s' % index, 'version': '1.0.%s' % index}
+        if index % UPDATER_RATIO == 0:
+            target = 'Item%s' % (index + 1)
+            item['update_for'] = [target, '%s-1.0.%s' % (target, index + 1)]
+        items.append(item)
+    return items
+
+
+def linear_look_for_updates(itemname, updaters):
+    '''The pre-index implementation of look_for_updates for comparison'''
+    return list(set([catalogitem['name'] for catalogitem in updaters
+                     if itemname in catalogitem.get('update_for', [])]))
+
+
+def main():
+    '''Prints timings for each catalog size'''
+    print '%10s %14s %14s' % ('items', 'linear (ms)', 'indexed (ms)')
+    for size in CATALOG_SIZES:
+        pkgdb = catalogs.make_catalog_db(make_catalog(size))
+        catalogs.catalogs().clear()
+        catalogs.catalogs()['bench'] = pkgdb
+        names = ['Item%s' % index
+                 for index in range(0, size, max(1, size / LOOKUPS))]
+
+        start = time.time()
+        for name in names:
+            linear_look_for_updates(name, pkgdb['updaters'])
+        linear_time = (time.time() - start) * 1000
+
+        start = time.time()
+        for name in names:
+            catalogs.look_for_updates(name, ['bench'])
+        indexed_time = (time.time() - start) * 1000
+
+        print '%10s %14.1f %14.1f' % (size, linear_time, indexed_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+benchmark_makecatalogs.py
+
+Times admin.makecatalogslib.makecatalogs() over a synthetic file repo with
+tens of thousands of pkginfo files, using different numbers of jobs, and
+checks that every run writes identical catalogs. Each read from the repo
+is delayed by a few milliseconds, like a read from a file share or server;
+a local disk answers from its cache too quickly for jobs to matter.
+
+Run from the code/client directory:
+
+    python -m tests.benchmarks.benchmark_makecatalogs [number_of_pkginfos]
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import plistlib
+import shutil
+import sys
+import tempfile
+import time
+
+from munkilib.admin import makecatalogslib
+from munkilib.munkirepo.FileRepo import FileRepo
+
+
+NUMBER_OF_PKGINFOS = 20000
+JOBS = [1, 2, 4, 8]
+CATALOGS = ['testing', 'production']
+# seconds added to each read from the repo
+LATENCY = 0.002
+
+
+class RemoteFileRepo(FileRepo):
+    '''A FileRepo whose reads take as long as they might over a network'''
+
+    def get(self, resource_identifier):
+        time.sleep(LATENCY)
+        return FileRepo.get(self, resource_identifier)
+
+
+def make_repo(repo_root, size):
+    '''Writes size synthetic pkginfo files and their pkgs'''
+    for kind in ['pkgsinfo', 'pkgs', 'catalogs', 'icons']:
+        os.makedirs(os.path.join(repo_root, kind))
+    for index in range(size):
+        name = 'Item%s' % (index / 10)
+        version = '1.0.%s' % (index % 10)
+        pkgname = '%s-%s.dmg' % (name, version)
+        pkginfo = {
+            'name': name,
+            'version': version,
+            'catalogs': CATALOGS[:index % 2 + 1],
+            'installer_item_location': pkgname,
+            'installer_item_hash': hashlib.sha256(pkgname).hexdigest(),
+            'installs': [{'type': 'application',
+                          'path': '/Applications/%s.app' % name,
+                          'CFBundleShortVersionString': version}],
+            'receipts': [{'packageid': 'com.example.%s' % name,
+                          'version': version}],
+            'description': 'Synthetic item %s ' % index * 5,
+            'notes': 'stripped from catalogs',
+            '_metadata': {'created_by': 'benchmark'},
+        }
+        plistlib.writePlist(pkginfo, os.path.join(
+            repo_root, 'pkgsinfo', '%s-%s.plist' % (name, version)))
+        open(os.path.join(repo_root, 'pkgs', pkgname), 'w').close()
+
+
+def read_catalogs(repo_root):
+    '''Returns a dict of catalog name to catalog data'''
+    catalog_dir = os.path.join(repo_root, 'catalogs')
+    return dict((name, open(os.path.join(catalog_dir, name)).read())
+                for name in os.listdir(catalog_dir))
+
+
+def main():
+    '''Prints timings for each number of jobs'''
+    size = NUMBER_OF_PKGINFOS
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        repo_root = os.path.join(tmpdir, 'repo')
+        print 'Creating %s pkginfo files in %s...' % (size, repo_root)
+        make_repo(repo_root, size)
+        repo = RemoteFileRepo('file://' + repo_root)
+
+        print '%10s %14s' % ('jobs', 'time (s)')
+        first_catalogs = None
+        for jobs in JOBS:
+            start = time.time()
+            errors = makecatalogslib.makecatalogs(repo, {'jobs': jobs})
+            elapsed = time.time() - start
+            if errors:
+                print 'Errors: %s' % errors[:5]
+            catalogs = read_catalogs(repo_root)
+            if first_catalogs is None:
+                first_catalogs = catalogs
+            elif catalogs != first_catalogs:
+                print 'Catalogs made with %s jobs differ!' % jobs
+            print '%10s %14.2f' % (jobs, elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
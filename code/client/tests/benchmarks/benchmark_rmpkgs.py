@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+benchmark_rmpkgs.py
+
+Times the removepackages receipt database in installer.rmpkgs using
+synthetic `pkgutil --files` output, read through a subprocess that takes
+about as long to start as pkgutil, so it doesn't need real receipts:
+
+  - a full import reading 1, 2, 4 and 8 packages at once, compared with
+    an incremental update after a few packages change
+  - getpathstoremove() compared with the unindexed query it replaced
+
+Run from the code/client directory:
+
+    python -m tests.benchmarks.benchmark_rmpkgs [number_of_packages]
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from munkilib import display
+from munkilib.installer import rmpkgs
+
+
+NUMBER_OF_PACKAGES = 300
+PATHS_PER_PACKAGE = 1000
+# packages whose receipts change between the full and incremental imports
+CHANGED_PACKAGES = 5
+# packages looked up per getpathstoremove timing
+LOOKUPS = 20
+JOBS = [1, 2, 4, 8]
+# seconds each synthetic pkgutil run takes before producing output
+PKGUTIL_LATENCY = 0.05
+
+
+def pkgutil_files_output(index):
+    '''Returns synthetic `pkgutil --files` output for package number index.
+    Every package shares some directories with the others, the way real
+    packages share /Library and /Applications.'''
+    lines = ['Library', 'Library/Application Support',
+             'Library/Application Support/Shared%s' % (index % 10)]
+    app = 'Applications/Item%s.app' % index
+    lines.append(app)
+    for path_index in range(PATHS_PER_PACKAGE - len(lines)):
+        lines.append('%s/Contents/Resources/file%s' % (app, path_index))
+    return ''.join(line + '\n' for line in lines)
+
+
+def write_pkgutil_files_output(files_dir, size):
+    '''Writes synthetic `pkgutil --files` output for size packages'''
+    os.makedirs(files_dir)
+    for index in range(size):
+        with open(os.path.join(files_dir, str(index)), 'w') as fileref:
+            fileref.write(pkgutil_files_output(index))
+
+
+def synthetic_read(argument):
+    '''Stands in for read_from_pkgutil'''
+    pkgid, files_path = argument
+    cmd = ['/bin/sh', '-c', 'sleep %s; cat "$0"' % PKGUTIL_LATENCY,
+           files_path]
+    return rmpkgs.package_record(0, 0, pkgid, '1.0', '', pkgid,
+                                 rmpkgs.command_output_lines(cmd))
+
+
+def synthetic_sources(files_dir, size, generation=0):
+    '''Returns receipt sources for size packages; the first
+    CHANGED_PACKAGES have a different fingerprint in each generation'''
+    sources = []
+    for index in range(size):
+        pkgid = 'com.example.pkg.%s' % index
+        fingerprint = 'installed'
+        if index < CHANGED_PACKAGES:
+            fingerprint = 'generation %s' % generation
+        sources.append((pkgid, fingerprint, synthetic_read,
+                        (pkgid, os.path.join(files_dir, str(index)))))
+    return sources
+
+
+def unindexed_getpathstoremove(curs, pkgkeys):
+    '''The pre-index getpathstoremove query for comparison'''
+    in_selected_packages = (
+        "select distinct path_key from pkgs_paths where pkg_key = %s"
+        % pkgkeys[0])
+    not_in_other_packages = (
+        "select distinct path_key from pkgs_paths where pkg_key != %s"
+        % pkgkeys[0])
+    return curs.execute(
+        "select path from paths where "
+        "(path_key in (%s) and path_key not in (%s))"
+        % (in_selected_packages, not_in_other_packages)).fetchall()
+
+
+def time_update(sources, forcerebuild, jobs=rmpkgs.IMPORT_JOBS):
+    '''Returns seconds taken to bring the database up to date'''
+    start = time.time()
+    conn = rmpkgs.open_database(forcerebuild=forcerebuild)
+    rmpkgs.update_database(conn, sources, jobs=jobs)
+    conn.close()
+    return time.time() - start
+
+
+def main():
+    '''Prints timings'''
+    size = NUMBER_OF_PACKAGES
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    # keep progress output out of the timings
+    display.verbose = 0
+    tmpdir = tempfile.mkdtemp()
+    rmpkgs.PACKAGEDB = os.path.join(tmpdir, 'b.receiptdb')
+    try:
+        files_dir = os.path.join(tmpdir, 'files')
+        write_pkgutil_files_output(files_dir, size)
+        print 'Importing %s packages of %s paths each...' % (
+            size, PATHS_PER_PACKAGE)
+        for jobs in JOBS:
+            print '%-32s %10.2f s' % (
+                'full import, %s jobs' % jobs,
+                time_update(synthetic_sources(files_dir, size), True, jobs))
+        print '%-32s %10.2f s' % (
+            'update, %s changed' % CHANGED_PACKAGES,
+            time_update(synthetic_sources(files_dir, size, 1), False))
+
+        conn = sqlite3.connect(rmpkgs.PACKAGEDB)
+        curs = conn.cursor()
+        pkgkeys = [row[0] for row in curs.execute(
+            'SELECT pkg_key FROM pkgs ORDER BY pkg_key LIMIT ?', (LOOKUPS,))]
+
+        start = time.time()
+        indexed = [sorted(rmpkgs.getpathstoremove([pkgkey]))
+                   for pkgkey in pkgkeys]
+        indexed_time = time.time() - start
+
+        for index in ['pkgs_paths_pkg_key', 'pkgs_paths_path_key']:
+            curs.execute('DROP INDEX %s' % index)
+        start = time.time()
+        unindexed = [sorted(row[0] for row in
+                            unindexed_getpathstoremove(curs, [pkgkey]))
+                     for pkgkey in pkgkeys]
+        unindexed_time = time.time() - start
+        conn.close()
+
+        if indexed != unindexed:
+            print 'getpathstoremove results differ!'
+        print '%-32s %10.2f ms' % (
+            'getpathstoremove, unindexed',
+            unindexed_time * 1000 / len(pkgkeys))
+        print '%-32s %10.2f ms' % (
+            'getpathstoremove, indexed', indexed_time * 1000 / len(pkgkeys))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
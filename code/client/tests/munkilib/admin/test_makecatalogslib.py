@@ -0,0 +1,307 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_makecatalogslib.py
+
+Unit tests for admin.makecatalogslib.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import plistlib
+import shutil
+import tempfile
+import threading
+import unittest
+from cStringIO import StringIO
+
+from munkilib import munkirepo
+from munkilib.admin import makecatalogslib
+
+
+def make_pkginfo(name, version, catalogs):
+    """Returns a minimal pkginfo dict"""
+    return {'name': name,
+            'version': version,
+            'catalogs': catalogs,
+            'installer_item_location': '%s-%s.dmg' % (name, version),
+            'notes': 'admin notes',
+            '_metadata': {'created_by': 'tests'}}
+
+
+class TestCatalogWriter(unittest.TestCase):
+    """Test that CatalogWriter output matches plistlib's."""
+
+    def test_matches_plistlib(self):
+        shared = make_pkginfo(u'Caf\xe9', '1.0', ['testing', 'production'])
+        shared['installer_item_size'] = 1024
+        shared['uninstallable'] = True
+        shared['installs'] = [{'type': 'file', 'path': '/tmp/<&>'}]
+        shared['icon_data'] = plistlib.Data('\x00\x01binary')
+        shared['force_install_after_date'] = datetime.datetime(2018, 1, 2)
+        shared['blocking_applications'] = []
+        shared['preinstall_script'] = '#!/bin/sh\n\techo "hi"\n'
+        other = make_pkginfo('Other', '2.0', ['testing'])
+        writer = makecatalogslib.CatalogWriter()
+        for catalog in [[shared, other], [shared]]:
+            buf = StringIO()
+            digest = writer.write(catalog, buf)
+            expected = plistlib.writePlistToString(catalog)
+            self.assertEqual(buf.getvalue(), expected)
+            self.assertEqual(
+                digest, makecatalogslib.hashlib.sha256(expected).hexdigest())
+        self.assertEqual(len(writer.fragments), 2)
+
+
+class TestVerifyPkginfo(unittest.TestCase):
+    """Test payload checks against a PkgsIndex."""
+
+    def setUp(self):
+        self.pkgs = makecatalogslib.PkgsIndex(
+            ['pkgs/apps/Firefox-60.0.dmg', 'pkgs/apps/Chrome.dmg',
+             'pkgs/apps/chrome.dmg'])
+
+    def verify(self, location, uninstaller_location=None):
+        """Returns the result of verify_pkginfo and the errors it added"""
+        pkginfo = {'name': 'Test', 'installer_item_location': location}
+        if uninstaller_location:
+            pkginfo['uninstaller_item_location'] = uninstaller_location
+        errors = []
+        result = makecatalogslib.verify_pkginfo(
+            'pkgsinfo/Test.plist', pkginfo, self.pkgs, errors)
+        return result, errors
+
+    def test_exact_match(self):
+        self.assertEqual(self.verify('apps/Firefox-60.0.dmg'), (True, []))
+
+    def test_case_insensitive_match_warns(self):
+        result, errors = self.verify('apps/firefox-60.0.DMG')
+        self.assertTrue(result)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('pkgs/apps/Firefox-60.0.dmg', errors[0])
+
+    def test_case_insensitive_match_is_first_in_list(self):
+        dummy_result, errors = self.verify('apps/CHROME.dmg')
+        self.assertIn('pkgs/apps/Chrome.dmg', errors[0])
+
+    def test_missing_uninstaller(self):
+        result, errors = self.verify('apps/Chrome.dmg', 'apps/Missing.dmg')
+        self.assertFalse(result)
+        self.assertIn('missing uninstaller item', errors[0])
+
+    def test_plain_list_is_accepted(self):
+        errors = []
+        self.assertTrue(makecatalogslib.verify_pkginfo(
+            'pkgsinfo/Test.plist',
+            {'name': 'Test', 'installer_item_location': 'apps/Chrome.dmg'},
+            ['pkgs/apps/Chrome.dmg'], errors))
+
+
+class ThreadRecordingRepo(munkirepo.Repo):
+    """A plugin with no get_many of its own that records reading threads"""
+
+    def __init__(self, url):
+        self.threads = set()
+
+    def get(self, resource_identifier):
+        self.threads.add(threading.current_thread().name)
+        if resource_identifier == 'pkgsinfo/missing':
+            raise munkirepo.RepoError('not found')
+        return resource_identifier
+
+
+class TestGetMany(unittest.TestCase):
+    """Test reading with jobs for plugins without their own get_many."""
+
+    def test_jobs_read_in_threads(self):
+        repo = ThreadRecordingRepo('test:')
+        refs = ['pkgsinfo/item%s' % index for index in range(20)]
+        results = list(makecatalogslib.get_many(
+            repo, refs + ['pkgsinfo/missing'], jobs=4))
+        self.assertEqual(results[:-1], zip(refs, refs))
+        self.assertTrue(isinstance(results[-1][1], munkirepo.RepoError))
+        self.assertNotIn(threading.current_thread().name, repo.threads)
+
+    def test_one_job_reads_in_this_thread(self):
+        repo = ThreadRecordingRepo('test:')
+        list(makecatalogslib.get_many(repo, ['pkgsinfo/item'], jobs=1))
+        self.assertEqual(repo.threads, set([threading.current_thread().name]))
+
+
+class TestDefaultStateFile(unittest.TestCase):
+    """Test default_state_file."""
+
+    def test_non_ascii_repo_url(self):
+        url = u'file:///Volumes/Munk\xed Repo'
+        self.assertEqual(
+            makecatalogslib.default_state_file(url),
+            makecatalogslib.default_state_file(url.encode('utf-8')))
+
+
+class TestIncrementalMakeCatalogs(unittest.TestCase):
+    """Test makecatalogs runs that use a state file."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo_root = os.path.join(self.tmpdir, 'repo')
+        for kind in ['pkgsinfo', 'pkgs', 'catalogs', 'icons']:
+            os.makedirs(os.path.join(self.repo_root, kind))
+        self.repo = munkirepo.connect('file://' + self.repo_root, None)
+        self.state_file = os.path.join(self.tmpdir, 'state')
+        for index in range(5):
+            self.add_pkginfo('Item%s' % index, '1.0', ['testing'])
+        self.add_pkginfo('Other', '2.0', ['production'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add_pkginfo(self, name, version, catalogs):
+        """Writes a pkginfo and the pkg it refers to"""
+        pkginfo = make_pkginfo(name, version, catalogs)
+        plistlib.writePlist(pkginfo, os.path.join(
+            self.repo_root, 'pkgsinfo', '%s-%s.plist' % (name, version)))
+        open(os.path.join(self.repo_root, 'pkgs',
+                          pkginfo['installer_item_location']), 'w').close()
+
+    def read_catalogs(self):
+        """Returns a dict of catalog name to raw catalog data"""
+        catalogs = {}
+        for name in os.listdir(os.path.join(self.repo_root, 'catalogs')):
+            catalogs[name] = open(
+                os.path.join(self.repo_root, 'catalogs', name)).read()
+        return catalogs
+
+    def makecatalogs(self, incremental=True, jobs=1):
+        """Runs makecatalogs, returning the messages it output"""
+        messages = []
+        options = {'jobs': jobs}
+        if incremental:
+            options['state_file'] = self.state_file
+        errors = makecatalogslib.makecatalogs(
+            self.repo, options, output_fn=messages.append)
+        self.assertEqual(errors, [])
+        return messages
+
+    def test_incremental_catalogs_match_full_run(self):
+        self.makecatalogs(incremental=True)
+        self.add_pkginfo('Item9', '1.0', ['testing'])
+        os.remove(os.path.join(
+            self.repo_root, 'pkgsinfo', 'Item0-1.0.plist'))
+        self.makecatalogs(incremental=True)
+        incremental_catalogs = self.read_catalogs()
+        self.makecatalogs(incremental=False)
+        self.assertEqual(incremental_catalogs, self.read_catalogs())
+        self.assertNotIn('Item0', incremental_catalogs['all'])
+        self.assertNotIn('admin notes', incremental_catalogs['all'])
+
+    def test_unchanged_pkginfo_is_not_reread(self):
+        self.makecatalogs(incremental=True)
+        original_get = self.repo.get
+        read = []
+
+        def tracking_get(resource_identifier):
+            read.append(resource_identifier)
+            return original_get(resource_identifier)
+
+        self.repo.get = tracking_get
+        self.add_pkginfo('Other', '3.0', ['production'])
+        self.makecatalogs(incremental=True)
+        self.assertEqual(
+            [ref for ref in read if ref.startswith('pkgsinfo/')],
+            ['pkgsinfo/Other-3.0.plist'])
+
+    def test_pkginfo_is_read_with_plugin_get_many(self):
+        original_get_many = self.repo.get_many
+        requested = []
+
+        def tracking_get_many(resource_identifiers, threads=None):
+            resource_identifiers = list(resource_identifiers)
+            requested.extend(resource_identifiers)
+            threads_requested.append(threads)
+            return original_get_many(resource_identifiers, threads)
+
+        threads_requested = []
+        self.repo.get_many = tracking_get_many
+        self.makecatalogs(incremental=False, jobs=3)
+        self.assertEqual(set(threads_requested), set([3]))
+        self.assertEqual(
+            sorted(ref for ref in requested if ref.startswith('pkgsinfo/')),
+            ['pkgsinfo/Item%s-1.0.plist' % index for index in range(5)] +
+            ['pkgsinfo/Other-2.0.plist'])
+
+    def test_unchanged_icons_are_not_rehashed(self):
+        for name in ['Item0.png', 'Item1.png']:
+            open(os.path.join(self.repo_root, 'icons', name), 'w').write(name)
+        self.makecatalogs(incremental=True)
+        open(os.path.join(self.repo_root, 'icons', 'Item2.png'), 'w').write(
+            'Item2.png')
+        messages = self.makecatalogs(incremental=True, jobs=2)
+        self.assertEqual([msg for msg in messages if msg.startswith('Hash')],
+                         ['Hashing Item2.png...'])
+        icon_hashes = plistlib.readPlist(os.path.join(
+            self.repo_root, 'icons', '_icon_hashes.plist'))
+        self.assertEqual(sorted(icon_hashes),
+                         ['Item0.png', 'Item1.png', 'Item2.png'])
+        self.assertEqual(icon_hashes['Item1.png'],
+                         makecatalogslib.hashlib.sha256('Item1.png').hexdigest())
+
+    def test_only_changed_catalogs_are_rewritten(self):
+        self.makecatalogs(incremental=True)
+        self.add_pkginfo('Other', '3.0', ['production'])
+        messages = self.makecatalogs(incremental=True)
+        self.assertIn('Skipped unchanged catalogs/testing...', messages)
+        self.assertIn('Created catalogs/production...', messages)
+        self.assertIn('Created catalogs/all...', messages)
+
+    def test_catalog_changed_by_full_run_is_rewritten(self):
+        self.makecatalogs(incremental=True)
+        self.add_pkginfo('Other', '3.0', ['production'])
+        self.makecatalogs(incremental=False)
+        os.remove(os.path.join(
+            self.repo_root, 'pkgsinfo', 'Other-3.0.plist'))
+        messages = self.makecatalogs(incremental=True)
+        self.assertIn('Created catalogs/production...', messages)
+        self.assertNotIn('3.0', self.read_catalogs()['production'])
+
+    def test_icon_hashes_changed_in_repo_are_rewritten(self):
+        open(os.path.join(self.repo_root, 'icons', 'Item0.png'), 'w').write(
+            'Item0.png')
+        self.makecatalogs(incremental=True)
+        icon_hashes_path = os.path.join(
+            self.repo_root, 'icons', '_icon_hashes.plist')
+        plistlib.writePlist({'Stale.png': 'abc'}, icon_hashes_path)
+        messages = self.makecatalogs(incremental=True)
+        self.assertIn('Created icons/_icon_hashes.plist...', messages)
+        self.assertEqual(
+            sorted(plistlib.readPlist(icon_hashes_path)), ['Item0.png'])
+
+    def test_jobs_do_not_change_output(self):
+        for index in range(50):
+            self.add_pkginfo('Many%s' % index, '1.0', ['testing'])
+        serial_messages = self.makecatalogs(incremental=False)
+        serial_catalogs = self.read_catalogs()
+        parallel_messages = self.makecatalogs(incremental=False, jobs=4)
+        self.assertEqual(serial_messages, parallel_messages)
+        self.assertEqual(serial_catalogs, self.read_catalogs())
+
+    def test_corrupt_state_file_is_ignored(self):
+        open(self.state_file, 'w').write('not a state file')
+        self.makecatalogs(incremental=True)
+        self.assertEqual(
+            sorted(self.read_catalogs()), ['all', 'production', 'testing'])
+
+
+if __name__ == '__main__':
+    unittest.main()
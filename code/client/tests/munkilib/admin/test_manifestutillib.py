@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_manifestutillib.py
+
+Unit tests for admin.manifestutillib.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+
+from munkilib import munkirepo
+from munkilib.admin import manifestutillib
+
+
+class TestDefaultCacheFile(unittest.TestCase):
+    """Test default_cache_file."""
+
+    def test_non_ascii_repo_url(self):
+        url = u'file:///Volumes/Munk\xed Repo'
+        self.assertEqual(
+            manifestutillib.default_cache_file(url),
+            manifestutillib.default_cache_file(url.encode('utf-8')))
+
+
+class TestRepoIndex(unittest.TestCase):
+    """Test RepoIndex against a FileRepo."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo_root = os.path.join(self.tmpdir, 'repo')
+        for kind in ['manifests', 'catalogs']:
+            os.makedirs(os.path.join(self.repo_root, kind))
+        self.repo = munkirepo.connect('file://' + self.repo_root, None)
+        self.cache_file = os.path.join(self.tmpdir, 'cache', 'index')
+        self.write_manifest('site_default', {
+            'catalogs': ['production'],
+            'managed_installs': ['Firefox', 'Chrome']})
+        self.write_manifest('lab', {
+            'catalogs': ['testing'],
+            'included_manifests': ['site_default'],
+            'optional_installs': ['Office']})
+        plistlib.writePlist(
+            [{'name': 'Firefox', 'version': '1.0'},
+             {'name': 'Firefox', 'version': '2.0'},
+             {'name': 'FirefoxUpdate', 'version': '1.0',
+              'update_for': ['Firefox']}],
+            os.path.join(self.repo_root, 'catalogs', 'production'))
+        plistlib.writePlist(
+            [{'name': 'Office', 'version': '16.0'}],
+            os.path.join(self.repo_root, 'catalogs', 'testing'))
+        self.read = []
+        original_get = self.repo.get
+
+        def tracking_get(resource_identifier):
+            self.read.append(resource_identifier)
+            return original_get(resource_identifier)
+
+        self.repo.get = tracking_get
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_manifest(self, name, manifest):
+        """Writes a manifest to the repo"""
+        plistlib.writePlist(
+            manifest, os.path.join(self.repo_root, 'manifests', name))
+
+    def index(self):
+        """Returns a RepoIndex using our cache file"""
+        return manifestutillib.RepoIndex(
+            self.repo, cache_file=self.cache_file)
+
+    def test_refresh_reads_everything_once(self):
+        repo_index = self.index()
+        self.assertEqual(repo_index.refresh(), [])
+        self.assertEqual(repo_index.manifest_names(), ['lab', 'site_default'])
+        self.assertEqual(repo_index.catalog_names(), ['production', 'testing'])
+        self.assertEqual(
+            dict(repo_index.manifests())['lab']['optional_installs'],
+            ['Office'])
+        self.assertEqual(
+            repo_index.installer_item_names(['production', 'testing']),
+            ['Firefox', 'Office'])
+        self.assertEqual(len(self.read), 4)
+
+        del self.read[:]
+        self.assertEqual(repo_index.refresh(), [])
+        self.assertEqual(self.read, [])
+
+    def test_cache_file_is_used_by_the_next_session(self):
+        self.index().refresh()
+        del self.read[:]
+        self.write_manifest('lab', {'managed_installs': ['Slack']})
+        os.unlink(os.path.join(self.repo_root, 'manifests', 'site_default'))
+        repo_index = self.index()
+        self.assertEqual(repo_index.refresh(), [])
+        self.assertEqual(self.read, ['manifests/lab'])
+        self.assertEqual(dict(repo_index.manifests()),
+                         {'lab': {'managed_installs': ['Slack']}})
+
+    def test_invalid_manifest_is_recorded(self):
+        open(os.path.join(self.repo_root, 'manifests', 'broken'), 'w').write(
+            'not a plist')
+        repo_index = self.index()
+        self.assertEqual(repo_index.refresh(), [])
+        self.assertEqual(list(repo_index.manifest_errors()), ['broken'])
+        self.assertNotIn('broken', dict(repo_index.manifests()))
+        self.assertIn('broken', repo_index.manifest_names())
+
+    def test_saved_and_renamed_manifests(self):
+        repo_index = self.index()
+        repo_index.refresh()
+        repo_index.update_manifest('new', {'managed_installs': ['Zoom']})
+        repo_index.rename_manifest('lab', 'lab2')
+        self.assertEqual(repo_index.manifest_names(),
+                         ['lab2', 'new', 'site_default'])
+        # the repo doesn't have them, so the next refresh drops them
+        repo_index.refresh()
+        self.assertEqual(repo_index.manifest_names(), ['lab', 'site_default'])
+
+    def test_items_without_fingerprints_are_read_each_time(self):
+        self.repo.itemlist_with_metadata = (
+            lambda kind, include_hash=False: [
+                {'identifier': name} for name in self.repo.itemlist(kind)])
+        repo_index = self.index()
+        repo_index.refresh(['manifests'])
+        del self.read[:]
+        self.write_manifest('lab', {'managed_installs': ['Slack']})
+        repo_index.refresh(['manifests'])
+        self.assertEqual(sorted(self.read),
+                         ['manifests/lab', 'manifests/site_default'])
+        self.assertEqual(dict(repo_index.manifests())['lab'],
+                         {'managed_installs': ['Slack']})
+
+    def test_corrupt_cache_file_is_ignored(self):
+        os.makedirs(os.path.dirname(self.cache_file))
+        open(self.cache_file, 'w').write('garbage')
+        repo_index = self.index()
+        self.assertEqual(repo_index.refresh(), [])
+        self.assertEqual(repo_index.manifest_names(), ['lab', 'site_default'])
+
+
+class TestManifestSearchIndex(unittest.TestCase):
+    """Test ManifestSearchIndex queries."""
+
+    def setUp(self):
+        self.search = manifestutillib.ManifestSearchIndex([
+            ('site_default', {'catalogs': ['production'],
+                              'managed_installs': ['Firefox', 'Chrome']}),
+            ('lab', {'included_manifests': ['site_default'],
+                     'managed_installs': ['firefox'],
+                     'optional_installs': ['FirefoxESR'],
+                     'display_name': 'Lab Firefox'}),
+            ('lab/room1', {'included_manifests': ['lab'],
+                           'managed_uninstalls': ['Chrome']}),
+            ('kiosk', {
+                'conditional_items': [
+                    {'condition': 'x', 'included_manifests': ['site_default']}],
+                'enabled': True, 'managed_installs': [None]}),
+            ('loop_a', {'included_manifests': ['loop_b', 'site_default']}),
+            ('loop_b', {'included_manifests': ['loop_a']})])
+
+    def test_find_substring_ignores_case(self):
+        self.assertEqual(self.search.find('FIREFOX'), [
+            ('lab', 'display_name', 'Lab Firefox'),
+            ('lab', 'managed_installs', 'firefox'),
+            ('lab', 'optional_installs', 'FirefoxESR'),
+            ('site_default', 'managed_installs', 'Firefox')])
+
+    def test_find_in_section(self):
+        self.assertEqual(
+            self.search.find('chrome', keyname='managed_uninstalls'),
+            [('lab/room1', 'managed_uninstalls', 'Chrome')])
+
+    def test_find_exact(self):
+        self.assertEqual(
+            self.search.find('firefox', keyname='managed_installs',
+                             exact=True),
+            [('lab', 'managed_installs', 'firefox'),
+             ('site_default', 'managed_installs', 'Firefox')])
+
+    def test_manifests_including(self):
+        self.assertEqual(self.search.manifests_including('site_default'),
+                         ['kiosk', 'lab', 'loop_a'])
+        self.assertEqual(self.search.manifests_including('kiosk'), [])
+
+    def test_include_chains(self):
+        self.assertEqual(self.search.include_chains('site_default'), [
+            ['site_default', 'kiosk'],
+            ['site_default', 'lab', 'lab/room1'],
+            ['site_default', 'loop_a', 'loop_b', 'loop_a']])
+        self.assertEqual(self.search.include_chains('lab/room1'), [])
+
+    def test_repo_index_rebuilds_search_after_changes(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'manifests'))
+            repo = munkirepo.connect('file://' + tmpdir, None)
+            repo_index = manifestutillib.RepoIndex(repo)
+            repo_index.refresh(['manifests'])
+            self.assertEqual(repo_index.search_index().find('Zoom'), [])
+            repo_index.update_manifest('new', {'managed_installs': ['Zoom']})
+            self.assertEqual(repo_index.search_index().find('Zoom'),
+                             [('new', 'managed_installs', 'Zoom')])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_repocleanlib.py
+
+Unit tests for admin.repocleanlib.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import imp
+import os
+import plistlib
+import shutil
+import tempfile
+import time
+import unittest
+
+from munkilib import munkirepo
+from munkilib.admin import repocleanlib
+from munkilib.admin.common import AttributeDict
+
+
+def make_pkginfo(name, version, catalogs):
+    """Returns a minimal pkginfo dict"""
+    return {'name': name,
+            'version': version,
+            'catalogs': catalogs,
+            'installer_item_location': '%s-%s.dmg' % (name, version),
+            'installer_item_size': 10}
+
+
+PKGINFOS = [
+    make_pkginfo('Firefox', '60.0', ['production']),
+    make_pkginfo('Firefox', '61.0', ['production']),
+    make_pkginfo('Firefox', '61.0', ['testing']),
+    make_pkginfo('Firefox', '61.0', ['production']),
+    make_pkginfo(u'Caf\xe9', '1.0', ['production']),
+    make_pkginfo('AdobeReader', '11.0', ['production', 'testing']),
+]
+
+
+class TestPkginfoStore(unittest.TestCase):
+    """Test PkginfoStore in memory and spilled to disk."""
+
+    def fill_store(self, memory_budget):
+        """Returns a store holding PKGINFOS"""
+        store = repocleanlib.PkginfoStore(memory_budget=memory_budget)
+        self.addCleanup(store.close)
+        for index, pkginfo in enumerate(PKGINFOS):
+            store.add(repocleanlib.make_metakey(pkginfo),
+                      repocleanlib.make_record(
+                          pkginfo, 'pkgsinfo/%s.plist' % index, 100))
+        return store
+
+    def test_variants_are_grouped_and_sorted(self):
+        store = self.fill_store(1024 * 1024)
+        self.assertFalse(store.spilled)
+        variants = list(store.variants())
+        self.assertEqual(len(store), 4)
+        self.assertEqual(
+            [metakey for metakey, dummy_versions in variants],
+            sorted(metakey for metakey, dummy_versions in variants))
+        firefox = dict(variants)[u'name: Firefox\ncatalogs: production']
+        self.assertEqual(sorted(firefox), ['60.0', '61.0'])
+        self.assertEqual(
+            [record.resource_identifier for record in firefox['61.0']],
+            ['pkgsinfo/1.plist', 'pkgsinfo/3.plist'])
+        self.assertEqual(firefox['60.0'][0].pkg_size, 10 * 1024)
+
+    def test_spilled_store_matches_memory_store(self):
+        in_memory = list(self.fill_store(1024 * 1024).variants())
+        store = self.fill_store(repocleanlib.RECORD_OVERHEAD * 3)
+        self.assertTrue(store.spilled)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(list(store.variants()), in_memory)
+
+    def test_close_removes_database(self):
+        store = self.fill_store(0)
+        tmpdir = store.tmpdir
+        self.assertTrue(os.path.isdir(tmpdir))
+        store.close()
+        self.assertFalse(os.path.exists(tmpdir))
+
+    def test_removepackages_receipts_are_part_of_metakey(self):
+        pkginfo = make_pkginfo('Tool', '1.0', ['production'])
+        pkginfo['uninstall_method'] = 'removepackages'
+        pkginfo['receipts'] = [{'packageid': 'com.example.tool'}]
+        self.assertEqual(
+            repocleanlib.make_metakey(pkginfo),
+            'name: Tool\ncatalogs: production\nreceipts: com.example.tool')
+
+
+def make_record(name, version, catalogs, pkg_path, pkg_size=2048):
+    """Returns a PkginfoRecord"""
+    return repocleanlib.PkginfoRecord(
+        name, version, 'pkgsinfo/%s-%s.plist' % (name, version), 100,
+        tuple(catalogs), pkg_path, pkg_size, '', 0)
+
+
+class TestReclaim(unittest.TestCase):
+    """Test working out what deleting items reclaims."""
+
+    def setUp(self):
+        self.items = [
+            make_record('Firefox', '59.0', ['production'], 'Firefox.dmg'),
+            make_record('Firefox', '60.0', ['testing'], 'Firefox.dmg'),
+            make_record('Chrome', '66.0', ['production'], 'Chrome-66.dmg'),
+            make_record('Tool', '1.0', [], 'Tool.pkg'),
+        ]
+
+    def test_shared_pkgs_are_listed_once(self):
+        objects = repocleanlib.objects_to_delete(self.items, set())
+        self.assertEqual(
+            [identifier for identifier, dummy_size, dummy_catalogs
+             in objects],
+            ['pkgsinfo/Firefox-59.0.plist', 'pkgs/Firefox.dmg',
+             'pkgsinfo/Firefox-60.0.plist', 'pkgsinfo/Chrome-66.0.plist',
+             'pkgs/Chrome-66.dmg', 'pkgsinfo/Tool-1.0.plist',
+             'pkgs/Tool.pkg'])
+        self.assertEqual(objects[1][2], set(['production', 'testing']))
+
+    def test_kept_pkgs_are_not_deleted(self):
+        objects = repocleanlib.objects_to_delete(
+            self.items, set(['Firefox.dmg']))
+        self.assertFalse('pkgs/Firefox.dmg' in
+                         [identifier for identifier, dummy_size,
+                          dummy_catalogs in objects])
+
+    def test_reclaim_by_catalog(self):
+        by_catalog, total = repocleanlib.reclaim_by_catalog(
+            repocleanlib.objects_to_delete(self.items, set()))
+        self.assertEqual(by_catalog, {
+            'production': (4, 100 + 2048 + 100 + 2048),
+            'testing': (2, 100 + 2048),
+            repocleanlib.NO_CATALOG: (2, 100 + 2048)})
+        self.assertEqual(total, (7, 4 * 100 + 3 * 2048))
+
+
+class TestDeleteObjects(unittest.TestCase):
+    """Test deleting objects from a file repo."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = munkirepo.connect('file://' + self.tmpdir, None)
+        self.identifiers = ['pkgsinfo/item%s' % index for index in range(30)]
+        for identifier in self.identifiers:
+            self.repo.put(identifier, 'pkginfo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_delete_in_parallel(self):
+        with munkirepo.batch(self.repo):
+            results = dict(repocleanlib.delete_objects(
+                self.repo, self.identifiers + ['pkgs/missing'], jobs=4))
+            # each deletion is made before it is reported
+            self.assertEqual(self.repo.itemlist('pkgsinfo'), [])
+        self.assertTrue(isinstance(results.pop('pkgs/missing'),
+                                   munkirepo.RepoError))
+        self.assertEqual(results, dict.fromkeys(self.identifiers))
+        self.assertEqual(self.repo.itemlist('pkgsinfo'), [])
+
+    def test_rate_limit(self):
+        start = time.time()
+        list(repocleanlib.delete_objects(
+            self.repo, self.identifiers[:11], jobs=4, rate=100))
+        # ten intervals of at least 10ms between the first and last start
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEqual(len(self.repo.itemlist('pkgsinfo')), 19)
+
+
+    def test_stopping_early_stops_deleting(self):
+        deletions = repocleanlib.delete_objects(
+            self.repo, self.identifiers, jobs=4)
+        for dummy_i in range(5):
+            next(deletions)
+        deletions.close()
+        # the five reported, plus no more than jobs already under way
+        remaining = len(self.repo.itemlist('pkgsinfo'))
+        self.assertTrue(30 - 5 - 4 <= remaining <= 30 - 5)
+
+
+class TestAnalyze(unittest.TestCase):
+    """Test repoclean's analysis of a file repo."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for kind in ['manifests', 'pkgsinfo']:
+            os.makedirs(os.path.join(self.tmpdir, kind))
+        for index, pkginfo in enumerate(PKGINFOS):
+            plistlib.writePlist(pkginfo, os.path.join(
+                self.tmpdir, 'pkgsinfo', '%s.plist' % index))
+        self.repoclean = imp.load_source('repoclean', os.path.join(
+            os.path.dirname(__file__), '..', '..', '..', 'repoclean'))
+        self.cleaner = self.repoclean.RepoCleaner(
+            munkirepo.connect('file://' + self.tmpdir, None),
+            AttributeDict({'memory_budget': 1}))
+        self.addCleanup(self.cleaner.pkginfodb.close)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_manifest(self, name, manifest):
+        """Writes a manifest to the repo"""
+        plistlib.writePlist(
+            manifest, os.path.join(self.tmpdir, 'manifests', name))
+
+    def test_manifest_items_are_found(self):
+        self.write_manifest('site_default', {
+            'managed_installs': ['Firefox-60.0'],
+            'conditional_items': [{'managed_installs': ['AdobeReader']}]})
+        self.cleaner.analyze()
+        self.assertEqual(self.cleaner.manifest_items,
+                         set(['Firefox', 'AdobeReader']))
+        self.assertEqual(self.cleaner.manifest_items_with_versions,
+                         set([('Firefox', '60.0')]))
+        self.assertEqual(self.cleaner.pkginfo_count, len(PKGINFOS))
+
+    def test_error_analyzing_manifests_is_raised(self):
+        self.write_manifest('site_default', {
+            'managed_installs': ['Firefox'],
+            'conditional_items': ['not a dict']})
+        self.assertRaises(AttributeError, self.cleaner.analyze)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_rmpkgs.py
+
+Unit tests for the removepackages receipt database in installer.rmpkgs.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from munkilib import display
+from munkilib.installer import rmpkgs
+
+
+# synthetic `pkgutil --files` output for each package id
+PKG_FILES = {
+    'com.example.app': ['Applications', 'Applications/App.app',
+                        'Applications/App.app/Contents'],
+    'com.example.tool': ['usr', 'usr/local', 'usr/local/bin/tool',
+                         'Applications'],
+}
+
+
+class TestReceiptDatabase(unittest.TestCase):
+    """Test building, updating and querying the receipt database."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved_packagedb = rmpkgs.PACKAGEDB
+        self.saved_verbose = display.verbose
+        rmpkgs.PACKAGEDB = os.path.join(self.tmpdir, 'b.receiptdb')
+        display.verbose = 0
+        self.imported = []
+
+    def tearDown(self):
+        rmpkgs.PACKAGEDB = self.saved_packagedb
+        display.verbose = self.saved_verbose
+        shutil.rmtree(self.tmpdir)
+
+    def fake_read(self, pkgid):
+        """Reads a package from PKG_FILES"""
+        self.imported.append(pkgid)
+        return rmpkgs.package_record(
+            0, 0, pkgid, '1.0', '', pkgid,
+            [path + '\n' for path in PKG_FILES[pkgid]])
+
+    def update(self, fingerprints, jobs=1):
+        """Updates the database from a dict of pkgid to fingerprint"""
+        self.imported = []
+        sources = [(pkgid, fingerprint, self.fake_read, pkgid)
+                   for pkgid, fingerprint in sorted(fingerprints.items())]
+        conn = rmpkgs.open_database()
+        self.assertTrue(rmpkgs.update_database(conn, sources, jobs=jobs))
+        conn.close()
+
+    def paths(self, pkgid):
+        """Returns the paths only pkgid installed"""
+        return sorted(rmpkgs.getpathstoremove(rmpkgs.getpkgkeys([pkgid])))
+
+    def test_unique_paths_are_removed(self):
+        self.update({'com.example.app': 'a', 'com.example.tool': 'a'})
+        self.assertEqual(self.paths('com.example.app'),
+                         ['Applications/App.app',
+                          'Applications/App.app/Contents'])
+        self.assertEqual(self.paths('com.example.tool'),
+                         ['usr', 'usr/local', 'usr/local/bin/tool'])
+
+    def test_only_changed_packages_are_imported(self):
+        self.update({'com.example.app': 'a', 'com.example.tool': 'a'})
+        self.update({'com.example.app': 'a', 'com.example.tool': 'b'})
+        self.assertEqual(self.imported, ['com.example.tool'])
+        self.update({'com.example.app': 'a', 'com.example.tool': 'b'})
+        self.assertEqual(self.imported, [])
+        self.assertEqual(len(rmpkgs.getpkgkeys(['com.example.tool'])), 1)
+
+    def test_unknown_fingerprints_are_always_imported(self):
+        self.update({'com.example.app': None})
+        self.update({'com.example.app': None})
+        self.assertEqual(self.imported, ['com.example.app'])
+        self.assertEqual(len(rmpkgs.getpkgkeys(['com.example.app'])), 1)
+
+    def test_removed_packages_are_dropped(self):
+        self.update({'com.example.app': 'a', 'com.example.tool': 'a'})
+        self.update({'com.example.app': 'a'})
+        self.assertEqual(rmpkgs.getpkgkeys(['com.example.tool']), [])
+        # paths the tool shared with the app now belong to the app alone
+        self.assertEqual(self.paths('com.example.app'),
+                         ['Applications', 'Applications/App.app',
+                          'Applications/App.app/Contents'])
+        conn = sqlite3.connect(rmpkgs.PACKAGEDB)
+        self.assertEqual(
+            conn.execute('SELECT count(*) FROM paths').fetchone()[0], 3)
+        conn.close()
+
+    def test_parallel_reads_match_serial_reads(self):
+        self.update({'com.example.app': 'a', 'com.example.tool': 'a'},
+                    jobs=4)
+        self.assertEqual(sorted(self.imported),
+                         ['com.example.app', 'com.example.tool'])
+        self.assertEqual(self.paths('com.example.tool'),
+                         ['usr', 'usr/local', 'usr/local/bin/tool'])
+
+    def test_reads_stay_within_window(self):
+        pool = rmpkgs.ThreadPool(2)
+        try:
+            to_import = [(index, None, self.imported.append, index)
+                         for index in range(20)]
+            for index, (source, dummy_fp, dummy_package) in enumerate(
+                    rmpkgs.read_sources(pool, to_import, 4)):
+                self.assertEqual(source, index)
+                self.assertLessEqual(len(self.imported), index + 5)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(sorted(self.imported), range(20))
+
+    def test_stop_request_keeps_imported_packages(self):
+        stop_requests = [False, True]
+        saved_stop_requested = rmpkgs.processes.stop_requested
+        rmpkgs.processes.stop_requested = lambda: stop_requests.pop(0)
+        try:
+            conn = rmpkgs.open_database()
+            self.assertFalse(rmpkgs.update_database(
+                conn, [(pkgid, 'a', self.fake_read, pkgid)
+                       for pkgid in sorted(PKG_FILES)], jobs=2))
+            conn.close()
+        finally:
+            rmpkgs.processes.stop_requested = saved_stop_requested
+        self.assertEqual(len(rmpkgs.getpkgkeys(['com.example.app'])), 1)
+        self.update({'com.example.app': 'a', 'com.example.tool': 'a'})
+        self.assertEqual(self.imported, ['com.example.tool'])
+
+    def test_many_packages_removed_together(self):
+        def read_many(pkgid):
+            """Reads a package with one unique and one shared path"""
+            return rmpkgs.package_record(
+                0, 0, pkgid, '1.0', '', pkgid,
+                ['shared\n', 'only/%s\n' % pkgid])
+
+        pkgids = ['com.example.pkg%s' % index for index in range(600)]
+        conn = rmpkgs.open_database()
+        self.assertTrue(rmpkgs.update_database(
+            conn, [(pkgid, 'a', read_many, pkgid)
+                   for pkgid in pkgids + ['com.example.other']]))
+        conn.close()
+        pkgkeys = rmpkgs.getpkgkeys(pkgids)
+        self.assertEqual(len(pkgkeys), 600)
+        # keys that aren't in the db, so there are more keys than even
+        # sqlite builds with a raised variable limit (250000) would allow
+        unused_pkgkeys = range(1000000, 1130000)
+        self.assertEqual(
+            sorted(rmpkgs.getpathstoremove(pkgkeys + unused_pkgkeys)),
+            sorted('only/%s' % pkgid for pkgid in pkgids))
+
+    def test_old_schema_is_rebuilt(self):
+        conn = sqlite3.connect(rmpkgs.PACKAGEDB)
+        conn.execute('CREATE TABLE pkgs (pkg_key INTEGER PRIMARY KEY)')
+        conn.close()
+        self.update({'com.example.app': 'a'})
+        self.assertEqual(rmpkgs.database_version(rmpkgs.PACKAGEDB),
+                         rmpkgs.SCHEMA_VERSION)
+        self.assertEqual(self.imported, ['com.example.app'])
+
+
+if __name__ == '__main__':
+    unittest.main()
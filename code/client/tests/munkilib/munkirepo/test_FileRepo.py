@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_FileRepo.py
+
+Unit tests for the FileRepo plugin.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from munkilib import munkirepo
+
+
+class TestItemlistWithMetadata(unittest.TestCase):
+    """Test FileRepo.itemlist_with_metadata."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = munkirepo.connect('file://' + self.tmpdir, None)
+        for path in ['pkgsinfo/apps/Firefox.plist', 'pkgsinfo/Chrome.plist',
+                     'pkgsinfo/.hidden', 'pkgsinfo/.git/config']:
+            self.repo.put(path, path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_matches_itemlist(self):
+        items = self.repo.itemlist_with_metadata('pkgsinfo')
+        self.assertEqual([item['identifier'] for item in items],
+                         self.repo.itemlist('pkgsinfo'))
+
+    def test_metadata(self):
+        path = os.path.join(self.tmpdir, 'pkgsinfo', 'Chrome.plist')
+        os.utime(path, (1500000000, 1500000000))
+        items = self.repo.itemlist_with_metadata('pkgsinfo', include_hash=True)
+        chrome = [item for item in items
+                  if item['identifier'] == 'Chrome.plist'][0]
+        self.assertEqual(chrome['size'], len('pkgsinfo/Chrome.plist'))
+        self.assertEqual(chrome['mtime'], 1500000000)
+        self.assertEqual(
+            chrome['sha256'],
+            hashlib.sha256('pkgsinfo/Chrome.plist').hexdigest())
+
+    def test_hash_is_optional(self):
+        for item in self.repo.itemlist_with_metadata('pkgsinfo'):
+            self.assertFalse('sha256' in item)
+
+    def test_missing_kind(self):
+        self.assertEqual(self.repo.itemlist_with_metadata('icons'), [])
+
+
+class TestAtomicWrites(unittest.TestCase):
+    """Test FileRepo.put and FileRepo.batch."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = munkirepo.connect('file://' + self.tmpdir, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, resource_identifier):
+        """Returns the contents of a repo file, or None if it's missing"""
+        path = os.path.join(self.tmpdir, resource_identifier)
+        if not os.path.exists(path):
+            return None
+        return open(path).read()
+
+    def test_put_leaves_no_temporary_files(self):
+        self.repo.put('catalogs/all', 'one')
+        self.repo.put('catalogs/all', 'two')
+        self.assertEqual(self.read('catalogs/all'), 'two')
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'catalogs')),
+                         ['all'])
+
+    def test_put_keeps_permissions(self):
+        self.repo.put('catalogs/all', 'one')
+        os.chmod(os.path.join(self.tmpdir, 'catalogs/all'), 0640)
+        self.repo.put('catalogs/all', 'two')
+        self.assertEqual(
+            os.stat(os.path.join(self.tmpdir, 'catalogs/all')).st_mode & 0777,
+            0640)
+
+    def test_batch_publishes_at_end(self):
+        self.repo.put('catalogs/old', 'old')
+        local_path = os.path.join(self.tmpdir, 'local')
+        open(local_path, 'w').write('testing')
+        with self.repo.batch():
+            self.repo.put('catalogs/all', 'all')
+            self.repo.put_from_local_file('catalogs/testing', local_path)
+            self.repo.delete('catalogs/old')
+            self.assertEqual(self.read('catalogs/all'), None)
+            # deletes are not held back
+            self.assertEqual(self.read('catalogs/old'), None)
+            # temporary files are hidden from itemlist
+            self.assertEqual(self.repo.itemlist('catalogs'), [])
+        self.assertEqual(self.read('catalogs/all'), 'all')
+        self.assertEqual(self.read('catalogs/testing'), 'testing')
+        self.assertEqual(self.read('catalogs/old'), None)
+        self.assertEqual(sorted(self.repo.itemlist('catalogs')),
+                         ['all', 'testing'])
+
+    def test_batch_is_discarded_on_error(self):
+        self.repo.put('catalogs/all', 'old')
+        try:
+            with self.repo.batch():
+                self.repo.put('catalogs/all', 'new')
+                self.repo.put('catalogs/all', 'newer')
+                raise ValueError('oops')
+        except ValueError:
+            pass
+        self.assertEqual(self.read('catalogs/all'), 'old')
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'catalogs')),
+                         ['all'])
+
+    def test_failed_publish_removes_temporary_files(self):
+        original_rename = os.rename
+        renames = []
+
+        def failing_rename(source, dest):
+            if renames:
+                raise OSError(28, 'No space left on device')
+            renames.append(dest)
+            original_rename(source, dest)
+
+        os.rename = failing_rename
+        try:
+            with self.repo.batch():
+                for name in ['a', 'b', 'c']:
+                    self.repo.put('catalogs/' + name, name)
+        except munkirepo.RepoError:
+            pass
+        else:
+            self.fail('RepoError not raised')
+        finally:
+            os.rename = original_rename
+        self.assertEqual(self.read('catalogs/a'), 'a')
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'catalogs')),
+                         ['a'])
+
+    def test_delete_item_put_in_same_batch(self):
+        with self.repo.batch():
+            self.repo.put('catalogs/all', 'all')
+            self.repo.delete('catalogs/all')
+        self.assertEqual(self.read('catalogs/all'), None)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'catalogs')),
+                         [])
+
+    def test_nested_batches(self):
+        with self.repo.batch():
+            with self.repo.batch():
+                self.repo.put('catalogs/all', 'all')
+            self.assertEqual(self.read('catalogs/all'), None)
+        self.assertEqual(self.read('catalogs/all'), 'all')
+
+    def test_delete_missing_item_in_batch(self):
+        with self.repo.batch():
+            self.assertRaises(munkirepo.RepoError,
+                              self.repo.delete, 'catalogs/missing')
+
+    def test_many_deletes_and_puts_in_batch(self):
+        for index in range(20):
+            self.repo.put('pkgsinfo/item%s' % index, 'old')
+        with self.repo.batch():
+            for index in range(10):
+                self.repo.delete('pkgsinfo/item%s' % index)
+            # deleted, then put back
+            self.repo.put('pkgsinfo/item0', 'new')
+            # put twice; the last write wins
+            self.repo.put('pkgsinfo/item1', 'first')
+            self.repo.put('pkgsinfo/item1', 'second')
+            for index in range(10, 20):
+                self.repo.delete('pkgsinfo/item%s' % index)
+            self.assertRaises(munkirepo.RepoError,
+                              self.repo.delete, 'pkgsinfo/item2')
+        self.assertEqual(sorted(self.repo.itemlist('pkgsinfo')),
+                         ['item0', 'item1'])
+        self.assertEqual(self.read('pkgsinfo/item0'), 'new')
+        self.assertEqual(self.read('pkgsinfo/item1'), 'second')
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tmpdir, 'pkgsinfo'))),
+            ['item0', 'item1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
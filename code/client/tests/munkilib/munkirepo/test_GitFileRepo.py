@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_GitFileRepo.py
+
+Unit tests for the GitFileRepo plugin's batched commits.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from munkilib import munkirepo
+from munkilib.munkirepo.GitFileRepo import GITCMD
+
+
+def git(repo_dir, *args):
+    """Runs git in repo_dir and returns its output"""
+    return subprocess.check_output([GITCMD] + list(args), cwd=repo_dir)
+
+
+@unittest.skipUnless(os.path.exists(GITCMD), 'git is not installed')
+class TestBatchedCommits(unittest.TestCase):
+    """Test that GitFileRepo.batch makes a single commit."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        git(self.tmpdir, 'init', '-q', '.')
+        git(self.tmpdir, 'config', 'user.email', 'munki@example.com')
+        git(self.tmpdir, 'config', 'user.name', 'Munki Tests')
+        with open(os.path.join(self.tmpdir, '.gitignore'), 'w') as fileref:
+            fileref.write('*.ignored\n')
+        git(self.tmpdir, 'add', '.gitignore')
+        git(self.tmpdir, 'commit', '-q', '-m', 'Initial commit')
+        self.repo = munkirepo.connect('file://' + self.tmpdir, 'GitFileRepo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def commit_count(self):
+        """Returns the number of commits in the repo"""
+        return int(git(self.tmpdir, 'rev-list', '--count', 'HEAD'))
+
+    def test_batch_makes_one_commit(self):
+        self.repo.put('pkgsinfo/old.plist', 'old')
+        commits = self.commit_count()
+        with self.repo.batch():
+            for index in range(10):
+                self.repo.put('pkgsinfo/item%s.plist' % index, 'item')
+            self.repo.put('pkgsinfo/skipped.ignored', 'ignored')
+            self.repo.put('pkgsinfo/temp.plist', 'temp')
+            self.repo.delete('pkgsinfo/temp.plist')
+            self.repo.delete('pkgsinfo/old.plist')
+        self.assertEqual(self.commit_count(), commits + 1)
+        tracked = git(self.tmpdir, 'ls-files').splitlines()
+        self.assertEqual(
+            sorted(tracked),
+            ['.gitignore'] + sorted('pkgsinfo/item%s.plist' % index
+                                    for index in range(10)))
+        message = git(self.tmpdir, 'log', '-1', '--format=%B')
+        self.assertTrue('created 10, deleted 1 items' in message)
+        # nothing left uncommitted; the ignored file stays untracked
+        self.assertEqual(git(self.tmpdir, 'status', '--porcelain'), '')
+
+    def test_empty_batch_makes_no_commit(self):
+        commits = self.commit_count()
+        with self.repo.batch():
+            pass
+        self.assertEqual(self.commit_count(), commits)
+
+    def test_deletions_are_committed_when_batch_fails(self):
+        self.repo.put('pkgsinfo/old.plist', 'old')
+        commits = self.commit_count()
+        try:
+            with self.repo.batch():
+                self.repo.put('pkgsinfo/new.plist', 'new')
+                self.repo.delete('pkgsinfo/old.plist')
+                raise ValueError('oops')
+        except ValueError:
+            pass
+        self.assertEqual(self.commit_count(), commits + 1)
+        self.assertEqual(git(self.tmpdir, 'ls-files').splitlines(),
+                         ['.gitignore'])
+        self.assertEqual(git(self.tmpdir, 'status', '--porcelain'), '')
+
+    def test_renames_are_logged_by_path(self):
+        # git status reports this as a rename, with the original path in
+        # its own field; that field must not be read as an entry
+        self.repo.put('Deleted/old.plist', 'same content')
+        with self.repo.batch():
+            self.repo.put('pkgsinfo/new.plist', 'same content')
+            self.repo.delete('Deleted/old.plist')
+        message = git(self.tmpdir, 'log', '-1', '--format=%B')
+        self.assertTrue('created 1, deleted 1 items' in message)
+        self.assertEqual(message.strip().splitlines()[2:],
+                         ["deleted 'Deleted/old.plist'",
+                          "created 'pkgsinfo/new.plist'"])
+
+if __name__ == '__main__':
+    unittest.main()
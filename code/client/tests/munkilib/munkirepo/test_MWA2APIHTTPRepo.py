@@ -0,0 +1,271 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_MWA2APIHTTPRepo.py
+
+Unit tests for the MWA2APIHTTPRepo plugin, run against a local stand-in for
+the MWA2 API.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cgi
+import os
+import plistlib
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, TCPServer
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from munkilib import munkirepo
+from munkilib.munkirepo.MWA2APIHTTPRepo import MAX_CONNECTIONS
+
+
+AUTHTOKEN = 'Basic dGVzdDp0ZXN0'
+
+
+class FakeMWA2Server(ThreadingMixIn, TCPServer):
+    """In-memory stand-in for the MWA2 API"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        TCPServer.__init__(self, ('127.0.0.1', 0), FakeMWA2Handler)
+        self.items = {}
+        self.connections = 0
+        self.puts = 0
+        self.active_requests = 0
+        self.max_active_requests = 0
+        self.lock = threading.Lock()
+
+
+class FakeMWA2Handler(BaseHTTPRequestHandler):
+    """Handles requests for FakeMWA2Server"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=''):
+        """Sends a response that keeps the connection open"""
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_one_request(self):
+        with self.server.lock:
+            self.server.active_requests += 1
+            self.server.max_active_requests = max(
+                self.server.max_active_requests, self.server.active_requests)
+        try:
+            BaseHTTPRequestHandler.handle_one_request(self)
+        finally:
+            with self.server.lock:
+                self.server.active_requests -= 1
+
+    def resource(self):
+        """Returns the item path and query for the request"""
+        url = urlparse(self.path)
+        return urllib2.unquote(url.path).lstrip('/'), url.query
+
+    def authorized(self):
+        """Sends a 401 unless the request has our authtoken"""
+        if self.headers.get('Authorization') != AUTHTOKEN:
+            self.respond(401, 'Unauthorized')
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        path, query = self.resource()
+        if path == 'redirect':
+            self.send_response(302)
+            self.send_header('Location', '/catalogs/all')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif query == 'api_fields=filename':
+            names = sorted(item[len(path) + 1:] for item in self.server.items
+                           if item.startswith(path + '/'))
+            if path in ['catalogs', 'manifests', 'pkgsinfo']:
+                names = [{'filename': name} for name in names]
+            self.respond(200, plistlib.writePlistToString(names))
+        elif path in self.server.items:
+            self.respond(200, self.server.items[path])
+        else:
+            self.respond(404, 'Not found')
+
+    def do_PUT(self):
+        if not self.authorized():
+            return
+        path, dummy_query = self.resource()
+        length = int(self.headers['Content-Length'])
+        self.server.items[path] = self.rfile.read(length)
+        self.server.puts += 1
+        if path == 'manifests/drop':
+            # act on the request, then drop the connection unanswered
+            self.close_connection = 1
+            return
+        self.respond(200, self.server.items[path])
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        path, dummy_query = self.resource()
+        form = cgi.FieldStorage(
+            fp=self.rfile, headers=self.headers,
+            environ={'REQUEST_METHOD': 'POST',
+                     'CONTENT_TYPE': self.headers['Content-Type']})
+        self.server.items[path] = form['filedata'].value
+        self.respond(200)
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+        path, dummy_query = self.resource()
+        if self.server.items.pop(path, None) is None:
+            self.respond(404, 'Not found')
+        else:
+            self.respond(200)
+
+
+class TestMWA2APIHTTPRepo(unittest.TestCase):
+    """Test MWA2APIHTTPRepo against FakeMWA2Server."""
+
+    def setUp(self):
+        self.server = FakeMWA2Server()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        os.environ['MUNKIREPO_AUTHTOKEN'] = AUTHTOKEN
+        self.repo = munkirepo.connect(
+            'http://127.0.0.1:%s/' % self.server.server_address[1],
+            'MWA2APIHTTPRepo')
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        del os.environ['MUNKIREPO_AUTHTOKEN']
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get_delete(self):
+        self.repo.put('pkgsinfo/apps/Firefox-60.0.plist', '<plist/>')
+        self.assertEqual(
+            self.repo.get('pkgsinfo/apps/Firefox-60.0.plist'), '<plist/>')
+        self.repo.delete('pkgsinfo/apps/Firefox-60.0.plist')
+        self.assertRaises(munkirepo.RepoError, self.repo.get,
+                          'pkgsinfo/apps/Firefox-60.0.plist')
+
+    def test_itemlist(self):
+        self.server.items['pkgsinfo/b.plist'] = ''
+        self.server.items['pkgsinfo/a.plist'] = ''
+        self.server.items['icons/a.png'] = ''
+        self.assertEqual(self.repo.itemlist('pkgsinfo'),
+                         ['a.plist', 'b.plist'])
+        self.assertEqual(self.repo.itemlist('icons'), ['a.png'])
+
+    def test_large_content_with_unicode_name(self):
+        content = 'x' * 1024 * 1024
+        self.repo.put(u'manifests/Caf\xe9', content)
+        self.assertEqual(self.repo.get(u'manifests/Caf\xe9'), content)
+
+    def test_local_files(self):
+        local_path = os.path.join(self.tmpdir, 'Firefox.dmg')
+        with open(local_path, 'wb') as fileref:
+            fileref.write('\x00dmg data\r\n' * 1000)
+        self.repo.put_from_local_file('pkgs/Firefox.dmg', local_path)
+        self.assertEqual(self.server.items['pkgs/Firefox.dmg'],
+                         open(local_path, 'rb').read())
+
+        self.repo.put_from_local_file('manifests/site', local_path)
+        copy_path = os.path.join(self.tmpdir, 'copy')
+        self.repo.get_to_local_file('manifests/site', copy_path)
+        self.assertEqual(open(copy_path, 'rb').read(),
+                         open(local_path, 'rb').read())
+
+    def test_connections_are_reused(self):
+        self.server.items['catalogs/all'] = 'catalog'
+        for dummy_i in range(20):
+            self.repo.get('catalogs/all')
+        self.assertEqual(self.server.connections, 1)
+
+    def test_concurrency_is_bounded(self):
+        self.server.items['catalogs/all'] = 'catalog'
+        pool = ThreadPool(MAX_CONNECTIONS * 3)
+        results = pool.map(lambda dummy_i: self.repo.get('catalogs/all'),
+                           range(100))
+        pool.close()
+        pool.join()
+        self.assertEqual(results, ['catalog'] * 100)
+        self.assertTrue(self.server.connections <= MAX_CONNECTIONS)
+
+    def test_get_many(self):
+        refs = ['pkgsinfo/item%s.plist' % index for index in range(30)]
+        for ref in refs:
+            self.server.items[ref] = ref
+        results = list(self.repo.get_many(refs + ['pkgsinfo/missing']))
+        self.assertEqual(results[:-1], zip(refs, refs))
+        self.assertTrue(isinstance(results[-1][1], munkirepo.RepoError))
+        self.assertTrue(self.server.connections <= MAX_CONNECTIONS)
+
+    def test_redirects_are_followed(self):
+        self.server.items['catalogs/all'] = 'catalog'
+        self.assertEqual(self.repo.get('redirect'), 'catalog')
+
+    def test_server_closing_idle_connection(self):
+        self.server.items['catalogs/all'] = 'catalog'
+        self.repo.get('catalogs/all')
+        for pool in self.repo.pools.values():
+            for connection in list(pool.idle.queue):
+                # simulate the server timing out the keep-alive connection
+                connection.sock.close()
+                connection.sock = connection.sock.__class__()
+        self.assertEqual(self.repo.get('catalogs/all'), 'catalog')
+
+    def test_put_on_connection_closed_by_server(self):
+        self.server.items['catalogs/all'] = 'catalog'
+        self.repo.get('catalogs/all')
+        for pool in self.repo.pools.values():
+            for connection in list(pool.idle.queue):
+                connection.sock.shutdown(socket.SHUT_RDWR)
+        self.repo.put('manifests/site', 'manifest')
+        self.assertEqual(self.server.items['manifests/site'], 'manifest')
+        self.assertEqual(self.server.puts, 1)
+
+    def test_put_is_not_resent_after_failure(self):
+        self.server.items['catalogs/all'] = 'catalog'
+        self.repo.get('catalogs/all')
+        self.assertRaises(munkirepo.RepoError, self.repo.put,
+                          'manifests/drop', 'manifest')
+        self.assertEqual(self.server.puts, 1)
+
+    def test_bad_authtoken(self):
+        self.repo.authtoken = 'Basic bad'
+        self.assertRaises(munkirepo.RepoError, self.repo.get, 'catalogs/all')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_get_many.py
+
+Unit tests for the Repo.get_many bulk read API.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from munkilib import munkirepo
+
+
+class DictRepo(munkirepo.Repo):
+    """A minimal plugin that only implements get(), like an older
+    third-party plugin would"""
+
+    def __init__(self, url):
+        self.items = {}
+
+    def get(self, resource_identifier):
+        try:
+            return self.items[resource_identifier]
+        except KeyError:
+            raise munkirepo.RepoError('%s not found' % resource_identifier)
+
+
+class LegacyRepo(object):
+    """A plugin that doesn't derive from Repo at all"""
+
+    def __init__(self, url):
+        self.items = {}
+
+    def get(self, resource_identifier):
+        try:
+            return self.items[resource_identifier]
+        except KeyError:
+            raise munkirepo.RepoError('%s not found' % resource_identifier)
+
+
+class TestGetMany(unittest.TestCase):
+    """Test get_many for the base class and FileRepo."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, 'manifests'))
+        self.refs = ['manifests/site%s' % index for index in range(50)]
+        for ref in self.refs:
+            with open(os.path.join(self.tmpdir, ref), 'w') as fileref:
+                fileref.write(ref)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_results(self, repo):
+        """get_many returns content in order, with errors in place"""
+        refs = self.refs[:10] + ['manifests/missing'] + self.refs[10:]
+        results = list(munkirepo.get_many(repo, refs))
+        self.assertEqual([ref for ref, dummy_content in results], refs)
+        for ref, content in results:
+            if ref == 'manifests/missing':
+                self.assertTrue(isinstance(content, munkirepo.RepoError))
+            else:
+                self.assertEqual(content, ref)
+
+    def test_serial_fallback(self):
+        repo = DictRepo('dict:')
+        for ref in self.refs:
+            repo.items[ref] = ref
+        self.check_results(repo)
+
+    def test_plugin_not_derived_from_repo(self):
+        repo = LegacyRepo('legacy:')
+        for ref in self.refs:
+            repo.items[ref] = ref
+        self.check_results(repo)
+
+    def test_file_repo(self):
+        self.check_results(munkirepo.connect('file://' + self.tmpdir, None))
+
+    def test_file_repo_threads(self):
+        repo = munkirepo.connect('file://' + self.tmpdir, None)
+        original_get = repo.get
+        threads = set()
+
+        def recording_get(resource_identifier):
+            threads.add(threading.current_thread().name)
+            return original_get(resource_identifier)
+
+        repo.get = recording_get
+        list(munkirepo.get_many(repo, self.refs, threads=1))
+        self.assertEqual(threads, set([threading.current_thread().name]))
+        threads.clear()
+        list(munkirepo.get_many(repo, self.refs, threads=3))
+        self.assertNotIn(threading.current_thread().name, threads)
+
+    def test_stopping_early_abandons_remaining_reads(self):
+        repo = DictRepo('dict:')
+        read = []
+
+        def slow_get(resource_identifier):
+            read.append(resource_identifier)
+            time.sleep(0.01)
+            return resource_identifier
+
+        repo.get = slow_get
+        results = munkirepo.get_many_in_threads(repo, self.refs, 2)
+        self.assertEqual(next(results), (self.refs[0], self.refs[0]))
+        results.close()
+        count = len(read)
+        time.sleep(0.1)
+        self.assertEqual(len(read), count)
+        self.assertTrue(count < len(self.refs))
+
+    def test_empty_list(self):
+        repo = munkirepo.connect('file://' + self.tmpdir, None)
+        self.assertEqual(list(repo.get_many([])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
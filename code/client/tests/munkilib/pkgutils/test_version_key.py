@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+test_version_key.py
+
+Unit tests for pkgutils.version_key.
+
+These check, over many randomly generated version strings, that comparing
+version keys always gives the same answer as comparing MunkiLooseVersion
+objects.
+
+"""
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import unittest
+
+from munkilib import pkgutils
+
+
+# characters version strings are built from; weighted towards digits and
+# periods, with the separators and letters real-world versions contain
+VERSION_CHARS = '0123456789' * 4 + '.' * 6 + '00' + 'abdvAB- ,_(' + u'é'
+# a few versions that exercise the trailing zero handling
+SPECIAL_VERSIONS = ['', '0', '0.0', '10.6', '10.6.0', '10.6.0.0', '10.06',
+                    '1.0a', '1.0.0a', '1.0b1', '1.0-1', None, 5, u'2.0']
+NUMBER_OF_VERSIONS = 400
+
+
+def random_version(rand):
+    """Returns a random version string"""
+    return ''.join(rand.choice(VERSION_CHARS)
+                   for dummy_i in range(rand.randint(1, 12)))
+
+
+def sign(number):
+    """Returns -1, 0 or 1"""
+    return cmp(number, 0)
+
+
+class TestVersionKey(unittest.TestCase):
+    """Test pkgutils.version_key against MunkiLooseVersion."""
+
+    def setUp(self):
+        rand = random.Random(20181016)
+        self.versions = SPECIAL_VERSIONS + [
+            random_version(rand) for dummy_i in range(NUMBER_OF_VERSIONS)]
+
+    def test_ordering_matches_munkilooseversion(self):
+        for vers_a in self.versions:
+            loose_a = pkgutils.MunkiLooseVersion(vers_a)
+            key_a = pkgutils.version_key(vers_a)
+            for vers_b in self.versions:
+                self.assertEqual(
+                    sign(cmp(key_a, pkgutils.version_key(vers_b))),
+                    sign(cmp(loose_a, pkgutils.MunkiLooseVersion(vers_b))),
+                    'version_key disagrees for %r and %r' % (vers_a, vers_b))
+
+    def test_equal_keys_have_equal_hashes(self):
+        self.assertEqual(pkgutils.version_key('10.6'),
+                         pkgutils.version_key('10.6.0'))
+        self.assertEqual(hash(pkgutils.version_key('10.6')),
+                         hash(pkgutils.version_key('10.6.0.0')))
+
+    def test_sorting_matches_munkilooseversion(self):
+        by_key = sorted(self.versions, key=pkgutils.version_key)
+        by_loose = sorted(self.versions, key=pkgutils.MunkiLooseVersion)
+        self.assertEqual(by_key, by_loose)
+
+    def test_cache_is_bounded(self):
+        for index in range(pkgutils.VERSION_KEY_CACHE_SIZE + 100):
+            pkgutils.version_key('1.%s' % index)
+        self.assertTrue(
+            len(pkgutils._VERSION_KEYS) <= pkgutils.VERSION_KEY_CACHE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()